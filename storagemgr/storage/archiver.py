@@ -9,14 +9,20 @@ the file modification date at time of archive.
 
 import shutil
 from gi.repository import GExiv2
-from os import walk, makedirs, stat
-from os.path import join, splitext, getmtime, isdir, isfile
+from os import walk, makedirs, remove, stat
+from os.path import basename, dirname, join, splitext, getmtime, isdir, isfile
 from datetime import datetime
 
-from storage.smhash import smhash
+from django.db.models import F, Q
+
+from storage.smhash import image_digested
+from storage.hashcache import cached_fingerprint, digest_algorithm
+from storage.batch import TransactionBatch
+from storage.throttle import IOBudget
 from storage.mediainfo import MediaInfo
-from storage.models import Hash, RootPath, RelPath, File, Keyword
+from storage.models import Hash, RootPath, RelPath, File, KeywordSync
 from storage.models import IMAGE_TYPES, VIDEO_TYPES
+from storage.models import file_details
 
 from logger import init_logging
 logger = init_logging(__name__)
@@ -25,6 +31,11 @@ class UnknownFormat(Exception):
     pass
 
 
+class ArchiveFailed(Exception):
+    """Some files couldn't be added to the archive"""
+    pass
+
+
 class Archiver(object):
     """Archive the supplied directory"""
     
@@ -33,15 +44,36 @@ class Archiver(object):
         self.destination = destination
         self.root_path = RootPath.getrootpath(destination)
         assert self.root_path is not None, "No root for requested destination"
+        # Files are added to a few directories, read them all up front
+        RelPath.warm_cache(self.root_path)
         self.descend = descend
         self.break_on_add = break_on_add
+        self.batch = TransactionBatch()
+        # Hashing and copying are charged to the destination's I/O budget
+        self.budget = IOBudget.for_root(self.root_path)
+        # Whether any file's contents have changed since it was added,
+        # see unmatched()
+        self.changed_files = None
+        # The paths of the copies made by this run, see archive_copy()
+        self.copies = set()
+        # The algorithms of the existing digests, see File.matching_files()
+        self.algorithms = Hash.algorithms()
         return
 
     def archive(self):
         logger.info("Archiving from {0} to {1}".format(
             self.source, self.destination))
-        for root, folders, filenames in walk(self.source):
-            self.archive_files(filenames, root)
+        try:
+            for root, folders, filenames in walk(self.source):
+                self.archive_files(filenames, root)
+        except BaseException:
+            self.batch.abort()
+            self.remove_uncommitted_copies()
+            raise
+        self.batch.close()
+        if len(self.batch.failed) > 0:
+            raise ArchiveFailed("Unable to archive {0} files, see the "
+                                "log".format(len(self.batch.failed)))
         return
 
     def archive_files(self, filenames, root):
@@ -49,14 +81,29 @@ class Archiver(object):
         #import pdb; pdb.set_trace()
         tmp_root = RootPath(path=root)
         tmp_path = RelPath(path='', root=tmp_root)
+        # Hash the directory's files first, so that their Hashes are
+        # resolved together
+        candidates = []
         for fname in filenames:
             fn = join(root, fname)
             if not self.archive_file(fn):
                 logger.debug("skipped {0}".format(fn))
                 continue
+            if self.unmatched(fn):
+                details = None
+            else:
+                details = file_details(fn, budget=self.budget)
+            candidates.append((fname, fn, details))
+        hashes = Hash.gethashes([(details.digest, details.algorithm)
+                                 for fname, fn, details in candidates
+                                 if details is not None])
+        for fname, fn, details in candidates:
             tmp_file = File(path=tmp_path, name=fname)
-            tmp_file.get_details()
-            matching = tmp_file.matching_files()
+            if details is None:
+                matching = []
+            else:
+                tmp_file.get_details(details, hashes[details.digest])
+                matching = tmp_file.matching_files(self.algorithms)
             if len(matching) == 0:
                 if self.break_on_add:
                     import pdb; pdb.set_trace()
@@ -66,53 +113,120 @@ class Archiver(object):
                 dest = join(self.destination,
                             fdate.strftime("%Y"),
                             fdate.strftime("%m%b"))
-                relpath = RelPath.getrelpath(dest, self.root_path)
-                if not isdir(relpath.abspath):
-                    makedirs(relpath.abspath)
-                newfn = self.avoid_clash(newfn, relpath)
-                new_file = File(path=relpath, name=newfn)
-                if isfile(new_file.abspath):
+                if not isdir(dest):
+                    makedirs(dest)
+                newfn = self.avoid_clash(newfn, dest)
+                new_path = join(dest, newfn)
+                if isfile(new_path):
                     # This should never happen
                     raise ValueError("destination already exists: {0}".format(
-                        new_file))
-                #shutil.copy2(fn, new_file.abspath)
-                self.copy_file(fn, new_file)
-                new_file.update_details()
-                logger.info("added {0} as {1} ({2})".format(
-                            fn,
-                            new_file.name,
-                            new_file.hash.digest))
+                        new_path))
+                self.batch.run(self.archive_copy, fn, dest, newfn)
             else:
                 logger.info("{0} matches {1}".format(fname, matching))
                 # Merge keywords from the new file
                 #import pdb; pdb.set_trace()
                 keywords = set(tmp_file.file_keywords())
                 if len(keywords) > 0:
-                    for existing_file in matching:
-                        logger.info("updating {0} from matching file {1}".format(
-                            existing_file, fname))
-                        existing_keywords = set(
-                            [x.name for x in existing_file.keyword_set.all()])
-                        new_keywords = keywords - existing_keywords
-                        # If there are new keywords, write them to the db and
-                        # back to the file
-                        if len(new_keywords) > 0:
-                            logger.info("Adding keywords {0} to {1}".format(
-                                new_keywords, existing_file))
-                            # Write the keywords to the database
-                            for kw in new_keywords:
-                                Keyword.get_or_add(kw).files.add(existing_file)
-                            # Write the keywords to the archived image
-                            all_keywords = list(keywords.union(existing_keywords))
-                            img_exiv2 = existing_file.file_exiv2()
-                            img_exiv2.set_tag_multiple(
-                                'Iptc.Application2.Keywords', list(all_keywords))
-                            img_exiv2.save_file()
+                    self.batch.run(self.merge_keywords, fname, keywords,
+                                   matching)
+        return
+
+    def unmatched(self, fn):
+        """Answer a boolean indicating whether fn is known not to match any
+        file, from its size and fingerprint, without reading all of it.
+
+        Images (and RAWs and videos with the media scheme) are hashed by
+        their image data, so files with different contents may match, and files whose contents have changed match
+        on their original hash, so neither can be prefiltered."""
+        if image_digested(fn, digest_algorithm()):
+            return False
+        if self.changed_files is None:
+            self.changed_files = File.objects.exclude(
+                hash=F('original_hash')).exists()
+        if self.changed_files:
+            return False
+        stats = stat(fn)
+        candidates = File.objects.filter(
+            Q(fingerprint=cached_fingerprint(fn, stats, self.budget)) |
+            Q(fingerprint=None), size=stats.st_size)
+        return not candidates.exists()
+
+    def archive_copy(self, fn, dest, newfn):
+        """Copy fn to dest/newfn and add the copy to the database.
+        This is run as a unit of the receivers batch, so may be repeated:
+        a copy made by an earlier attempt is reused.  If the unit fails,
+        the copy is removed, so that the archive has no files the
+        database doesn't know about."""
+        new_path = join(dest, newfn)
+        try:
+            if new_path not in self.copies:
+                self.copies.add(new_path)
+                self.copy_file(fn, new_path)
+            return self.add_file(fn, dest, newfn)
+        except Exception:
+            self.remove_copy(new_path)
+            raise
+
+    def remove_copy(self, path):
+        """Remove the copy at path"""
+        logger.info(u"Removing uncommitted copy: {0}".format(path))
+        self.copies.discard(path)
+        if isfile(path):
+            remove(path)
+        return
+
+    def remove_uncommitted_copies(self):
+        """Remove the copies whose database rows were rolled back"""
+        for path in list(self.copies):
+            relpath = dirname(path)[len(self.root_path.path)+1:]
+            if not File.objects.filter(path__root=self.root_path,
+                                       path__path=relpath,
+                                       name=basename(path),
+                                       deleted=None).exists():
+                self.remove_copy(path)
+        return
+
+    def add_file(self, fn, dest, newfn):
+        """Add the copy of fn, dest/newfn, to the database.
+        This is run as a unit of the receivers batch, so may be repeated."""
+        relpath = RelPath.getrelpath(dest, self.root_path)
+        new_file = File(path=relpath, name=newfn)
+        new_file.update_details()
+        logger.info("added {0} as {1} ({2})".format(
+                    fn,
+                    new_file.name,
+                    new_file.hash.digest))
+        return new_file
+
+    def merge_keywords(self, fname, keywords, matching):
+        """Add keywords from fname to each of the matching files.
+        This is run as a unit of the receivers batch, so may be repeated."""
+        keyword_sync = KeywordSync()
+        file_keywords = KeywordSync.keyword_names(matching)
+        for existing_file in matching:
+            logger.info("updating {0} from matching file {1}".format(
+                existing_file, fname))
+            existing_keywords = file_keywords[existing_file.pk]
+            new_keywords = keywords - existing_keywords
+            # If there are new keywords, write them to the db and
+            # back to the file
+            if len(new_keywords) > 0:
+                logger.info("Adding keywords {0} to {1}".format(
+                    new_keywords, existing_file))
+                keyword_sync.add_keywords(existing_file, new_keywords)
+                # Write the keywords to the archived image
+                all_keywords = list(keywords.union(existing_keywords))
+                img_exiv2 = existing_file.file_exiv2()
+                img_exiv2.set_tag_multiple(
+                    'Iptc.Application2.Keywords', list(all_keywords))
+                img_exiv2.save_file()
+        # Write the keywords to the database
+        keyword_sync.apply()
         return
 
-    def copy_file(self, from_fn, to_file):
-        """Copy from_fn to the file pointed to by to_file,
-        and validate the results"""
+    def copy_file(self, from_fn, to_fn):
+        """Copy from_fn to to_fn, and validate the results"""
         from_stats = stat(from_fn)
         from_size = from_stats.st_size
         if from_size == 0:
@@ -120,22 +234,24 @@ class Archiver(object):
             msg = "Source file has 0 bytes: {0}".format(from_fn)
             logger.fatal(msg)
             import pdb; pdb.set_trace()
-        shutil.copy2(from_fn, to_file.abspath)
+        if self.budget is not None:
+            self.budget.consume(from_size)
+        shutil.copy2(from_fn, to_fn)
         #
         # Copy validation since we've seen some 0 length files.
         #
         # Confirm file size
-        to_stats = stat(to_file.abspath)
+        to_stats = stat(to_fn)
         to_size = to_stats.st_size
         if to_size == 0:
             # Should never get here
-            msg = "Copied file has 0 bytes: {0}".format(to_file.abspath)
+            msg = "Copied file has 0 bytes: {0}".format(to_fn)
             logger.fatal(msg)
             import pdb; pdb.set_trace()
         if to_size != from_size:
             # Should never get here
             msg = "Copied file sizes don't match: {0} and {1}".format(
-                from_fn, to_file.abspath)
+                from_fn, to_fn)
             logger.fatal(msg)
             import pdb; pdb.set_trace()
         # Get the mtime, we don't care about microsecond differences
@@ -145,7 +261,7 @@ class Archiver(object):
         if from_mtime != to_mtime:
             # Should never get here
             msg = "Copied file dates don't match: {0} and {1}".format(
-                from_fn, to_file.abspath)
+                from_fn, to_fn)
             logger.fatal(msg)
             import pdb; pdb.set_trace()
         return
@@ -169,11 +285,10 @@ class Archiver(object):
         filename, etc."""
         return True
         
-    def avoid_clash(self, filename, relpath):
+    def avoid_clash(self, filename, dest):
         """Ensure that the supplied filename doesn't exist in the target
-        directory."""
+        directory, dest."""
         newname = filename
-        dest = relpath.abspath
         newp = join(dest, newname)
         if isfile(newp):
             logger.info("avoiding name clash for {0}".format(newname))
@@ -0,0 +1,187 @@
+"""
+Module: batch
+
+Group database writes in to transactions.
+
+Committing each row on its own costs a disk sync per row on InnoDB, which
+dominates the time taken to scan or archive a large tree.  TransactionBatch
+runs units of work (e.g. a directory of a scan) inside a shared transaction
+that is committed every size units or interval seconds.
+
+In-process caches of database rows (e.g. Hash ids) register with
+on_rollback() to be cleared when a transaction is rolled back, since they
+may refer to rows that no longer exist.
+"""
+
+import sys
+import time
+
+from django.conf import settings
+from django.db import transaction
+
+from logger import init_logging
+logger = init_logging(__name__)
+
+# The functions called when a transaction is rolled back, see on_rollback()
+_rollback_hooks = []
+
+
+def on_rollback(func):
+    """Register func to be called, without arguments, whenever a
+    TransactionBatch's transaction is rolled back"""
+    if func not in _rollback_hooks:
+        _rollback_hooks.append(func)
+    return func
+
+
+def rolled_back():
+    """Call the functions registered with on_rollback()"""
+    for func in _rollback_hooks:
+        func()
+    return
+
+
+class TransactionBatch(object):
+    """Run units of work in transactions of up to size units or
+    interval seconds.
+
+    Each unit is a callable that is executed immediately in the open
+    transaction, without a savepoint of its own, so that a unit costs no
+    extra queries.  If a unit fails, the transaction is rolled back, the
+    batch's earlier units are replayed each in its own transaction and the
+    failed unit retried (up to retries times), so only the failed unit is
+    lost.  Units that still fail are added to failed.  If the commit itself
+    fails, each unit of the batch is replayed in the same way.  Units must
+    therefore be safe to repeat.
+
+    on_commit, if supplied, is called with the list of the committed units'
+    results just before the transaction is committed.
+
+    commit_time is the total seconds spent committing."""
+
+    def __init__(self, size=None, interval=None, retries=1, on_commit=None):
+        if size is None:
+            size = settings.COMMIT_SIZE
+        if interval is None:
+            interval = settings.COMMIT_INTERVAL
+        self.size = size
+        self.interval = interval
+        self.retries = retries
+        self.on_commit = on_commit
+        self.atomic = None
+        self.units = []
+        self.results = []
+        self.failed = []
+        self.started = None
+        self.commit_time = 0.0
+
+    def run(self, func, *args):
+        """Run func(*args) in the current batch"""
+        if self.atomic is None:
+            self.begin()
+        try:
+            result = func(*args)
+        except Exception:
+            logger.warn("Unit failed, replaying the batch: {0}{1}".format(
+                func.__name__, args), exc_info=True)
+            self.rollback()
+            self.replay()
+            self.run_alone(func, args, self.retries)
+            return
+        self.units.append((func, args))
+        self.results.append(result)
+        if len(self.units) >= self.size or \
+                time.time() - self.started >= self.interval:
+            self.commit()
+        return
+
+    def begin(self):
+        self.atomic = transaction.atomic()
+        self.atomic.__enter__()
+        self.started = time.time()
+        return
+
+    def commit(self):
+        """Commit the current transaction, if any"""
+        if self.atomic is None:
+            return
+        try:
+            if self.on_commit is not None:
+                self.on_commit(self.results)
+        except Exception:
+            logger.warn("Batch failed, retrying units individually",
+                        exc_info=True)
+            self.rollback()
+            self.replay()
+            return
+        atomic = self.atomic
+        self.atomic = None
+        start = time.time()
+        try:
+            atomic.__exit__(None, None, None)
+        except Exception:
+            # The transaction has been rolled back
+            logger.warn("Commit failed, retrying units individually",
+                        exc_info=True)
+            rolled_back()
+            self.replay()
+            return
+        self.commit_time += time.time() - start
+        self.reset()
+        return
+
+    def rollback(self):
+        """Roll back the current transaction.
+        Must be called while handling the exception that caused it."""
+        atomic = self.atomic
+        self.atomic = None
+        try:
+            atomic.__exit__(*sys.exc_info())
+        finally:
+            rolled_back()
+        return
+
+    def replay(self):
+        """Retry each of the batch's units in its own transaction"""
+        units = self.units
+        self.reset()
+        for func, args in units:
+            self.run_alone(func, args, self.retries + 1)
+        return
+
+    def run_alone(self, func, args, attempts):
+        """Run func(*args) in its own transaction, up to attempts times.
+        If it still fails, add it to failed."""
+        for attempt in range(attempts):
+            try:
+                with transaction.atomic():
+                    result = func(*args)
+                    if self.on_commit is not None:
+                        self.on_commit([result])
+                return
+            except Exception:
+                rolled_back()
+                logger.warn("Unit failed: {0}{1}".format(
+                    func.__name__, args), exc_info=True)
+        logger.error("Giving up on: {0}{1}".format(func.__name__, args))
+        self.failed.append((func, args))
+        return
+
+    def abort(self):
+        """Roll back the current transaction, e.g. when interrupted.
+        Must be called while handling the exception."""
+        if self.atomic is not None:
+            self.rollback()
+        self.reset()
+        return
+
+    def reset(self):
+        self.atomic = None
+        self.units = []
+        self.results = []
+        return
+
+    def close(self):
+        """Commit any outstanding work"""
+        self.commit()
+        return
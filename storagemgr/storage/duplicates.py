@@ -4,8 +4,11 @@ import pandas as pd
 from os.path import join
 from copy import copy
 
+from django.db.models import Count
+
 from storage.models import Hash, RootPath, RelPath, File
 from storage.models import PathPriority
+from storage.nearindex import near_clusters
 
 from logger import init_logging
 logger = init_logging(__name__)
@@ -59,7 +62,14 @@ class Duplicates(object):
     @classmethod
     def load_from_db(cls, *args, **kwargs):
         dup = cls()
-        hash = pd.DataFrame.from_records(Hash.objects.values('id', 'digest'))
+        algorithms = Hash.algorithms()
+        if len(algorithms) > 1:
+            logger.warn("Digests use several algorithms ({0}), duplicates "
+                        "are only found between files with the same "
+                        "algorithm until migrate_hashes has finished".format(
+                            ", ".join(algorithms)))
+        hash = pd.DataFrame.from_records(Hash.objects.values('id', 'digest',
+                                                             'algorithm'))
         dup.hash = hash.set_index('id')
         root_path = pd.DataFrame.from_records(RootPath.objects.values('id', 'path'))
         dup.root_path = root_path.set_index('id')
@@ -91,6 +101,33 @@ class Duplicates(object):
         return dup
 
 
+def near_duplicates(threshold):
+    """Answer the iterator of near duplicate images: lists of Files whose
+    perceptual hashes are within threshold bits of each other, but which
+    aren't all the same file (Hash)."""
+    files = File.objects.filter(deleted=None, symbolic_link=False,
+                                dhash__isnull=False)
+    dhashes = files.values_list('dhash', flat=True).distinct()
+    clusters = near_clusters(dhashes.iterator(), threshold)
+    # Files with the same perceptual hash but different digests, e.g.
+    # re-encoded at the same size, are also near duplicates
+    clustered = set()
+    for cluster in clusters:
+        clustered.update(cluster)
+    same = files.values('dhash').annotate(
+        hashes=Count('hash', distinct=True)).filter(hashes__gt=1)
+    for row in same:
+        if row['dhash'] not in clustered:
+            clusters.append(set([row['dhash']]))
+    logger.info("{0} near duplicate clusters".format(len(clusters)))
+    for cluster in clusters:
+        cluster_files = list(files.filter(dhash__in=cluster)
+                             .select_related('path__root', 'hash')
+                             .order_by('dhash', 'name'))
+        if len(set(file.hash_id for file in cluster_files)) > 1:
+            yield cluster_files
+
+
 class Deduplicate(object):
     """Do the work of deciding which files to remove for the supplied Hash
     and setting up the symbolic links."""
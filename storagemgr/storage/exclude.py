@@ -0,0 +1,111 @@
+"""
+Module: exclude
+
+Match directories against the ExcludeDir rules of a root path.
+
+The rules of a root (including the global rules) are compiled in to a
+single ExcludeMatcher:
+
+* Literal rules, e.g. "\\.git" or "VirtualBox VMs", are combined in to an
+  alternation of plain strings.  As they can't contain a "/", a literal
+  that is in a path is in one of its components, so a directory whose
+  parent isn't excluded only has its own name searched.
+* All other rules are combined in to a single alternation regex, which is
+  searched for in the directory's absolute path.
+
+Every rule is therefore still searched for anywhere in the absolute path,
+as ExcludeDir has always been applied, e.g. "\\.git" excludes
+"project.git" and ".gitignore.d".
+
+Matchers are cached per root until an ExcludeDir is saved or deleted.
+"""
+
+import re
+from os.path import basename
+
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from storage.models import ExcludeDir
+
+from logger import init_logging
+logger = init_logging(__name__)
+
+# A regex consisting only of literal characters and escaped punctuation
+LITERAL_RE = re.compile(r'^(?:[^\\.^$*+?{}\[\]|()/]|\\[^A-Za-z0-9/])+$')
+# Regex features that can't safely be combined with other regexes:
+# backreferences and inline flags
+UNCOMBINABLE_RE = re.compile(r'\\[1-9]|\(\?P=|\(\?[aiLmsux]')
+
+# root_path.pk: ExcludeMatcher
+_matchers = {}
+
+
+class ExcludeMatcher(object):
+    """Answer whether a directory is excluded by any of the supplied
+    regexes (strings)"""
+
+    def __init__(self, regexes):
+        literals = set()
+        combined = []
+        self.separate = []
+        for regex in regexes:
+            if LITERAL_RE.match(regex):
+                literals.add(re.sub(r'\\(.)', r'\1', regex))
+            elif UNCOMBINABLE_RE.search(regex):
+                self.separate.append(re.compile(regex))
+            else:
+                combined.append(u"(?:{0})".format(regex))
+        self.literals = frozenset(literals)
+        if len(literals) > 0:
+            self.literal_regex = re.compile(u"|".join(
+                re.escape(literal) for literal in sorted(literals)))
+        else:
+            self.literal_regex = None
+        if len(combined) > 0:
+            self.regex = re.compile(u"|".join(combined))
+        else:
+            self.regex = None
+
+    def excluded(self, path):
+        """Answer a boolean indicating whether path is excluded"""
+        if self.literal_regex is not None and \
+                self.literal_regex.search(path):
+            return True
+        return self.regex_excluded(path)
+
+    def child_excluded(self, path):
+        """Answer a boolean indicating whether path is excluded, where its
+        parent is known not to be excluded, i.e. only the last component
+        is searched for the literal rules"""
+        if self.literal_regex is not None and \
+                self.literal_regex.search(basename(path)):
+            return True
+        return self.regex_excluded(path)
+
+    def regex_excluded(self, path):
+        if self.regex is not None and self.regex.search(path):
+            return True
+        for regex in self.separate:
+            if regex.search(path):
+                return True
+        return False
+
+
+def exclude_matcher(root_path):
+    """Answer the (cached) ExcludeMatcher for the supplied root path"""
+    matcher = _matchers.get(root_path.pk)
+    if matcher is None:
+        query = Q(root_path=root_path) | Q(root_path=None)
+        regexes = [rec.regex for rec in ExcludeDir.objects.filter(query)]
+        matcher = ExcludeMatcher(regexes)
+        _matchers[root_path.pk] = matcher
+    return matcher
+
+
+@receiver(post_save, sender=ExcludeDir)
+@receiver(post_delete, sender=ExcludeDir)
+def exclude_dir_changed(sender, **kwargs):
+    """Discard the cached matchers, global rules affect every root"""
+    _matchers.clear()
@@ -0,0 +1,236 @@
+"""
+Module: hashcache
+
+A persistent cache of file digests and fingerprints, so that files that
+haven't changed since they were last hashed (by a scan, the archiver or the
+smhash command) cost only a stat.
+
+Entries are keyed by (st_dev, st_ino, st_size, mtime_ns) and the kind of
+value: 'fingerprint' or the digest's algorithm, e.g. 'sha256'.  They are
+stored in the SQLite database settings.HASH_CACHE_PATH (None = no cache).
+Once there are more than settings.HASH_CACHE_ENTRIES the least recently
+used entries are evicted.
+
+The cache is an optimisation only, database errors are logged and the
+file is hashed as usual.
+"""
+
+import os
+import sqlite3
+import stat
+import threading
+import time
+
+from django.conf import settings
+
+from storage.smhash import smhash, fingerprint, join_algorithm, image_dhash
+from storage.smhash import JPEG_SCHEME, MEDIA_SCHEME
+
+from logger import init_logging
+logger = init_logging(__name__)
+
+# The table name includes the version of the digests, so changing the way
+# files are hashed doesn't answer stale digests
+TABLE = 'digests_v2'
+# The kind of the fingerprint and perceptual hash entries
+FINGERPRINT = 'fingerprint'
+DHASH = 'dhash'
+# The cached value of files without a dhash, e.g. undecodable images, so
+# that they aren't decoded again
+NO_DHASH = 'none'
+# Seconds between updates of an entry's last use
+USED_RESOLUTION = 3600
+# Entries added between checks of the cache size
+EVICT_CHECK = 1000
+# The fraction of HASH_CACHE_ENTRIES left after eviction
+EVICT_TO = 0.9
+
+# The cache of the current process and thread, see hash_cache()
+_local = threading.local()
+
+
+def stat_mtime_ns(stats):
+    """Answer the mtime in nanoseconds from the supplied os.stat().
+
+    It is always derived from the float st_mtime, since on Python 2 only
+    scandir's stats have an exact st_mtime_ns, and the values must be the
+    same whichever way the file was stat'd."""
+    return int(stats.st_mtime * 1000000000)
+
+
+class HashCache(object):
+    """The digest cache stored in the SQLite database at path"""
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.pid = os.getpid()
+        self.added = 0
+        self.db = sqlite3.connect(path, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS {0} ("
+            "dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, "
+            "kind TEXT, value TEXT, used INTEGER, "
+            "PRIMARY KEY (dev, ino, size, mtime_ns, kind))".format(TABLE))
+        self.db.execute("CREATE INDEX IF NOT EXISTS {0}_used "
+                        "ON {0} (used)".format(TABLE))
+        self.db.commit()
+
+    @staticmethod
+    def key(stats, kind):
+        return (stats.st_dev, stats.st_ino, stats.st_size,
+                stat_mtime_ns(stats), kind)
+
+    def get(self, stats, kind):
+        """Answer the cached value of kind (FINGERPRINT or a digest
+        algorithm) for the file with the supplied os.stat(), or None"""
+        key = self.key(stats, kind)
+        row = self.db.execute(
+            "SELECT value, used FROM {0} WHERE dev=? AND ino=? AND size=? "
+            "AND mtime_ns=? AND kind=?".format(TABLE), key).fetchone()
+        if row is None:
+            return None
+        now = int(time.time())
+        if now - row[1] > USED_RESOLUTION:
+            self.db.execute(
+                "UPDATE {0} SET used=? WHERE dev=? AND ino=? AND size=? "
+                "AND mtime_ns=? AND kind=?".format(TABLE), (now,) + key)
+            self.db.commit()
+        return row[0]
+
+    def put(self, stats, kind, value):
+        """Cache the value of kind for the file with the supplied
+        os.stat()"""
+        self.db.execute(
+            "INSERT OR REPLACE INTO {0} (dev, ino, size, mtime_ns, kind, "
+            "value, used) VALUES (?, ?, ?, ?, ?, ?, ?)".format(TABLE),
+            self.key(stats, kind) + (value, int(time.time())))
+        self.db.commit()
+        self.added += 1
+        if self.added % EVICT_CHECK == 0:
+            self.evict()
+        return
+
+    def evict(self):
+        """Remove the least recently used entries if the cache is full"""
+        count = self.db.execute(
+            "SELECT COUNT(*) FROM {0}".format(TABLE)).fetchone()[0]
+        if count <= self.max_entries:
+            return
+        excess = count - int(self.max_entries * EVICT_TO)
+        logger.debug("Evicting {0} hash cache entries".format(excess))
+        self.db.execute(
+            "DELETE FROM {0} WHERE rowid IN (SELECT rowid FROM {0} "
+            "ORDER BY used LIMIT ?)".format(TABLE), (excess,))
+        self.db.commit()
+        return
+
+
+def hash_cache():
+    """Answer the HashCache of the current thread, or None if disabled.
+    SQLite connections can't be shared with forked processes or other
+    threads, so each opens its own."""
+    if settings.HASH_CACHE_PATH is None:
+        return None
+    cache = getattr(_local, 'cache', None)
+    if cache is None or cache.pid != os.getpid() or \
+            cache.path != settings.HASH_CACHE_PATH:
+        try:
+            cache = HashCache(settings.HASH_CACHE_PATH,
+                              settings.HASH_CACHE_ENTRIES)
+        except sqlite3.Error as e:
+            logger.warn("Unable to open hash cache {0}: {1}".format(
+                settings.HASH_CACHE_PATH, e))
+            return None
+        _local.cache = cache
+    return cache
+
+
+def content_stats(fn, stats=None):
+    """Answer the os.stat() of the contents of fn, i.e. of the target of a
+    symbolic link.  stats is the os_stats() of fn, if already known."""
+    if stats is None or stat.S_ISLNK(stats.st_mode):
+        stats = os.stat(fn)
+    return stats
+
+
+def cached(kind, func, fn, stats, budget, refresh):
+    """Answer the cached kind of value for fn, calling
+    func(fn, stats, budget) to calculate it if necessary, or if refresh
+    is True"""
+    stats = content_stats(fn, stats)
+    cache = hash_cache()
+    if cache is None:
+        return func(fn, stats, budget)
+    try:
+        value = None if refresh else cache.get(stats, kind)
+    except sqlite3.Error as e:
+        logger.warn("Hash cache read failed: {0}".format(e))
+        return func(fn, stats, budget)
+    if value is None:
+        value = func(fn, stats, budget)
+        try:
+            cache.put(stats, kind, value)
+        except sqlite3.Error as e:
+            logger.warn("Hash cache write failed: {0}".format(e))
+    return value
+
+
+def digest_algorithm():
+    """Answer the algorithm of new digests: settings.SMHASH_ALGORITHM,
+    with the JPEG_SCHEME if settings.SMHASH_JPEG_STREAM and the
+    MEDIA_SCHEME if settings.SMHASH_MEDIA_STREAM"""
+    schemes = []
+    if settings.SMHASH_JPEG_STREAM:
+        schemes.append(JPEG_SCHEME)
+    if settings.SMHASH_MEDIA_STREAM:
+        schemes.append(MEDIA_SCHEME)
+    return join_algorithm(settings.SMHASH_ALGORITHM, schemes)
+
+
+def cached_smhash(fn, stats=None, budget=None, refresh=False,
+                  algorithm=None, dhashes=None):
+    """Answer smhash(fn), using the cache unless refresh is True.
+    stats is the os_stats() of fn, if already known.
+    algorithm defaults to digest_algorithm().
+    dhashes is passed to smhash(), if the file is hashed."""
+    if algorithm is None:
+        algorithm = digest_algorithm()
+    return cached(algorithm,
+                  lambda fn, stats, budget: smhash(fn, budget, algorithm,
+                                                   dhashes),
+                  fn, stats, budget, refresh)
+
+
+def cached_dhash(fn, stats=None, budget=None, refresh=False, dhashes=None):
+    """Answer image_dhash(fn), using the cache unless refresh is True.
+    stats is the os_stats() of fn, if already known.
+    dhashes are those already calculated by smhash(), see cached_smhash()."""
+
+    def calculate(fn, stats, budget):
+        if dhashes is not None and fn in dhashes:
+            value = dhashes[fn]
+        else:
+            if budget is not None:
+                budget.consume(stats.st_size)
+            value = image_dhash(fn)
+        if value is None:
+            return NO_DHASH
+        return value
+
+    value = cached(DHASH, calculate, fn, stats, budget, refresh)
+    if value == NO_DHASH:
+        return None
+    # The cache answers text
+    return int(value)
+
+
+def cached_fingerprint(fn, stats=None, budget=None, refresh=False):
+    """Answer fingerprint(fn), using the cache unless refresh is True.
+    stats is the os_stats() of fn, if already known."""
+    return cached(FINGERPRINT,
+                  lambda fn, stats, budget: fingerprint(fn, stats.st_size,
+                                                        budget),
+                  fn, stats, budget, refresh)
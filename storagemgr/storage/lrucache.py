@@ -0,0 +1,52 @@
+"""
+Module: lrucache
+
+A bounded, least recently used, in-process cache of database lookups,
+e.g. Hash digest to id (see models.Hash.gethash()).
+
+Entries may refer to rows created in a transaction that is later rolled
+back, so the caches are cleared when a TransactionBatch rolls back (see
+batch.on_rollback()).
+"""
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """A dictionary of at most size entries, evicting the least recently
+    used"""
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+
+    def get(self, key, default=None):
+        """Answer the value of key, or default if it isn't cached"""
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            return default
+        # Move to the most recently used end
+        self.entries[key] = value
+        return value
+
+    def put(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return
+
+    def discard(self, key):
+        self.entries.pop(key, None)
+        return
+
+    def clear(self):
+        self.entries.clear()
+        return
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
@@ -6,6 +6,7 @@ from optparse import make_option
 from os.path import abspath
 
 from storage.archiver import VideoArchiver, ImageArchiver, Archiver
+from storage.archiver import ArchiveFailed
 
 from logger import init_logging
 logger = init_logging(__name__)
@@ -69,12 +70,12 @@ class Command(BaseCommand):
         if options['images'] or options['media']:
             dest = settings.IMAGES_ARCHIVE
             archiver = ImageArchiver(options['srcdir'], dest, break_on_add=options['break_on_add'])
-            archiver.archive()
+            self.archive(archiver)
 
         if options['videos'] or options['media']:
             dest = settings.IMAGES_ARCHIVE
             archiver = VideoArchiver(options['srcdir'], dest, break_on_add=options['break_on_add'])
-            archiver.archive()
+            self.archive(archiver)
 
         if options['allfiles']:
             import pdb; pdb.set_trace()
@@ -85,3 +86,11 @@ class Command(BaseCommand):
         logger.info("Archive finished")
 
         return
+
+    def archive(self, archiver):
+        try:
+            archiver.archive()
+        except ArchiveFailed as e:
+            logger.fatal(str(e))
+            raise CommandError(str(e))
+        return
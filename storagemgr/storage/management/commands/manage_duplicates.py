@@ -16,7 +16,8 @@ from optparse import make_option
 from django.core.management.base import BaseCommand, CommandError
 
 from storage.models import Hash, File
-from storage.duplicates import Duplicates, Deduplicate
+from storage.duplicates import Duplicates, Deduplicate, near_duplicates
+from storage.smhash import hamming
 
 from logger import init_logging
 logger = init_logging(__name__)
@@ -52,6 +53,12 @@ class Command(BaseCommand):
             dest='deduplicate',
             default=False,
             help='Replace duplicates with symbolic links'),
+        make_option('--near',
+            type='int',
+            dest='near',
+            default=None,
+            help='Print the clusters of images whose perceptual hashes '
+                 'differ by at most NEAR bits'),
         )
 
     def handle(self, *args, **options):
@@ -70,6 +77,8 @@ class Command(BaseCommand):
             self._print_show_hash(args)
         if options['deduplicate']:
             self.deduplicate()
+        if options['near'] is not None:
+            self._print_near(options['near'])
 
         logger.info("Manage Duplicates finished")
 
@@ -109,6 +118,19 @@ class Command(BaseCommand):
                 print(u"\n{0}".format(current_digest))
             print(u"    {0}".format(file.abspath))
         return
+
+    def _print_near(self, threshold):
+        count = 0
+        for files in near_duplicates(threshold):
+            count += 1
+            first = files[0]
+            print(u"\n{0:016x}".format(first.dhash & 0xffffffffffffffff))
+            for file in files:
+                print(u"    {0:2d} {1} {2}".format(
+                    hamming(first.dhash, file.dhash), file.hash.digest[:8],
+                    file.abspath))
+        print("\n{0} clusters".format(count))
+        return
         
 
     def deduplicate(self):
@@ -0,0 +1,86 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from storage.rehash import HashMigration, DHashBackfill
+from storage.rehash import MIGRATION_BATCH_SIZE
+
+from logger import init_logging
+logger = init_logging(__name__)
+
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Rehash files whose digests use an old algorithm'
+    option_list = BaseCommand.option_list + (
+        make_option('--debug',
+            action='store_true',
+            dest='debug',
+            default=False,
+            help='Load pdb and halt on startup'),
+        make_option('--algorithm',
+            dest='algorithm',
+            default=None,
+            help='The new algorithm, e.g. sha256+jpeg (default from '
+                 'settings.SMHASH_ALGORITHM, SMHASH_JPEG_STREAM and '
+                 'SMHASH_MEDIA_STREAM)'),
+        make_option('--batch-size',
+            type='int',
+            dest='batch_size',
+            default=MIGRATION_BATCH_SIZE,
+            help='Hashes migrated per transaction'),
+        make_option('--limit',
+            type='int',
+            dest='limit',
+            default=None,
+            help='The maximum number of hashes to migrate (default all)'),
+        make_option('--pause',
+            type='float',
+            dest='pause',
+            default=0.0,
+            help='Seconds to pause between batches'),
+        make_option('--dhashes',
+            action='store_true',
+            dest='dhashes',
+            default=False,
+            help='Add the perceptual hashes of images scanned without '
+                 'one, instead of migrating the digests'),
+        )
+
+    def handle(self, *args, **options):
+
+        if options['debug']:
+            import pdb
+            pdb.set_trace()
+
+        if options['dhashes']:
+            self.backfill_dhashes(options)
+            return
+
+        logger.info("Migrate Hashes starting")
+        migration = HashMigration(options['algorithm'],
+                                  batch_size=options['batch_size'],
+                                  limit=options['limit'],
+                                  pause=options['pause'])
+        print("Migrating {0} hashes to {1}".format(
+            migration.pending().count(), migration.algorithm))
+        migration.migrate()
+        print("Migrated {0} hashes, skipped {1}".format(
+            migration.migrated, migration.skipped))
+        logger.info("Migrate Hashes finished")
+
+        return
+
+    def backfill_dhashes(self, options):
+        logger.info("DHash backfill starting")
+        backfill = DHashBackfill(batch_size=options['batch_size'],
+                                 limit=options['limit'],
+                                 pause=options['pause'])
+        print("Adding the dhashes of {0} files".format(
+            backfill.pending().count()))
+        backfill.backfill()
+        print("Added {0} dhashes, skipped {1}".format(
+            backfill.updated, backfill.skipped))
+        logger.info("DHash backfill finished")
+        return
@@ -1,9 +1,12 @@
+import sys
 from os.path import isdir, abspath
 from optparse import make_option
 
 from django.core.management.base import BaseCommand, CommandError
 
-from storage.scan import QuickScan, FullScan
+from storage.models import RootPath
+from storage.scan import QuickScan, FullScan, ScanFailed
+from storage.parallel import ParallelScan
 
 from logger import init_logging
 logger = init_logging(__name__)
@@ -24,6 +27,76 @@ class Command(BaseCommand):
             dest='full',
             default=False,
             help='Perform full scan instead'),
+        make_option('--workers',
+            type='int',
+            dest='workers',
+            default=1,
+            help='Number of worker processes used for hashing'),
+        make_option('--threads',
+            action='store_true',
+            dest='threads',
+            default=False,
+            help='Hash with a pool of worker threads instead of processes'),
+        make_option('--resume',
+            action='store_true',
+            dest='resume',
+            default=False,
+            help='Resume the last interrupted scan of each root'),
+        make_option('--commit-size',
+            type='int',
+            dest='commit_size',
+            default=None,
+            help='Directories per transaction (default settings.COMMIT_SIZE)'),
+        make_option('--commit-interval',
+            type='float',
+            dest='commit_interval',
+            default=None,
+            help='Maximum seconds per transaction '
+                 '(default settings.COMMIT_INTERVAL)'),
+        make_option('--skip-unchanged-dirs',
+            action='store_true',
+            dest='skip_unchanged_dirs',
+            default=False,
+            help="Don't check the files of directories whose mtime is unchanged"),
+        make_option('--verify-every',
+            type='int',
+            dest='verify_every',
+            default=7,
+            help='Days between checking the files of unchanged directories '
+                 '(0 = never)'),
+        make_option('--fingerprint',
+            action='store_true',
+            dest='check_fingerprint',
+            default=False,
+            help="Don't rehash files whose mtime has changed if their "
+                 "sampled fingerprint hasn't"),
+        make_option('--parallel-roots',
+            action='store_true',
+            dest='parallel_roots',
+            default=False,
+            help='Scan the roots (all if none are given) concurrently, '
+                 'a process per root or shard'),
+        make_option('--shard-depth',
+            type='int',
+            dest='shard_depth',
+            default=0,
+            help='With --parallel-roots, split each root in to a shard per '
+                 'directory this deep (default 0 = a shard per root)'),
+        make_option('--processes',
+            type='int',
+            dest='processes',
+            default=None,
+            help='With --parallel-roots, the maximum number of concurrent '
+                 'shards (default all)'),
+        make_option('--progress',
+            action='store_true',
+            dest='progress',
+            default=sys.stderr.isatty(),
+            help='Show a progress line (default if stderr is a terminal)'),
+        make_option('--no-progress',
+            action='store_false',
+            dest='progress',
+            help="Don't show the progress line"),
         )
 
     def handle(self, *args, **options):
@@ -33,13 +106,73 @@ class Command(BaseCommand):
             pdb.set_trace()
 
         logger.info("Quick Scan starting")
+        if options['parallel_roots']:
+            self.parallel_scan(args, options)
+            logger.info("Quick Scan finished")
+            return
         for rp in args:
             if options['full']:
-                scan = FullScan(rp)
+                scan = FullScan(rp, workers=options['workers'],
+                        resume=options['resume'],
+                        commit_size=options['commit_size'],
+                        commit_interval=options['commit_interval'],
+                        progress=options['progress'],
+                        threads=options['threads'])
             else:
-                scan = QuickScan(rp)
+                scan = QuickScan(rp, workers=options['workers'],
+                        resume=options['resume'],
+                        commit_size=options['commit_size'],
+                        commit_interval=options['commit_interval'],
+                        progress=options['progress'],
+                        skip_unchanged_dirs=options['skip_unchanged_dirs'],
+                        verify_every=options['verify_every'],
+                        check_fingerprint=options['check_fingerprint'],
+                        threads=options['threads'])
             print("Scanning: {0}".format(scan.root_paths))
-            scan.scan()
+            self.scan(scan)
         logger.info("Quick Scan finished")
 
         return
+
+    def scan(self, scan):
+        """Run the scan, converting a failure to a CommandError"""
+        try:
+            scan.scan()
+        except ScanFailed as e:
+            logger.fatal(str(e))
+            raise CommandError(str(e))
+        return
+
+    def scan_options(self, options):
+        """Answer the scan class and its keyword arguments"""
+        kwargs = dict(workers=options['workers'],
+                      resume=options['resume'],
+                      commit_size=options['commit_size'],
+                      commit_interval=options['commit_interval'],
+                      threads=options['threads'])
+        if options['full']:
+            return FullScan, kwargs
+        kwargs['skip_unchanged_dirs'] = options['skip_unchanged_dirs']
+        kwargs['verify_every'] = options['verify_every']
+        kwargs['check_fingerprint'] = options['check_fingerprint']
+        return QuickScan, kwargs
+
+    def parallel_scan(self, args, options):
+        if len(args) == 0:
+            root_paths = list(RootPath.objects.all())
+        else:
+            root_paths = []
+            for rp in args:
+                for root_path in RootPath.objects.filter(path__icontains=rp):
+                    if root_path not in root_paths:
+                        root_paths.append(root_path)
+        if len(root_paths) == 0:
+            raise CommandError("No root paths found from: {0}".format(args))
+        scan_class, kwargs = self.scan_options(options)
+        scan = ParallelScan(scan_class, kwargs, root_paths,
+                            shard_depth=options['shard_depth'],
+                            processes=options['processes'],
+                            progress=options['progress'])
+        print("Scanning in parallel: {0}".format(root_paths))
+        self.scan(scan)
+        return
@@ -5,7 +5,7 @@ from django.core.management.base import BaseCommand, CommandError
 from optparse import make_option
 
 from storage.archiver import VideoArchiver, ImageArchiver, Archiver
-from storage.smhash import smhash
+from storage.hashcache import cached_smhash
 
 from logger import init_logging
 logger = init_logging(__name__)
@@ -21,6 +21,10 @@ class Command(BaseCommand):
             dest='debug',
             default=False,
             help='Load pdb and halt on startup'),
+        make_option('--algorithm',
+            dest='algorithm',
+            default=None,
+            help='The hashlib algorithm (default settings.SMHASH_ALGORITHM)'),
         )
 
     def handle(self, *args, **options):
@@ -35,7 +39,7 @@ class Command(BaseCommand):
             logger.fatal(msg)
             raise CommandError(msg)
 
-        digest = smhash(args[0])
+        digest = cached_smhash(args[0], algorithm=options['algorithm'])
         print("{0}: {1}".format(args[0], digest))
 
         logger.info("Archive finished")
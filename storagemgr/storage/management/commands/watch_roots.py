@@ -0,0 +1,61 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from storage.watcher import RootWatcher, create_watcher
+from storage.watcher import DEBOUNCE_DELAY, POLL_INTERVAL
+
+from logger import init_logging
+logger = init_logging(__name__)
+
+
+
+class Command(BaseCommand):
+    args = '[root path]'
+    help = 'Continuously update the catalog as the managed directories change'
+    option_list = BaseCommand.option_list + (
+        make_option('--debug',
+            action='store_true',
+            dest='debug',
+            default=False,
+            help='Load pdb and halt on startup'),
+        make_option('--delay',
+            type='float',
+            dest='delay',
+            default=DEBOUNCE_DELAY,
+            help='Seconds a path must be unchanged before it is processed'),
+        make_option('--poll',
+            action='store_true',
+            dest='poll',
+            default=False,
+            help='Poll for changes instead of using inotify'),
+        make_option('--interval',
+            type='float',
+            dest='interval',
+            default=POLL_INTERVAL,
+            help='Seconds between polls'),
+        )
+
+    def handle(self, *args, **options):
+
+        if options['debug']:
+            import pdb
+            pdb.set_trace()
+
+        if len(args) > 1:
+            msg = "Only a single root path may be supplied"
+            logger.fatal(msg)
+            raise CommandError(msg)
+        rp = args[0] if len(args) == 1 else None
+
+        logger.info("Watch Roots starting")
+        watcher = create_watcher(options['poll'], options['interval'])
+        root_watcher = RootWatcher(watcher, rp, delay=options['delay'])
+        print("Watching: {0}".format(root_watcher.scan.root_paths))
+        try:
+            root_watcher.run()
+        except KeyboardInterrupt:
+            pass
+        logger.info("Watch Roots finished")
+
+        return
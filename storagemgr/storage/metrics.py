@@ -0,0 +1,312 @@
+"""
+Module: metrics
+
+Collect scan throughput counters and per phase timings.
+
+Each root path has its own Metrics, the totals are their sum.  At the end
+of a run the report is written to settings.SCAN_REPORT_DIR as:
+
+* scan-YYYYmmdd-HHMMSS.json: the full report, and
+* storagemgr_scan.prom: a Prometheus textfile (for the node exporter's
+  textfile collector).
+
+The previous report of the same kind of scan is used to estimate the time
+remaining, shown by ProgressLine.
+
+Phases:
+
+walk:      Listing directories
+stat:      Stating directory entries
+db_lookup: Reading the known directories and files
+hash:      Hashing file contents
+exif:      Reading image metadata
+db_write:  Inserting and updating rows and committing
+
+With a worker pool, hash and exif are the sum of the workers' times.
+
+The hash phase is also broken down by the type of file and the way it was
+hashed, e.g. 'jpeg/image' or 'mp4/file' (see smhash.smhash()), as the
+number of files and seconds.  Digests answered by the hash cache aren't
+included.
+"""
+
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from glob import glob
+from os.path import basename, isdir, join
+
+from django.conf import settings
+
+from logger import init_logging
+logger = init_logging(__name__)
+
+PHASES = ['walk', 'stat', 'db_lookup', 'hash', 'exif', 'db_write']
+COUNTERS = ['dirs', 'dirs_skipped', 'dirs_moved', 'files', 'files_hashed',
+            'bytes_hashed', 'files_added', 'files_updated', 'files_moved',
+            'files_touched', 'files_deleted']
+PROMETHEUS_FILE = 'storagemgr_scan.prom'
+# Seconds between updates of the progress line
+PROGRESS_INTERVAL = 1.0
+
+
+class Metrics(object):
+    """The counters and phase timings of a single root (or the totals)"""
+
+    def __init__(self):
+        self.counters = dict((name, 0) for name in COUNTERS)
+        self.timings = dict((phase, 0.0) for phase in PHASES)
+        # 'type/method': [files, seconds]
+        self.hash_types = {}
+        self.started = time.time()
+        self.finished = None
+
+    def add(self, other):
+        for name in COUNTERS:
+            self.counters[name] += other.counters[name]
+        for phase in PHASES:
+            self.timings[phase] += other.timings[phase]
+        self.add_hash_types(other.hash_types)
+        return
+
+    def add_hash_types(self, hash_types):
+        """Add the supplied {'type/method': (files, seconds)}"""
+        for key, (files, seconds) in hash_types.items():
+            totals = self.hash_types.setdefault(key, [0, 0.0])
+            totals[0] += files
+            totals[1] += seconds
+        return
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    def report(self):
+        """Answer the receiver as a dictionary"""
+        elapsed = self.elapsed
+        report = dict(self.counters)
+        report['timings'] = dict(self.timings)
+        report['hash_types'] = dict(
+            (key, {'files': files, 'seconds': seconds})
+            for key, (files, seconds) in self.hash_types.items())
+        report['elapsed'] = elapsed
+        if elapsed > 0:
+            report['files_per_second'] = self.counters['files'] / elapsed
+            report['bytes_hashed_per_second'] = \
+                self.counters['bytes_hashed'] / elapsed
+        else:
+            report['files_per_second'] = 0.0
+            report['bytes_hashed_per_second'] = 0.0
+        return report
+
+
+class ScanMetrics(object):
+    """The Metrics of each root of a scan.
+
+    Counters and timings are added to the current root, set by
+    start_root().  Those added before the first root aren't reported."""
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.roots = {}
+        self.current = Metrics()
+        self.started = datetime.now()
+
+    def start_root(self, abspath):
+        self.current = Metrics()
+        self.roots[abspath] = self.current
+        return
+
+    def finish_root(self):
+        self.current.finished = time.time()
+        return
+
+    def count(self, name, amount=1):
+        self.current.counters[name] += amount
+        return
+
+    def add_time(self, phase, seconds):
+        self.current.timings[phase] += seconds
+        return
+
+    def add_hash_types(self, hash_types):
+        self.current.add_hash_types(hash_types)
+        return
+
+    @contextmanager
+    def timer(self, phase):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.current.timings[phase] += time.time() - start
+
+    def totals(self):
+        """Answer the Metrics summed over all roots"""
+        totals = Metrics()
+        if len(self.roots) > 0:
+            totals.started = min(m.started for m in self.roots.values())
+            totals.finished = max(m.finished or time.time()
+                                  for m in self.roots.values())
+        for metrics in self.roots.values():
+            totals.add(metrics)
+        return totals
+
+    def report(self):
+        """Answer the run's report as a dictionary"""
+        return {
+            'scan': self.kind,
+            'started': self.started.isoformat(),
+            'finished': datetime.now().isoformat(),
+            'totals': self.totals().report(),
+            'roots': dict((abspath, metrics.report())
+                          for abspath, metrics in self.roots.items()),
+            }
+
+    def write_reports(self, report_dir=None):
+        """Write the JSON report and Prometheus textfile to report_dir
+        (default settings.SCAN_REPORT_DIR).  Answer the JSON file name,
+        or None if reports are disabled."""
+        if report_dir is None:
+            report_dir = settings.SCAN_REPORT_DIR
+        if report_dir is None:
+            return None
+        if not isdir(report_dir):
+            os.makedirs(report_dir)
+        report = self.report()
+        fname = join(report_dir, "scan-{0}.json".format(
+            self.started.strftime("%Y%m%d-%H%M%S")))
+        write_atomic(fname, json.dumps(report, indent=2, sort_keys=True))
+        write_atomic(join(report_dir, PROMETHEUS_FILE),
+                     prometheus_text(report))
+        logger.info(u"Scan report: {0}".format(fname))
+        return fname
+
+
+def write_atomic(fname, text):
+    """Write text to fname, so that readers never see a partial file"""
+    if not isinstance(text, bytes):
+        text = text.encode('utf-8')
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'wb') as fp:
+        fp.write(text)
+    os.rename(tmp_fname, fname)
+    return
+
+
+def prometheus_text(report):
+    """Answer the Prometheus text exposition of the supplied report"""
+    lines = []
+
+    def metric(name, help, mtype, values):
+        lines.append("# HELP storagemgr_scan_{0} {1}".format(name, help))
+        lines.append("# TYPE storagemgr_scan_{0} {1}".format(name, mtype))
+        for labels, value in values:
+            label_str = ",".join(u'{0}="{1}"'.format(k, escape_label(v))
+                                 for k, v in labels)
+            lines.append(u"storagemgr_scan_{0}{{{1}}} {2}".format(
+                name, label_str, value))
+
+    kind = report['scan']
+    roots = sorted(report['roots'].items())
+    for name in COUNTERS:
+        metric(name, "Scan counter: {0}".format(name), 'gauge',
+               [((('scan', kind), ('root', abspath)), root[name])
+                for abspath, root in roots])
+    metric('phase_seconds', "Seconds spent in each phase of the scan",
+           'gauge',
+           [((('scan', kind), ('root', abspath), ('phase', phase)),
+             root['timings'][phase])
+            for abspath, root in roots for phase in PHASES])
+    metric('hash_type_seconds',
+           "Seconds spent hashing each type of file", 'gauge',
+           [((('scan', kind), ('root', abspath), ('type', hash_type)),
+             values['seconds'])
+            for abspath, root in roots
+            for hash_type, values in sorted(root['hash_types'].items())])
+    metric('hash_type_files', "Files hashed of each type", 'gauge',
+           [((('scan', kind), ('root', abspath), ('type', hash_type)),
+             values['files'])
+            for abspath, root in roots
+            for hash_type, values in sorted(root['hash_types'].items())])
+    metric('elapsed_seconds', "Duration of the scan", 'gauge',
+           [((('scan', kind), ('root', abspath)), root['elapsed'])
+            for abspath, root in roots])
+    metric('last_finished_timestamp_seconds',
+           "Time the last scan finished", 'gauge',
+           [((('scan', kind),), time.time())])
+    return u"\n".join(lines) + u"\n"
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def previous_report(kind, report_dir=None):
+    """Answer the most recent report of the kind of scan, or None"""
+    if report_dir is None:
+        report_dir = settings.SCAN_REPORT_DIR
+    if report_dir is None:
+        return None
+    # The file names sort chronologically
+    for fname in sorted(glob(join(report_dir, 'scan-*.json')), reverse=True):
+        try:
+            with open(fname) as fp:
+                report = json.load(fp)
+        except (IOError, ValueError):
+            logger.warn(u"Unable to read report: {0}".format(basename(fname)))
+            continue
+        if report.get('scan') == kind:
+            return report
+    return None
+
+
+class ProgressLine(object):
+    """Show the progress of the scan on a single, updated, line.
+
+    The ETA is estimated from the number of files seen by the previous
+    report of the same kind of scan."""
+
+    def __init__(self, metrics, previous=None, stream=None):
+        self.metrics = metrics
+        if previous is None:
+            self.expected_files = None
+        else:
+            self.expected_files = previous['totals']['files']
+        self.stream = stream or sys.stderr
+        self.last_update = 0
+
+    def update(self, force=False):
+        now = time.time()
+        if not force and now - self.last_update < PROGRESS_INTERVAL:
+            return
+        self.last_update = now
+        totals = self.metrics.totals()
+        report = totals.report()
+        line = "{0} dirs, {1} files, {2:.1f} files/s, {3:.1f} MB/s".format(
+            totals.counters['dirs'], totals.counters['files'],
+            report['files_per_second'],
+            report['bytes_hashed_per_second'] / (1024 * 1024))
+        eta = self.eta(totals.counters['files'], report['files_per_second'])
+        if eta is not None:
+            line += ", ETA {0}".format(eta)
+        self.stream.write("\r" + line.ljust(79))
+        self.stream.flush()
+        return
+
+    def eta(self, files, files_per_second):
+        """Answer the estimated time remaining as a string, or None"""
+        if not self.expected_files or files_per_second <= 0:
+            return None
+        remaining = max(0, self.expected_files - files) / files_per_second
+        minutes, seconds = divmod(int(remaining), 60)
+        hours, minutes = divmod(minutes, 60)
+        return "{0}:{1:02d}:{2:02d}".format(hours, minutes, seconds)
+
+    def finish(self):
+        self.update(force=True)
+        self.stream.write("\n")
+        return
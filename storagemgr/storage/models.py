@@ -1,15 +1,26 @@
 import os
+import stat
+import time
 import gi
 gi.require_version('GExiv2', '0.10')
 from gi.repository import GExiv2
 import gi.repository.GLib
+from collections import namedtuple
 from datetime import datetime
 from os.path import exists, islink, join, splitext
 
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction, IntegrityError
 from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 
-from storage.smhash import smhash
+from storage.batch import on_rollback
+from storage.lrucache import LRUCache
+from storage.pathtrie import PathTrie
+from storage.hashcache import cached_smhash, cached_fingerprint, cached_dhash
+from storage.hashcache import stat_mtime_ns, digest_algorithm
+from storage.smhash import DEFAULT_ALGORITHM, pop_hash_times
 
 from logger import init_logging
 logger = init_logging(__name__)
@@ -17,28 +28,271 @@ logger = init_logging(__name__)
 IMAGE_TYPES = ['.jpg', '.jpeg', '.tif', '.tiff', '.raw', '.png', '.crw',
                 '.cr2']
 VIDEO_TYPES = ['.mov', '.mpg', '.mp4', '.m4v', '.mpeg', '.3gp']
+# The maximum number of parameters in a single query (SQLite allows 999)
+QUERY_CHUNK_SIZE = 500
+# The maximum length of a Keyword name (MySQL's limit for unique fields)
+KEYWORD_NAME_LENGTH = 255
+# The digest of empty files, whatever the algorithm
+EMPTY_DIGEST = "0"
+# The image date fields, in increasing order of precedence
+DATE_FIELDS = ['Exif.Photo.DateTimeDigitized',
+               'Exif.Photo.DateTimeOriginal',
+               'Exif.Image.DateTime']
+
+# The details of a file that are read from the file system.
+# Answered by file_details(), which doesn't access the database
+# so may be called from worker processes.
+# hash_time and metadata_time are the seconds taken to read each.
+FileDetails = namedtuple('FileDetails',
+    ['symbolic_link', 'mtime', 'size', 'dev', 'ino', 'mtime_ns',
+     'digest', 'algorithm', 'fingerprint', 'dhash', 'metadata',
+     'hash_time', 'hash_types', 'metadata_time'])
+
+# digest: (Hash id, algorithm) of the recently used Hashes, see
+# Hash.gethash()
+_hash_ids = LRUCache(settings.HASH_ID_CACHE_SIZE)
+# The PathTrie of the RootPaths, see RootPath.getrootpath()
+_root_trie = None
+# The RootPath count and latest mod_date the trie was read with, and when
+# they were last checked
+_root_trie_key = None
+_root_trie_checked = 0
+# keyword name: Keyword id of the recently used Keywords, see
+# Keyword.getids()
+_keyword_ids = LRUCache(settings.KEYWORD_ID_CACHE_SIZE)
+# root path id: RelPathMap of the roots whose directories are cached, see
+# RelPath.warm_cache()
+_rel_path_maps = {}
+
+
+def keyword_name(name):
+    """Answer name as stored by Keyword, i.e. truncated to
+    KEYWORD_NAME_LENGTH characters"""
+    return name[:KEYWORD_NAME_LENGTH]
+
+
+def os_stats(abspath):
+    """Answer os.stats() for the supplied path.
+    For a symbolic link we want the stats of the link, not the target."""
+    if islink(abspath):
+        stats = os.lstat(abspath)
+    else:
+        stats = os.stat(abspath)
+    return stats
+
+
+def file_details(abspath, metadata=False, stats=None, budget=None,
+                 cache=True):
+    """Answer the FileDetails for the supplied path.
+    If metadata is True, also read the image metadata (image types only).
+    stats is the os_stats() of the path, if already known.
+    budget is the IOBudget that hashing is charged to, if any.
+    If cache is False the digests aren't read from the hash cache
+    (but are stored in it)."""
+    if stats is None:
+        stats = os_stats(abspath)
+    symbolic_link = stat.S_ISLNK(stats.st_mode)
+    # Discard the times of any earlier hashing by this thread
+    pop_hash_times()
+    start = time.time()
+    algorithm = digest_algorithm()
+    is_image = splitext(abspath)[1].lower() in IMAGE_TYPES
+    # The dhashes of images decoded while hashing
+    dhashes = {} if is_image and settings.DHASH_IMAGES else None
+    if stats.st_size == 0:
+        digest = EMPTY_DIGEST
+    else:
+        digest = cached_smhash(abspath, stats, budget, refresh=not cache,
+                               algorithm=algorithm, dhashes=dhashes)
+    # The blocks will usually still be cached after hashing
+    file_fingerprint = cached_fingerprint(abspath, stats, budget,
+                                          refresh=not cache)
+    if dhashes is not None and stats.st_size > 0:
+        file_dhash = cached_dhash(abspath, stats, budget, refresh=not cache,
+                                  dhashes=dhashes)
+    else:
+        file_dhash = None
+    hash_time = time.time() - start
+    # The time smhash() took by type of file, unless the digest was cached
+    hash_types = pop_hash_times()
+    details = FileDetails(symbolic_link, stats.st_mtime, stats.st_size,
+                          stats.st_dev, stats.st_ino, stat_mtime_ns(stats),
+                          digest, algorithm, file_fingerprint, file_dhash,
+                          None, hash_time, hash_types, 0.0)
+    if metadata:
+        details = details_metadata(abspath, details)
+    return details
+
+
+def details_metadata(abspath, details):
+    """Answer the supplied FileDetails with the image metadata of abspath
+    (image types only).  GExiv2 isn't thread safe, so threaded hashing
+    reads the metadata separately."""
+    if splitext(abspath)[1].lower() not in IMAGE_TYPES:
+        return details
+    start = time.time()
+    img_metadata = image_metadata(abspath)
+    return details._replace(metadata=img_metadata,
+                            metadata_time=time.time() - start)
+
+
+def exiv2_metadata(abspath):
+    "Answer the exiv2 object for the supplied file, or None"
+    try:
+        img_exiv2 = GExiv2.Metadata(abspath)
+    # Catching every exception is really bad, but I can't catch
+    # GLib.Error :-(
+    except Exception as e:
+    #except IOError, GLib.Error:
+        msg = "GExiv2 exception on {0}, ignoring, e={1}".format(
+                abspath, e)
+        logger.warn(msg)
+        img_exiv2 = None
+    return img_exiv2
+
+
+def exiv2_keywords(img_exiv2):
+    """Answer the set of keywords in the supplied exiv2 object"""
+    keywords = []
+    iptc_keywords = img_exiv2.get_tag_multiple('Iptc.Application2.Keywords')
+    keywords.extend(iptc_keywords)
+    xmp = img_exiv2.get_tag_multiple('Xmp.MicrosoftPhoto.LastKeywordXMP')
+    keywords.extend(xmp)
+    return set(keywords)
+
+
+def image_metadata(abspath):
+    """Answer a dictionary of the metadata stored for the supplied image:
+
+    keywords: the set of keywords
+    dates:    a list of (field name, date string) in DATE_FIELDS order
+
+    The dictionary only contains simple types so it can be passed between
+    processes.  Answer None if the metadata can't be read."""
+    img_exiv2 = exiv2_metadata(abspath)
+    if img_exiv2 is None:
+        return None
+    dates = []
+    for field in DATE_FIELDS:
+        dt = img_exiv2.get(field, None)
+        if dt is not None:
+            dates.append((field, dt))
+    return {'keywords': exiv2_keywords(img_exiv2),
+            'dates': dates}
 
-# Create your models here.
 
 class Hash(models.Model):
-    """The Hash table is a sparse list of digests of the managed files"""
+    """The Hash table is a sparse list of digests of the managed files
+
+    :param algorithm: The hashlib algorithm of the digest, see
+                      settings.SMHASH_ALGORITHM.  Digests of different
+                      algorithms never match, except EMPTY_DIGEST.
+    """
 
     digest = models.CharField(max_length=128, unique=True)
+    algorithm = models.CharField(max_length=32, default=DEFAULT_ALGORITHM,
+                                 db_index=True)
     creation_date = models.DateTimeField(auto_now_add=True)
     mod_date = models.DateTimeField(auto_now=True)
 
     @classmethod
-    def gethash(cls, digest):
+    def gethash(cls, digest, algorithm=None):
         """Answer a Hash instance for the supplied digest,
-        creating if necessary"""
+        creating if necessary.  algorithm defaults to
+        settings.SMHASH_ALGORITHM.
+
+        Recently used digests are answered from an in-process cache
+        without a query; the Hash answered then only has its id, digest
+        and algorithm, so is for reference, e.g. as a File's hash."""
+        cached = _hash_ids.get(digest)
+        if cached is not None:
+            return cls(pk=cached[0], digest=digest, algorithm=cached[1])
         qs = cls.objects.filter(digest=digest)
         assert len(qs) <= 1, "Found duplicate Hashes"
         if len(qs) == 1:
-            return qs[0]
+            hash = qs[0]
         else:
-            hash = Hash(digest=digest)
-            hash.save()
-            return hash
+            if algorithm is None:
+                algorithm = digest_algorithm()
+            try:
+                with transaction.atomic():
+                    hash = Hash(digest=digest, algorithm=algorithm)
+                    hash.save()
+            except IntegrityError:
+                # Created by a concurrent scan
+                hash = cls.objects.get(digest=digest)
+        _hash_ids.put(digest, (hash.pk, hash.algorithm))
+        return hash
+
+    @classmethod
+    def gethashes(cls, digests, algorithm=None):
+        """Answer a dictionary of digest: Hash for the supplied
+        (digest, algorithm) pairs (or digests of algorithm), creating the
+        Hashes if necessary.  See gethash().
+
+        The digests that aren't cached are read in one query (per
+        QUERY_CHUNK_SIZE).  Missing Hashes are inserted in bulk and read
+        back; if a concurrent scan inserts one of them first, the unique
+        digest fails the insert and they are created individually."""
+        if algorithm is None:
+            algorithm = digest_algorithm()
+        algorithms = {}
+        for digest in digests:
+            if isinstance(digest, tuple):
+                digest, digest_alg = digest
+            else:
+                digest_alg = algorithm
+            algorithms[digest] = digest_alg
+        hashes = {}
+        for digest in algorithms:
+            cached = _hash_ids.get(digest)
+            if cached is not None:
+                hashes[digest] = cls(pk=cached[0], digest=digest,
+                                     algorithm=cached[1])
+        missing = [digest for digest in algorithms if digest not in hashes]
+        hashes.update(cls.read_hashes(missing))
+        missing = [digest for digest in missing if digest not in hashes]
+        if len(missing) == 0:
+            return hashes
+        try:
+            with transaction.atomic():
+                cls.objects.bulk_create([
+                    Hash(digest=digest, algorithm=algorithms[digest])
+                    for digest in missing])
+        except IntegrityError:
+            # Created by a concurrent scan
+            logger.debug("Bulk Hash insert failed, creating individually")
+            for digest in missing:
+                hashes[digest] = cls.gethash(digest, algorithms[digest])
+            return hashes
+        # bulk_create() doesn't set the primary keys
+        hashes.update(cls.read_hashes(missing))
+        return hashes
+
+    @classmethod
+    def read_hashes(cls, digests):
+        """Answer a dictionary of digest: Hash of the existing Hashes of
+        digests, and cache them"""
+        hashes = {}
+        for i in range(0, len(digests), QUERY_CHUNK_SIZE):
+            for hash in cls.objects.filter(
+                    digest__in=digests[i:i+QUERY_CHUNK_SIZE]):
+                hashes[hash.digest] = hash
+                _hash_ids.put(hash.digest, (hash.pk, hash.algorithm))
+        return hashes
+
+    @staticmethod
+    def clear_cache():
+        """Clear the digest cache, e.g. after a rollback"""
+        _hash_ids.clear()
+        return
+
+    @classmethod
+    def algorithms(cls):
+        """Answer the list of algorithms of the existing digests"""
+        return list(cls.objects.exclude(digest=EMPTY_DIGEST)
+                    .values_list('algorithm', flat=True)
+                    .order_by('algorithm').distinct())
 
     def files(self):
         """Answer the set of files associated with the receiver
@@ -59,30 +313,84 @@ class Hash(models.Model):
 
 
 
+on_rollback(Hash.clear_cache)
+
+
+@receiver(post_save, sender=Hash)
+def hash_saved(sender, instance, **kwargs):
+    _hash_ids.put(instance.digest, (instance.pk, instance.algorithm))
+
+
+@receiver(post_delete, sender=Hash)
+def hash_deleted(sender, instance, **kwargs):
+    _hash_ids.discard(instance.digest)
+
+
 class RootPath(models.Model):
     """Store the path of monitored folders
     
-    The root path must always be stored as an absolute path."""
+    The root path must always be stored as an absolute path.
+
+    :param io_bandwidth: The read bandwidth budget in MB/s,
+                         None = settings.IO_BANDWIDTH
+    :param io_iops:      The read operations per second budget,
+                         None = settings.IO_IOPS
+    """
 
     # path should be unique, but MySQL doesn't allow unique with max_length>255
     path = models.CharField(max_length=255, unique=True)
+    io_bandwidth = models.FloatField(null=True, blank=True)
+    io_iops = models.IntegerField(null=True, blank=True)
     creation_date = models.DateTimeField(auto_now_add=True)
     mod_date = models.DateTimeField(auto_now=True)
 
     @classmethod
-    def getrootpath(cls, path, create=True):
-        """Answer an instance of the receiver for the supplied path.
-        Create if necessary and allowed."""
-        # For now use a simple brute force search
-        # The number of root paths is expected to be small,
-        # so this won't be a huge issue
-        root_path = None
-        roots = cls.objects.all()
-        for root in roots:
-            if path.startswith(root.path):
-                root_path = root
-                break
-        return root_path
+    def getrootpath(cls, path):
+        """Answer the instance of the receiver containing the supplied path,
+        i.e. the longest root path that is path or one of its parents, or
+        None.
+
+        The roots are read once per process in to a PathTrie, which is
+        rebuilt when a RootPath is saved or deleted by this process, or
+        when another process is found to have changed them (checked every
+        settings.ROOT_PATH_CACHE_TTL seconds, see trie_stale())."""
+        global _root_trie, _root_trie_key, _root_trie_checked
+        if _root_trie is not None and \
+                time.time() - _root_trie_checked >= \
+                settings.ROOT_PATH_CACHE_TTL:
+            if cls.trie_stale():
+                _root_trie = None
+            else:
+                _root_trie_checked = time.time()
+        if _root_trie is None:
+            _root_trie_key = cls.trie_key()
+            _root_trie_checked = time.time()
+            trie = PathTrie()
+            for root in cls.objects.all():
+                trie.add(root.path, root)
+            _root_trie = trie
+        return _root_trie.longest(path)
+
+    @classmethod
+    def trie_key(cls):
+        """Answer the count and latest mod_date of the receiver's rows,
+        which change when a RootPath is added, modified or deleted"""
+        stats = cls.objects.aggregate(count=models.Count('pk'),
+                                      latest=models.Max('mod_date'))
+        return (stats['count'], stats['latest'])
+
+    @classmethod
+    def trie_stale(cls):
+        """Answer a boolean indicating whether the root paths have changed
+        since the trie was read"""
+        return cls.trie_key() != _root_trie_key
+
+    @staticmethod
+    def clear_cache():
+        """Discard the trie of root paths, e.g. after a rollback"""
+        global _root_trie
+        _root_trie = None
+        return
 
     @property
     def abspath(self):
@@ -92,10 +400,29 @@ class RootPath(models.Model):
         return self.abspath
 
 
+on_rollback(RootPath.clear_cache)
+
+
+@receiver(post_save, sender=RootPath)
+@receiver(post_delete, sender=RootPath)
+def root_path_changed(sender, **kwargs):
+    RootPath.clear_cache()
+
+
 class RelPath(models.Model):
-    """Store the relative path from root to file"""
+    """Store the relative path from root to file
+
+    :param mtime:       The directory mtime when last scanned
+    :param entry_count: The number of directory entries when last scanned
+    :param dev:         The directory's st_dev, used to detect moves
+    :param ino:         The directory's st_ino, used to detect moves
+    """
     path = models.CharField(max_length=255, blank=True)
     root = models.ForeignKey(RootPath)
+    mtime = models.FloatField(null=True)
+    entry_count = models.IntegerField(null=True)
+    dev = models.BigIntegerField(null=True)
+    ino = models.BigIntegerField(null=True)
     creation_date = models.DateTimeField(auto_now_add=True)
     mod_date = models.DateTimeField(auto_now=True)
 
@@ -114,19 +441,107 @@ class RelPath(models.Model):
             rel_path_str = path[len(root_path.path)+1:]
         else:
             rel_path_str = ''
-        rel_paths = RelPath.objects.filter(root=root_path,
-                                           path=rel_path_str)
+        rel_path_map = _rel_path_maps.get(root_path.pk)
+        if rel_path_map is None or not rel_path_map.covers(rel_path_str):
+            rel_paths = RelPath.objects.filter(root=root_path,
+                                               path=rel_path_str)
+        else:
+            # The cache has all the sub-tree's directories, see warm_cache()
+            rel_paths = rel_path_map.get(rel_path_str, root_path)
         assert len(rel_paths) <= 1, "Found more than one RelPath with same name"
         if len(rel_paths) == 0:
-            if create:
-                rel_path = RelPath(root=root_path, path=rel_path_str)
-                rel_path.save()
-            else:
+            if not create:
                 raise ValueError("RelPath not found: {0}".format(path))
+            try:
+                with transaction.atomic():
+                    rel_path = RelPath(root=root_path, path=rel_path_str)
+                    rel_path.save()
+            except IntegrityError:
+                # Created by a concurrent scan
+                rel_path = RelPath.objects.get(root=root_path,
+                                               path=rel_path_str)
+                rel_path.root = root_path
+                if rel_path_map is not None:
+                    rel_path_map.put_instance(rel_path)
         else:
             rel_path = rel_paths[0]
+            # Avoid another query for the root
+            rel_path.root = root_path
         return rel_path
 
+    @classmethod
+    def warm_cache(cls, root_path, prefix=''):
+        """Read all the directories of root_path in to memory, so that
+        getrelpath() answers them, and knows which are new, without a
+        query.  If prefix (a relative path) is supplied, only the
+        directories of that sub-tree are read, others are queried as
+        usual.  The cache is kept up to date with the RelPaths saved and
+        deleted by this process, until clear_cache()."""
+        _rel_path_maps[root_path.pk] = RelPathMap(root_path, prefix)
+        return
+
+    @staticmethod
+    def clear_cache(root_path=None):
+        """Discard the cached directories of root_path (default all), e.g.
+        after a rollback"""
+        if root_path is None:
+            _rel_path_maps.clear()
+        else:
+            _rel_path_maps.pop(root_path.pk, None)
+        return
+
+    def update_dir_stats(self, mtime, entry_count):
+        """Record the directory mtime and entry count, saving if changed"""
+        if self.mtime != mtime or self.entry_count != entry_count:
+            self.mtime = mtime
+            self.entry_count = entry_count
+            self.save()
+        return
+
+    def update_inode(self, stats):
+        """Record the directory's device and inode, saving if changed"""
+        if self.dev != stats.st_dev or self.ino != stats.st_ino:
+            self.dev = stats.st_dev
+            self.ino = stats.st_ino
+            self.save()
+        return
+
+    def inode_moved(self):
+        """Answer a boolean indicating whether the receiver's inode is no
+        longer at its path, i.e. the directory has been moved (or removed)"""
+        try:
+            stats = os.lstat(self.abspath)
+        except OSError:
+            return True
+        return stats.st_dev != self.dev or stats.st_ino != self.ino
+
+    def move(self, rel_path_str):
+        """Move the receiver, and its sub-directories, to rel_path_str.
+        Sub-directories whose new path is already known are left
+        in place, their files will be re-added by the scan."""
+        old_prefix = join(self.path, '')
+        new_prefix = join(rel_path_str, '')
+        logger.info(u"Moved: {0} -> {1}".format(self.path, rel_path_str))
+        subdirs = list(RelPath.objects.filter(root=self.root,
+                                              path__startswith=old_prefix))
+        new_paths = [new_prefix + subdir.path[len(old_prefix):]
+                     for subdir in subdirs]
+        existing = set()
+        for i in range(0, len(new_paths), QUERY_CHUNK_SIZE):
+            existing.update(RelPath.objects.filter(root=self.root,
+                    path__in=new_paths[i:i+QUERY_CHUNK_SIZE]).values_list(
+                    'path', flat=True))
+        for subdir, new_path in zip(subdirs, new_paths):
+            if new_path in existing:
+                logger.warn(u"Not moving {0}, {1} already exists".format(
+                    subdir.path, new_path))
+                continue
+            subdir.path = new_path
+            subdir.save()
+        self.path = rel_path_str
+        self.save()
+        return
+
     @property
     def abspath(self):
         return join(self.root.abspath, self.path)
@@ -135,9 +550,83 @@ class RelPath(models.Model):
         return self.abspath
 
 
+class RelPathMap(object):
+    """The directories of a root path, or of its sub-tree prefix, see
+    RelPath.warm_cache()"""
+
+    FIELDS = ['id', 'path', 'mtime', 'entry_count', 'dev', 'ino',
+              'creation_date', 'mod_date']
+
+    def __init__(self, root_path, prefix=''):
+        self.prefix = prefix
+        # rel path: (field values)
+        self.paths = {}
+        # id: rel path
+        self.ids = {}
+        rel_paths = RelPath.objects.filter(root=root_path)
+        if prefix != '':
+            rel_paths = rel_paths.filter(Q(path=prefix) |
+                                         Q(path__startswith=prefix + '/'))
+        for row in rel_paths.values_list(*self.FIELDS):
+            self.put(row)
+
+    def covers(self, rel_path_str):
+        """Answer a boolean indicating whether rel_path_str is in the
+        receiver's sub-tree, i.e. whether get() answers it if it exists"""
+        return self.prefix == '' or rel_path_str == self.prefix or \
+            rel_path_str.startswith(self.prefix + '/')
+
+    def put(self, row):
+        """Add or update the supplied row (values of FIELDS)"""
+        old_path = self.ids.get(row[0])
+        if old_path is not None and old_path != row[1]:
+            # Moved
+            del self.paths[old_path]
+        self.paths[row[1]] = row
+        self.ids[row[0]] = row[1]
+        return
+
+    def put_instance(self, rel_path):
+        self.put(tuple(getattr(rel_path, field) for field in self.FIELDS))
+        return
+
+    def discard(self, pk):
+        path = self.ids.pop(pk, None)
+        if path is not None:
+            self.paths.pop(path, None)
+        return
+
+    def get(self, rel_path_str, root_path):
+        """Answer the list of RelPaths of rel_path_str (empty or one)"""
+        row = self.paths.get(rel_path_str)
+        if row is None:
+            return []
+        return [RelPath(root=root_path, **dict(zip(self.FIELDS, row)))]
+
+
+on_rollback(RelPath.clear_cache)
+
+
+@receiver(post_save, sender=RelPath)
+def rel_path_saved(sender, instance, **kwargs):
+    rel_path_map = _rel_path_maps.get(instance.root_id)
+    if rel_path_map is not None:
+        rel_path_map.put_instance(instance)
+
+
+@receiver(post_delete, sender=RelPath)
+def rel_path_deleted(sender, instance, **kwargs):
+    rel_path_map = _rel_path_maps.get(instance.root_id)
+    if rel_path_map is not None:
+        rel_path_map.discard(instance.pk)
+
+
 class ExcludeDir(models.Model):
     """Each record is a regular expression that will be applied to the selected
-    RootDir, or all directories."""
+    RootDir, or all directories.
+
+    The expressions are searched for in the directory's absolute path.
+    See storage.exclude."""
     
     regex = models.CharField(max_length=255)
     root_path = models.ForeignKey(RootPath, null=True)
@@ -154,6 +643,87 @@ class ExcludeDir(models.Model):
 
 
 
+class ScanRun(models.Model):
+    """Record the progress of a scan of a root path, so that an interrupted
+    scan can be resumed.
+
+    :param full:     True for a FullScan
+    :param shard:    The part of the root scanned, '' = all of it,
+                     see storage.scan.shard_top()
+    :param finished: The date the scan completed, None if it was interrupted
+                     (or is still running)
+
+    The completed directories are recorded in ScanRunDir, and are
+    deleted once the scan has finished."""
+
+    root = models.ForeignKey(RootPath)
+    full = models.BooleanField(default=False)
+    shard = models.CharField(max_length=255, blank=True, default='')
+    finished = models.DateTimeField(null=True, blank=True)
+    creation_date = models.DateTimeField(auto_now_add=True)
+    mod_date = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def start(cls, root_path, full, resume=False, shard=''):
+        """Answer the ScanRun for scanning the shard of root_path.
+        If resume is True, answer the most recent interrupted run,
+        if there is one, otherwise a new run."""
+        run = None
+        if resume:
+            runs = cls.objects.filter(root=root_path, full=full, shard=shard,
+                                      finished=None).order_by('-pk')
+            if len(runs) > 0:
+                run = runs[0]
+                logger.info(u"Resuming scan {0} of {1}".format(
+                    run.pk, root_path.abspath))
+        if run is None:
+            run = cls(root=root_path, full=full, shard=shard)
+            run.save()
+        return run
+
+    def completed_dirs(self):
+        """Answer the set of RelPath ids already completed by the receiver"""
+        return set(ScanRunDir.objects.filter(run=self).values_list(
+            'path_id', flat=True))
+
+    def dirs_completed(self, rel_paths):
+        """Record the supplied RelPaths as completed.
+        None entries (directories that weren't scanned) are ignored."""
+        ScanRunDir.objects.bulk_create([ScanRunDir(run=self, path=rel_path)
+                                        for rel_path in rel_paths
+                                        if rel_path is not None])
+        return
+
+    def finish(self):
+        """Mark the receiver finished and discard its progress, and that of
+        any earlier interrupted runs of the same shard and kind (quick or
+        full)"""
+        self.finished = datetime.now()
+        self.save()
+        ScanRunDir.objects.filter(run__root=self.root, run__shard=self.shard,
+                                  run__full=self.full,
+                                  run__pk__lte=self.pk).delete()
+        ScanRun.objects.filter(root=self.root, shard=self.shard,
+                               full=self.full, finished=None,
+                               pk__lt=self.pk).delete()
+        return
+
+    def __unicode__(self):
+        return u"{0} ({1})".format(self.root.abspath, self.pk)
+
+
+
+class ScanRunDir(models.Model):
+    """A directory completed by a ScanRun"""
+
+    run = models.ForeignKey(ScanRun)
+    path = models.ForeignKey(RelPath)
+
+    class Meta:
+        unique_together = ('run', 'path')
+
+
+
 class MetadataField(models.Model):
     """All the supported metadata fields."""
     name = models.CharField(max_length=4096)
@@ -171,6 +741,13 @@ class File(models.Model):
 
     :param size:          derived from os.stat
     :param mtime:         derived from os.stat
+    :param dev:           derived from os.stat, used to detect moves
+    :param ino:           derived from os.stat, used to detect moves
+    :param mtime_ns:      derived from os.stat, the mtime in nanoseconds
+    :param fingerprint:   smhash.fingerprint() of the contents, used to
+                          check for changes and prefilter duplicates
+    :param dhash:         smhash.dhash() of images, used to find near
+                          duplicates
     :param date:          E.g. image creation date
     :param date_field:    The source of date
     :param symbolic_link: True if this is a symbolic link
@@ -192,6 +769,11 @@ class File(models.Model):
     original_hash = models.ForeignKey(Hash, related_name="original_hash")
     size = models.BigIntegerField()
     mtime = models.FloatField()
+    dev = models.BigIntegerField(null=True)
+    ino = models.BigIntegerField(null=True)
+    mtime_ns = models.BigIntegerField(null=True)
+    fingerprint = models.CharField(max_length=64, null=True, db_index=True)
+    dhash = models.BigIntegerField(null=True)
     date = models.DateTimeField(null=True)
     date_field = models.ForeignKey(MetadataField, null=True)
     symbolic_link = models.BooleanField(default=False)
@@ -209,6 +791,10 @@ class File(models.Model):
     def abspath(self):
         return join(self.path.abspath, self.name)
 
+    @property
+    def is_image(self):
+        return splitext(self.name)[1].lower() in IMAGE_TYPES
+
     @property
     def keywords(self):
         return self.keyword_set.all()
@@ -221,49 +807,64 @@ class File(models.Model):
     def os_stats(self):
         """Answer os.stats() for the receiver.
         For a symbolic link we want the stats of the link, not the target."""
-        if islink(self.abspath):
-            stats = os.lstat(self.abspath)
-        else:
-            stats = os.stat(self.abspath)
-        return stats
+        return os_stats(self.abspath)
 
-    def os_stats_changed(self):
+    def os_stats_changed(self, stats=None):
         """Answer a boolean indicating whether the os.stats() related metadata
-        has changed, i.e. mtime & size."""
-        stats = self.os_stats()
-        res = self.mtime != stats.st_mtime or \
-                self.size != stats.st_size
-        return res
-
-    def get_details(self):
-        """Update the details of the receiver (excluding path and name)"""
+        has changed, i.e. mtime, size & inode.
+        stats is the receivers os_stats(), if already known."""
+        if stats is None:
+            stats = self.os_stats()
+        if self.size != stats.st_size:
+            return True
+        if self.mtime_ns is None:
+            # Recorded before nanosecond mtimes
+            return self.mtime != stats.st_mtime
+        if self.ino is not None and self.ino != stats.st_ino:
+            # Replaced, e.g. by renaming a new copy over the file
+            return True
+        return self.mtime_ns != stat_mtime_ns(stats)
+
+    def get_details(self, details=None, hash=None):
+        """Update the details of the receiver (excluding path and name).
+        details is the receivers FileDetails if they have already been read,
+        e.g. by a worker process.
+        hash is the Hash of details.digest, if already known (see
+        Hash.gethashes())."""
         # We don't expect to update the details of deleted files
         assert self.deleted is None, \
             u"Can't update deleted file: {0}".format(self.abspath)
 
-        # The file must be accessible
-        assert exists(self.abspath), \
-            u"File not accessible: {0}".format(self.abspath)
-
-        self.symbolic_link = islink(self.abspath)
-        stats = self.os_stats()
-        self.mtime = stats.st_mtime
-        self.size = stats.st_size
-        if self.size == 0:
-            digest = "0"
-        else:
-            digest = smhash(self.abspath)
-        self.hash = Hash.gethash(digest)
+        if details is None:
+            # The file must be accessible
+            assert exists(self.abspath), \
+                u"File not accessible: {0}".format(self.abspath)
+            details = file_details(self.abspath)
+
+        self.symbolic_link = details.symbolic_link
+        self.mtime = details.mtime
+        self.size = details.size
+        self.dev = details.dev
+        self.ino = details.ino
+        self.mtime_ns = details.mtime_ns
+        self.fingerprint = details.fingerprint
+        self.dhash = details.dhash
+        if hash is None:
+            hash = Hash.gethash(details.digest, details.algorithm)
+        self.hash = hash
         if self.original_hash_id is None:
             self.original_hash = self.hash
         return
 
-    def update_details(self):
-        self.get_details()
+    def update_details(self, details=None, hash=None, keyword_sync=None):
+        self.get_details(details, hash)
         if self.pk is None:
             # We need to save for the many-to-many relationships
             self.save()
-        self.file_update_metadata()
+        if details is None:
+            self.file_update_metadata(keyword_sync=keyword_sync)
+        else:
+            self.file_update_metadata(details.metadata, keyword_sync)
         self.save()
 
     def update_exif(self):
@@ -271,68 +872,43 @@ class File(models.Model):
         self.file_update_metadata()
         self.save()
 
-    def file_update_metadata(self):
+    def file_update_metadata(self, metadata=None, keyword_sync=None):
         """Update the receivers EXIF metadata.
+        metadata is the receivers image_metadata() if already read.
+        If keyword_sync (a KeywordSync) is supplied the keywords are
+        added to it, to be applied with those of other files, otherwise
+        they are applied immediately.
         Note that this doesn't save the changes to the receiver."""
-        if splitext(self.name)[1].lower() in IMAGE_TYPES:
+        if self.is_image:
             assert self.deleted is None, \
                 u"Can't update deleted file: {0}".format(self.abspath)
             # The file must be accessible
             assert exists(self.abspath), \
                 u"File not accessible: {0}".format(self.abspath)
 
-            img_exiv2 = self.file_exiv2()
-            if img_exiv2 is None:
+            if metadata is None:
+                metadata = image_metadata(self.abspath)
+            if metadata is None:
                 logger.warn("Unable to read metadata from: {0}".format(self.abspath))
                 return
 
             #
             # Keywords
             #
-            keywords = self.file_keywords()
-            old_keywords = self.keyword_set.all()
-            # Minimise db lookups by caching in a dictionary
-            oldkwdict = {}
-            for okw in old_keywords:
-                oldkwdict[okw.name] = okw
-            old_keywords = set(oldkwdict.keys())
-            removed = old_keywords - keywords
-            if len(removed) > 0:
-                logger.debug("Removing keywords from {0}: {1}".format(self.name, removed))
-            added = keywords - old_keywords
-            if len(added) > 0:
-                logger.debug("Adding keywords from {0}: {1}".format(self.name, added))
-            for kw in removed:
-                self.keyword_set.filter(name=kw)[0].files.remove(self)
-            for kw in added:
-                Keyword.get_or_add(kw).files.add(self)
+            if keyword_sync is None:
+                sync = KeywordSync()
+                sync.set_keywords(self, metadata['keywords'])
+                sync.apply()
+            else:
+                keyword_sync.set_keywords(self, metadata['keywords'])
 
             #
             # Date / Times
             #
-            dt = img_exiv2.get('Exif.Photo.DateTimeDigitized', None)
-            if dt is not None:
+            for fieldname, dt in metadata['dates']:
                 try:
                     # Side affect of adding to FileDate is to convert to datetime
-                    dt, field = FileDate.add(self, 'Exif.Photo.DateTimeDigitized', dt)
-                    self.date = dt
-                    self.date_field = field
-                except ValueError as ve:
-                    logger.warn("{0} no date: {1}".format(self.abspath, str(ve)))
-            dt = img_exiv2.get('Exif.Photo.DateTimeOriginal', None)
-            if dt is not None:
-                try:
-                    # Side affect of adding to FileDate is to convert to datetime
-                    dt, field = FileDate.add(self, 'Exif.Photo.DateTimeOriginal', dt)
-                    self.date = dt
-                    self.date_field = field
-                except ValueError as ve:
-                    logger.warn("{0} no date: {1}".format(self.abspath, str(ve)))
-            dt = img_exiv2.get('Exif.Image.DateTime', None)
-            if dt is not None:
-                try:
-                    # Side affect of adding to FileDate is to convert to datetime
-                    dt, field = FileDate.add(self, 'Exif.Image.DateTime', dt)
+                    dt, field = FileDate.add(self, fieldname, dt)
                     self.date = dt
                     self.date_field = field
                 except ValueError as ve:
@@ -341,62 +917,100 @@ class File(models.Model):
 
     def file_keywords(self, img_exiv2=None):
         """Answer the set of keywords in the receivers file"""
-        keywords = []
         if img_exiv2 is None:
             img_exiv2 = self.file_exiv2()
-        if img_exiv2 is not None:
-            iptc_keywords = img_exiv2.get_tag_multiple('Iptc.Application2.Keywords')
-            keywords.extend(iptc_keywords)
-            xmp = img_exiv2.get_tag_multiple('Xmp.MicrosoftPhoto.LastKeywordXMP')
-            keywords.extend(xmp)
-        keywords = set(keywords)
-        return keywords
+        if img_exiv2 is None:
+            return set()
+        return exiv2_keywords(img_exiv2)
 
     def file_exiv2(self):
         "Answer the exiv2 object from the receivers file"
-        try:
-            img_exiv2 = GExiv2.Metadata(self.abspath)
-        # Catching every exception is really bad, but I can't catch
-        # GLib.Error :-(
-        except Exception as e:
-        #except IOError, GLib.Error:
-            msg = "GExiv2 exception on {0}, ignoring, e={1}".format(
-                    self.abspath, e)
-            logger.warn(msg)
-            img_exiv2 = None
-        return img_exiv2
+        return exiv2_metadata(self.abspath)
 
     def mark_deleted(self):
         """Mark the receiver as deleted"""
         self.deleted = datetime.now()
         self.save()
 
+    @classmethod
+    def mark_all_deleted(cls, files):
+        """Mark the supplied files as deleted with a single update
+        (per QUERY_CHUNK_SIZE files)"""
+        ids = [file.pk for file in files]
+        now = datetime.now()
+        for i in range(0, len(ids), QUERY_CHUNK_SIZE):
+            cls.objects.filter(pk__in=ids[i:i+QUERY_CHUNK_SIZE]).update(
+                deleted=now, mod_date=now)
+        return
+
+    def update_stats(self, stats):
+        """Record the supplied os_stats() and save, the contents are known
+        to be unchanged"""
+        self.mtime = stats.st_mtime
+        self.mtime_ns = stat_mtime_ns(stats)
+        self.dev = stats.st_dev
+        self.ino = stats.st_ino
+        self.save()
+        return
+
+    def inode_moved(self):
+        """Answer a boolean indicating whether the receiver's inode is no
+        longer at its path.  A hard link leaves the inode in place."""
+        try:
+            stats = os.lstat(self.abspath)
+        except OSError:
+            return True
+        return stats.st_dev != self.dev or stats.st_ino != self.ino
+
+    def move(self, rel_path, name):
+        """Move the receiver to rel_path/name, undeleting if necessary"""
+        logger.debug(u"Moved: {0} -> {1}".format(self.abspath,
+                                                 join(rel_path.abspath, name)))
+        self.path = rel_path
+        self.name = name
+        self.deleted = None
+        self.save()
+        return
+
     def deduplicated(self):
         """Mark the receiver as deduplicated"""
         self.symbolic_link = True
         self.deduped = True
         self.save()
 
-    def matching_files(self):
-        """Answer the list of files with the same hash."""
+    def matching_files(self, algorithms=None):
+        """Answer the list of files with the same hash.
+
+        While existing digests are being migrated to a new algorithm (see
+        migrate_hashes), the file is also hashed with each of the other
+        algorithms in use.  algorithms is Hash.algorithms(), if already
+        known, which reads the whole Hash table."""
         # Get the digest of the candidate file
         logger.debug("Get digest for {0}".format(self))
-        if self.hash is None:
-            try:
-                digest = smhash(self.abspath)
-            except IOError as e:
-                msg = "Unable to hash {0}, e={1}.  Ignoring.".format(
-                    path, e)
-                logger.error(msg)
-                digest = None
-        else:
-            digest = self.hash.digest
-
-        if digest is None:
+        digests = {}
+        if self.hash is not None:
+            digests[self.hash.algorithm] = self.hash.digest
+        if algorithms is None:
+            algorithms = Hash.algorithms()
+        try:
+            for algorithm in algorithms or [digest_algorithm()]:
+                if algorithm not in digests:
+                    digests[algorithm] = cached_smhash(self.abspath,
+                                                       algorithm=algorithm)
+        except EnvironmentError as e:
+            msg = "Unable to hash {0}, e={1}.  Ignoring.".format(
+                self.abspath, e)
+            logger.error(msg)
+            if self.hash is None:
+                digests = {}
+
+        if len(digests) == 0:
             # Failed to hash, which means the file is corrupt, skip it
             return None
-        hashes = Hash.objects.filter(digest=digest)
-        assert hashes.count() <= 1, "Multiple entries exist for {0}".format(digest)
+        query = Q()
+        for algorithm, digest in digests.items():
+            query |= Q(algorithm=algorithm, digest=digest)
+        hashes = Hash.objects.filter(query)
         matching_files = []
         for h in hashes:
             matching_files.extend(list(h.all_files()))
@@ -486,26 +1100,180 @@ class PathPriority(models.Model):
 class Keyword(models.Model):
     """Store the keywords associated with a File
     (typically IPTC Keywords or Xmp.MicrosoftPhoto.LastKeywordXMP
-    in JPG images)"""
+    in JPG images)
+
+    Names are unique, so that concurrent scans can't add the same keyword
+    twice.  MySQL doesn't allow unique with max_length>255, so longer names
+    are truncated, see keyword_name()."""
     
-    name = models.CharField(max_length=4096)
+    name = models.CharField(max_length=KEYWORD_NAME_LENGTH, unique=True)
     files = models.ManyToManyField(File)
     creation_date = models.DateTimeField(auto_now_add=True)
     mod_date = models.DateTimeField(auto_now=True)
 
     @classmethod
     def get_or_add(cls, keyword):
+        keyword = keyword_name(keyword)
         try:
             kw = cls.objects.get(name=keyword)
         except cls.DoesNotExist:
-            kw = cls(name=keyword)
-            kw.save()
+            try:
+                with transaction.atomic():
+                    kw = cls(name=keyword)
+                    kw.save()
+            except IntegrityError:
+                # Created by a concurrent scan
+                kw = cls.objects.get(name=keyword)
         return kw
 
+    @classmethod
+    def getids(cls, names):
+        """Answer a dictionary of name: Keyword id for the supplied names,
+        creating the Keywords if necessary.
+
+        Recently used names are answered from an in-process cache, the
+        rest are read in one query (per QUERY_CHUNK_SIZE) and the missing
+        Keywords inserted in bulk and read back.  If a concurrent scan
+        inserts one of them first, the unique name fails the insert and
+        they are created individually.  names must already be truncated by
+        keyword_name()."""
+        ids = {}
+        missing = []
+        for name in set(names):
+            pk = _keyword_ids.get(name)
+            if pk is None:
+                missing.append(name)
+            else:
+                ids[name] = pk
+        ids.update(cls.read_ids(missing))
+        missing = [name for name in missing if name not in ids]
+        if len(missing) == 0:
+            return ids
+        try:
+            with transaction.atomic():
+                cls.objects.bulk_create([cls(name=name) for name in missing])
+        except IntegrityError:
+            logger.debug("Bulk Keyword insert failed, creating individually")
+            for name in missing:
+                try:
+                    with transaction.atomic():
+                        cls(name=name).save()
+                except IntegrityError:
+                    # Created by a concurrent scan
+                    pass
+        # bulk_create() doesn't set the primary keys
+        ids.update(cls.read_ids(missing))
+        return ids
+
+    @classmethod
+    def read_ids(cls, names):
+        """Answer a dictionary of name: id of the existing Keywords of
+        names, and cache them"""
+        ids = {}
+        for i in range(0, len(names), QUERY_CHUNK_SIZE):
+            # Use the first of any duplicates
+            for pk, name in cls.objects.filter(
+                    name__in=names[i:i+QUERY_CHUNK_SIZE]).order_by(
+                    '-pk').values_list('pk', 'name'):
+                ids[name] = pk
+        for name, pk in ids.items():
+            _keyword_ids.put(name, pk)
+        return ids
+
+    @staticmethod
+    def clear_cache():
+        """Clear the name cache, e.g. after a rollback"""
+        _keyword_ids.clear()
+        return
+
     def __unicode__(self):
         return self.name
 
 
+on_rollback(Keyword.clear_cache)
+
+
+@receiver(post_delete, sender=Keyword)
+def keyword_deleted(sender, instance, **kwargs):
+    _keyword_ids.discard(instance.name)
+
+
+class KeywordSync(object):
+    """Update the keywords of many Files in a few queries.
+
+    set_keywords() and add_keywords() record the keywords of each file.
+    apply() then reads the files' current keywords in one query (per
+    QUERY_CHUNK_SIZE), resolves the names with Keyword.getids(), and
+    inserts and deletes the changed file-keyword rows in bulk."""
+
+    def __init__(self):
+        # file id: [set of names, whether they replace the existing]
+        self.files = {}
+
+    def set_keywords(self, file, names):
+        """Replace the keywords of file (which must be saved) with names"""
+        self.files[file.pk] = [set(keyword_name(name) for name in names),
+                               True]
+        return
+
+    def add_keywords(self, file, names):
+        """Add names to the keywords of file (which must be saved)"""
+        entry = self.files.setdefault(file.pk, [set(), False])
+        entry[0].update(keyword_name(name) for name in names)
+        return
+
+    @staticmethod
+    def keyword_names(files):
+        """Answer a dictionary of file id: set of keyword names of the
+        supplied files"""
+        through = Keyword.files.through
+        file_ids = [file.pk for file in files]
+        names = dict((file_id, set()) for file_id in file_ids)
+        for i in range(0, len(file_ids), QUERY_CHUNK_SIZE):
+            for file_id, name in through.objects.filter(
+                    file_id__in=file_ids[i:i+QUERY_CHUNK_SIZE]).values_list(
+                    'file_id', 'keyword__name'):
+                names[file_id].add(name)
+        return names
+
+    def apply(self):
+        """Write the recorded keywords to the database"""
+        if len(self.files) == 0:
+            return
+        through = Keyword.files.through
+        file_ids = list(self.files.keys())
+        # file id: {keyword id: through row id}
+        current = dict((file_id, {}) for file_id in file_ids)
+        for i in range(0, len(file_ids), QUERY_CHUNK_SIZE):
+            for pk, file_id, keyword_id in through.objects.filter(
+                    file_id__in=file_ids[i:i+QUERY_CHUNK_SIZE]).values_list(
+                    'pk', 'file_id', 'keyword_id'):
+                current[file_id][keyword_id] = pk
+        all_names = set()
+        for names, replace in self.files.values():
+            all_names.update(names)
+        keyword_ids = Keyword.getids(all_names)
+        added = []
+        removed = []
+        for file_id, (names, replace) in self.files.items():
+            wanted = set(keyword_ids[name] for name in names)
+            existing = current[file_id]
+            for keyword_id in wanted - set(existing):
+                added.append(through(file_id=file_id, keyword_id=keyword_id))
+            if replace:
+                removed.extend(pk for keyword_id, pk in existing.items()
+                               if keyword_id not in wanted)
+        for i in range(0, len(removed), QUERY_CHUNK_SIZE):
+            through.objects.filter(
+                pk__in=removed[i:i+QUERY_CHUNK_SIZE]).delete()
+        through.objects.bulk_create(added)
+        if len(added) > 0 or len(removed) > 0:
+            logger.debug("Keywords of {0} files: {1} added, {2} removed".format(
+                len(file_ids), len(added), len(removed)))
+        self.files = {}
+        return
+
+
 
 class FileDate(models.Model):
     """Store a date associated with a file.
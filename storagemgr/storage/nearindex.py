@@ -0,0 +1,95 @@
+"""
+Module: nearindex
+
+A multi-index of perceptual hashes (see smhash.dhash()), used to find near
+duplicate images.
+
+The 64 bit hashes are split in to threshold + 1 bands of bits.  Two hashes
+within threshold bits of each other must have at least one band in common,
+so only the hashes sharing a band with the target are compared.  Each band
+is a dictionary of {band value: [hashes]}, so finding the near duplicates
+of every hash is sub-quadratic for the usual small thresholds.
+"""
+
+from storage.smhash import hamming
+
+from logger import init_logging
+logger = init_logging(__name__)
+
+HASH_BITS = 64
+
+
+class MultiIndex(object):
+    """An index of 64 bit hashes answering those within threshold bits of
+    a target"""
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        bands = min(threshold + 1, HASH_BITS)
+        # [(shift, mask)] of each band
+        self.bands = []
+        start = 0
+        for i in range(bands):
+            width = (HASH_BITS - start) // (bands - i)
+            self.bands.append((start, (1 << width) - 1))
+            start += width
+        # One {band value: [hashes]} per band
+        self.tables = [{} for band in self.bands]
+        self.values = set()
+
+    def band_values(self, value):
+        value &= (1 << HASH_BITS) - 1
+        return [(value >> shift) & mask for shift, mask in self.bands]
+
+    def add(self, value):
+        """Add value to the index (if not already present)"""
+        if value in self.values:
+            return
+        self.values.add(value)
+        for table, band_value in zip(self.tables, self.band_values(value)):
+            table.setdefault(band_value, []).append(value)
+        return
+
+    def search(self, value):
+        """Answer the list of (distance, value) of the values within the
+        receiver's threshold of value"""
+        found = {}
+        for table, band_value in zip(self.tables, self.band_values(value)):
+            for candidate in table.get(band_value, ()):
+                if candidate not in found:
+                    found[candidate] = hamming(value, candidate)
+        return [(d, candidate) for candidate, d in found.items()
+                if d <= self.threshold]
+
+
+def near_clusters(values, threshold):
+    """Answer the list of clusters (sets) of the supplied values, where
+    each value is within threshold bits of another member of its cluster.
+    Values without any near neighbour aren't answered."""
+    index = MultiIndex(threshold)
+    for value in values:
+        index.add(value)
+    logger.debug("Indexed {0} hashes".format(len(index.values)))
+    # Union-find of the values
+    parents = {}
+
+    def find(value):
+        root = value
+        while parents[root] != root:
+            root = parents[root]
+        while parents[value] != root:
+            parents[value], value = root, parents[value]
+        return root
+
+    for value in index.values:
+        for d, neighbour in index.search(value):
+            if d > 0:
+                parents.setdefault(value, value)
+                parents.setdefault(neighbour, neighbour)
+                a, b = find(value), find(neighbour)
+                if a != b:
+                    parents[a] = b
+    clusters = {}
+    for value in parents:
+        clusters.setdefault(find(value), set()).add(value)
+    return list(clusters.values())
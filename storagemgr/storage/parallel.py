@@ -0,0 +1,217 @@
+"""
+Module: parallel
+
+Scan several root paths, or shards of large roots, concurrently.
+
+Each shard is scanned by its own process, so roots on different disks are
+read at the same time.  The processes write to the database concurrently:
+RelPath and Hash creation tolerate another process having created the same
+row, and each shard has its own ScanRun.
+
+The processes send their metrics to the parent through a queue, which
+merges them in to a single progress line and scan report.
+"""
+
+import os
+import time
+from collections import deque
+from multiprocessing import Process, Queue
+from os.path import isdir, islink, join
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty
+
+from django.db import connection
+
+from storage.models import RootPath
+from storage.scan import ScanFailed
+from storage.exclude import exclude_matcher
+from storage.metrics import ScanMetrics, Metrics, ProgressLine
+from storage.metrics import PROGRESS_INTERVAL, previous_report
+
+from logger import init_logging
+logger = init_logging(__name__)
+
+# Seconds to wait for messages from the shard processes
+QUEUE_TIMEOUT = 0.5
+
+
+def root_shards(root_path, depth=0):
+    """Answer the list of shards of root_path (see storage.scan.shard_top())
+    splitting it at depth directories below the root.  The directories
+    above depth have their own files scanned by a shard each."""
+    matcher = exclude_matcher(root_path)
+    shards = []
+
+    def add_shards(rel_path, depth):
+        if depth == 0:
+            shards.append(rel_path)
+            return
+        shards.append(join(rel_path, '.') if rel_path else '.')
+        path = join(root_path.abspath, rel_path) if rel_path \
+            else root_path.abspath
+        try:
+            names = sorted(os.listdir(path))
+        except OSError as e:
+            logger.warn(u"Unable to list {0}: {1}".format(path, e))
+            return
+        for name in names:
+            subdir = join(path, name)
+            if not isdir(subdir) or islink(subdir) or \
+                    matcher.child_excluded(subdir):
+                continue
+            add_shards(join(rel_path, name) if rel_path else name, depth - 1)
+
+    add_shards('', depth)
+    return shards
+
+
+class QueueProgress(object):
+    """Send the metrics of a shard process to the parent.
+    Provides the ProgressLine interface used by Scan."""
+
+    def __init__(self, queue, metrics):
+        self.queue = queue
+        self.metrics = metrics
+        self.last_update = 0
+
+    def update(self, force=False):
+        now = time.time()
+        if not force and now - self.last_update < PROGRESS_INTERVAL:
+            return
+        self.last_update = now
+        self.queue.put(dict(
+            (label, (m.counters, m.timings, m.hash_types, m.started,
+                     m.finished))
+            for label, m in self.metrics.roots.items()))
+        return
+
+    def finish(self):
+        self.update(force=True)
+        return
+
+
+def scan_shard(scan_class, scan_kwargs, root_path_id, shard, budget_share,
+               queue):
+    """Scan the shard of the root path.  Executed in a shard process."""
+    scan = scan_class(**scan_kwargs)
+    scan.progress = QueueProgress(queue, scan.metrics)
+    scan.budget_share = budget_share
+    root_path = RootPath.objects.get(pk=root_path_id)
+    scan.scan([(root_path, shard)], report=False)
+    return
+
+
+class ParallelScan(object):
+    """Scan the root paths with a process per root, or per shard if
+    shard_depth is greater than 0.
+
+    At most processes shards are scanned at once (default all of them),
+    the shards of different roots are interleaved so that each root is
+    being scanned.  scan_kwargs are passed to scan_class (QuickScan or
+    FullScan) in each process."""
+
+    def __init__(self, scan_class, scan_kwargs, root_paths, shard_depth=0,
+                 processes=None, progress=False):
+        self.scan_class = scan_class
+        self.scan_kwargs = scan_kwargs
+        self.root_paths = root_paths
+        self.shard_depth = shard_depth
+        self.processes = processes
+        self.metrics = ScanMetrics(scan_class.__name__)
+        self.progress = None
+        if progress:
+            self.progress = ProgressLine(self.metrics,
+                previous_report(self.metrics.kind))
+        self.failed = []
+
+    def shards(self):
+        """Answer the list of (root_path, shard, shard count), interleaving
+        the roots"""
+        root_shards_list = []
+        for root_path in self.root_paths:
+            shards = root_shards(root_path, self.shard_depth)
+            root_shards_list.append(deque((root_path, shard, len(shards))
+                                          for shard in shards))
+        shards = []
+        while len(root_shards_list) > 0:
+            for pending in list(root_shards_list):
+                shards.append(pending.popleft())
+                if len(pending) == 0:
+                    root_shards_list.remove(pending)
+        return shards
+
+    def scan(self):
+        pending = deque(self.shards())
+        processes = self.processes or len(pending)
+        queue = Queue()
+        running = []
+        # The shard processes must open their own database connections
+        connection.close()
+        try:
+            while len(pending) > 0 or len(running) > 0:
+                while len(pending) > 0 and len(running) < processes:
+                    root_path, shard, count = pending.popleft()
+                    # The shards of a root share its I/O budget
+                    share = min(count, processes)
+                    process = Process(target=scan_shard,
+                        args=(self.scan_class, self.scan_kwargs, root_path.pk,
+                              shard, share, queue))
+                    process.start()
+                    logger.info(u"Scanning {0} shard '{1}' (pid {2})".format(
+                        root_path.abspath, shard, process.pid))
+                    running.append((process, root_path, shard))
+                self.receive(queue, QUEUE_TIMEOUT)
+                for entry in list(running):
+                    process, root_path, shard = entry
+                    if process.is_alive():
+                        continue
+                    process.join()
+                    running.remove(entry)
+                    if process.exitcode != 0:
+                        logger.error(u"Scan of {0} shard '{1}' failed".format(
+                            root_path.abspath, shard))
+                        self.failed.append((root_path, shard))
+            # Collect the final messages
+            while self.receive(queue, QUEUE_TIMEOUT):
+                pass
+        except BaseException:
+            for process, root_path, shard in running:
+                process.terminate()
+            raise
+        finally:
+            if self.progress is not None:
+                self.progress.finish()
+        self.metrics.write_reports()
+        if len(self.failed) > 0:
+            raise ScanFailed(u"Failed shards: {0}".format(", ".join(
+                u"{0}:'{1}'".format(root_path.abspath, shard)
+                for root_path, shard in self.failed)))
+        return
+
+    def receive(self, queue, timeout):
+        """Merge the metrics sent by the shard processes.
+        Answer a boolean indicating whether any were received."""
+        received = False
+        while True:
+            try:
+                message = queue.get(timeout=timeout)
+            except Empty:
+                break
+            received = True
+            timeout = 0
+            for label, (counters, timings, hash_types, started,
+                        finished) in message.items():
+                metrics = self.metrics.roots.get(label)
+                if metrics is None:
+                    metrics = Metrics()
+                    self.metrics.roots[label] = metrics
+                metrics.counters = counters
+                metrics.timings = timings
+                metrics.hash_types = hash_types
+                metrics.started = started
+                metrics.finished = finished
+        if self.progress is not None:
+            self.progress.update()
+        return received
@@ -0,0 +1,48 @@
+"""
+Module: pathtrie
+
+A trie of absolute paths, by path component, answering the value of the
+longest path that contains a given path, e.g. the RootPath of a directory
+(see models.RootPath.getrootpath()).
+
+Matching is by whole components, so /data/photos doesn't contain
+/data/photos2, and a nested root (/data/photos/archive) is preferred to
+its parent (/data/photos).
+"""
+
+import os
+
+
+def path_components(path):
+    """Answer the list of components of path, ignoring empty components,
+    e.g. of a trailing separator"""
+    return [component for component in path.split(os.sep)
+            if component != '']
+
+
+class PathTrie(object):
+    """A trie of {component: node}, where each node is
+    [value, {component: node}]"""
+
+    def __init__(self):
+        self.root = [None, {}]
+
+    def add(self, path, value):
+        node = self.root
+        for component in path_components(path):
+            node = node[1].setdefault(component, [None, {}])
+        node[0] = value
+        return
+
+    def longest(self, path):
+        """Answer the value of the longest path added that is path or one
+        of its parents, or None"""
+        node = self.root
+        value = node[0]
+        for component in path_components(path):
+            node = node[1].get(component)
+            if node is None:
+                break
+            if node[0] is not None:
+                value = node[0]
+        return value
@@ -0,0 +1,248 @@
+"""
+Module: rehash
+
+Migrate the existing digests to a new algorithm (settings.SMHASH_ALGORITHM,
+SMHASH_JPEG_STREAM and SMHASH_MEDIA_STREAM) in the background.
+
+Each Hash of another algorithm is migrated by rehashing each of its files
+that hasn't changed since it was scanned.  If they all have the same new
+digest, all the files referencing the Hash (including deleted files, and
+as their original_hash) are re-pointed to the Hash of the new digest, and
+the old Hash removed.  If another file was already hashed with the new
+algorithm, the two Hashes are merged, so that duplicates are found again.
+Files that only matched with the old algorithm, e.g. a PNG and a JPEG with
+the same pixels, are split between the Hashes of their new digests.
+
+Files whose algorithms only differ in a scheme that doesn't apply to them,
+e.g. PNGs when changing from sha256 to sha256+jpeg, keep their digest and
+aren't reread.
+
+Hashes are migrated in batches, each in its own transaction, so the
+migration can be interrupted and restarted at any time.  Hashes without a
+readable, unchanged, file are left for the next scan to rehash.
+
+DHashBackfill similarly adds the perceptual hash (File.dhash) of images
+scanned before it was recorded.
+"""
+
+import time
+from functools import reduce
+
+from django.db import transaction
+from django.db.models import Q
+
+from storage.models import Hash, File, EMPTY_DIGEST, IMAGE_TYPES
+from storage.smhash import split_algorithm, applied_schemes
+from storage.hashcache import cached_smhash, cached_dhash, digest_algorithm
+from storage.throttle import IOBudget
+
+from logger import init_logging
+logger = init_logging(__name__)
+
+# The number of Hashes migrated per transaction
+MIGRATION_BATCH_SIZE = 100
+
+
+class HashMigration(object):
+    """Rehash the files of the Hashes of algorithms other than algorithm
+    (default hashcache.digest_algorithm()).
+
+    At most limit Hashes are migrated (None = all), pausing for pause
+    seconds between batches of batch_size Hashes."""
+
+    def __init__(self, algorithm=None, batch_size=MIGRATION_BATCH_SIZE,
+                 limit=None, pause=0.0):
+        self.algorithm = algorithm or digest_algorithm()
+        self.batch_size = batch_size
+        self.limit = limit
+        self.pause = pause
+        self.migrated = 0
+        self.skipped = 0
+        # root path id: IOBudget
+        self.budgets = {}
+
+    def pending(self):
+        """Answer the query set of Hashes still to be migrated"""
+        return Hash.objects.exclude(algorithm=self.algorithm).exclude(
+            digest=EMPTY_DIGEST)
+
+    def migrate(self):
+        """Migrate the pending Hashes, in batches"""
+        last_pk = 0
+        while self.limit is None or self.migrated < self.limit:
+            batch_size = self.batch_size
+            if self.limit is not None:
+                batch_size = min(batch_size, self.limit - self.migrated)
+            hashes = list(self.pending().filter(pk__gt=last_pk)
+                          .order_by('pk')[:batch_size])
+            if len(hashes) == 0:
+                break
+            # Skipped Hashes aren't retried until the next run.
+            # Migrated Hashes may be deleted, which clears their pk.
+            last_pk = hashes[-1].pk
+            with transaction.atomic():
+                for hash in hashes:
+                    if self.migrate_hash(hash):
+                        self.migrated += 1
+                    else:
+                        self.skipped += 1
+            logger.info("Migrated {0} hashes, skipped {1}".format(
+                self.migrated, self.skipped))
+            if self.pause > 0:
+                time.sleep(self.pause)
+        return
+
+    def migrate_hash(self, hash):
+        """Migrate the supplied Hash.
+        Answer a boolean indicating whether it was migrated."""
+        digests = self.new_digests(hash)
+        if len(digests) == 0:
+            logger.debug(u"No unchanged file for {0}, skipping".format(hash))
+            return False
+        new_digests = set(digests.values())
+        if hash.digest in new_digests:
+            # The digest is unchanged by the new scheme for some files
+            hash.algorithm = self.algorithm
+            hash.save()
+        if len(new_digests) == 1:
+            # All the files still match, including those that couldn't be
+            # rehashed
+            new_hash = Hash.gethash(new_digests.pop(), self.algorithm)
+            if new_hash != hash:
+                File.objects.filter(hash=hash).update(hash=new_hash)
+                File.objects.filter(original_hash=hash).update(
+                    original_hash=new_hash)
+                hash.delete()
+            return True
+        # The files only matched with the old algorithm, e.g. a PNG and a
+        # JPEG with the same pixels, so each gets its own Hash.  Files that
+        # couldn't be rehashed are left for the next scan.
+        logger.info(u"{0} splits in to {1} digests".format(
+            hash, len(new_digests)))
+        new_hashes = Hash.gethashes([(digest, self.algorithm)
+                                     for digest in new_digests])
+        for file_id, digest in digests.items():
+            new_hash = new_hashes[digest]
+            if new_hash == hash:
+                continue
+            File.objects.filter(pk=file_id).update(hash=new_hash)
+            File.objects.filter(pk=file_id, original_hash=hash).update(
+                original_hash=new_hash)
+        referenced = Q(hash=hash) | Q(original_hash=hash)
+        if not File.objects.filter(referenced).exists():
+            hash.delete()
+        return True
+
+    def new_digests(self, hash):
+        """Answer a dictionary of file id: digest with the receiver's
+        algorithm of the unchanged files of hash.
+
+        Every file is checked, since files that share a digest of one
+        algorithm may not share it with another, e.g. two encodings of the
+        same pixels with the JPEG scheme.  Files whose type isn't affected
+        by the change of algorithm aren't reread."""
+        digests = {}
+        files = File.objects.filter(hash=hash, deleted=None,
+                                    symbolic_link=False)
+        for file in files.select_related('path__root'):
+            try:
+                if file.os_stats_changed():
+                    continue
+                if self.same_digest(file.abspath, hash.algorithm):
+                    digests[file.pk] = hash.digest
+                else:
+                    digests[file.pk] = cached_smhash(
+                        file.abspath, budget=self.budget(file.path.root),
+                        algorithm=self.algorithm)
+            except EnvironmentError as e:
+                logger.debug(u"Unable to rehash {0}: {1}".format(
+                    file.abspath, e))
+        return digests
+
+    def same_digest(self, fn, algorithm):
+        """Answer a boolean indicating whether fn's digest with algorithm
+        is the same with the receiver's algorithm, i.e. they only differ in
+        schemes that don't apply to fn"""
+        if split_algorithm(algorithm)[0] != \
+                split_algorithm(self.algorithm)[0]:
+            return False
+        return applied_schemes(fn, algorithm) == \
+            applied_schemes(fn, self.algorithm)
+
+    def budget(self, root_path):
+        """Answer the IOBudget of root_path"""
+        if root_path.pk not in self.budgets:
+            self.budgets[root_path.pk] = IOBudget.for_root(root_path)
+        return self.budgets[root_path.pk]
+
+
+class DHashBackfill(object):
+    """Add the perceptual hash of the unchanged image Files without one.
+
+    At most limit Files are updated (None = all), pausing for pause
+    seconds between batches of batch_size Files."""
+
+    def __init__(self, batch_size=MIGRATION_BATCH_SIZE, limit=None,
+                 pause=0.0):
+        self.batch_size = batch_size
+        self.limit = limit
+        self.pause = pause
+        self.updated = 0
+        self.skipped = 0
+        # root path id: IOBudget
+        self.budgets = {}
+
+    def pending(self):
+        """Answer the query set of Files still to be updated"""
+        images = reduce(lambda q, ext: q | Q(name__iendswith=ext),
+                        IMAGE_TYPES, Q())
+        return File.objects.filter(images, deleted=None, symbolic_link=False,
+                                   dhash=None, size__gt=0)
+
+    def backfill(self):
+        """Update the pending Files, in batches"""
+        last_pk = 0
+        while self.limit is None or self.updated < self.limit:
+            batch_size = self.batch_size
+            if self.limit is not None:
+                batch_size = min(batch_size, self.limit - self.updated)
+            files = list(self.pending().filter(pk__gt=last_pk)
+                         .select_related('path__root')
+                         .order_by('pk')[:batch_size])
+            if len(files) == 0:
+                break
+            with transaction.atomic():
+                for file in files:
+                    if self.update_file(file):
+                        self.updated += 1
+                    else:
+                        self.skipped += 1
+            # Skipped Files aren't retried until the next run
+            last_pk = files[-1].pk
+            logger.info("Added {0} dhashes, skipped {1}".format(
+                self.updated, self.skipped))
+            if self.pause > 0:
+                time.sleep(self.pause)
+        return
+
+    def update_file(self, file):
+        """Add the dhash of the supplied File.
+        Answer a boolean indicating whether it was updated."""
+        try:
+            if file.os_stats_changed():
+                return False
+            dhash = cached_dhash(file.abspath,
+                                 budget=self.budget(file.path.root))
+        except EnvironmentError as e:
+            logger.debug(u"Unable to dhash {0}: {1}".format(file.abspath, e))
+            return False
+        if dhash is None:
+            return False
+        File.objects.filter(pk=file.pk).update(dhash=dhash)
+        return True
+
+    def budget(self, root_path):
+        """Answer the IOBudget of root_path"""
+        if root_path.pk not in self.budgets:
+            self.budgets[root_path.pk] = IOBudget.for_root(root_path)
+        return self.budgets[root_path.pk]
@@ -1,85 +1,457 @@
 import os
-import re
+import time
+from datetime import date, datetime, timedelta
+from itertools import islice
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from os.path import join
+try:
+    from os import scandir
+except ImportError:
+    # Python 2 requires the scandir package
+    from scandir import scandir
 
 from django.db.models import Q
 
-from storage.models import RootPath, RelPath, File, ExcludeDir
+from storage.models import RootPath, RelPath, File, ScanRun, Hash
+from storage.models import KeywordSync
+from storage.models import QUERY_CHUNK_SIZE, file_details, stat_mtime_ns
+from storage.models import details_metadata
+from storage.hashcache import cached_fingerprint
+from storage.exclude import exclude_matcher
+from storage.batch import TransactionBatch
+from storage.throttle import IOBudget
+from storage.metrics import ScanMetrics, ProgressLine, previous_report
 
 from logger import init_logging
 logger = init_logging(__name__)
 
+# The number of files sent to the worker pool, and whose Hashes are
+# resolved, at a time
+HASH_BATCH_SIZE = 64
+# Directories modified within this many seconds of being scanned don't
+# have their mtime recorded, as further changes may not alter the mtime
+RACY_INTERVAL = 2.0
+# Files deleted within this long before the scan started may have been
+# moved to a directory that hasn't been scanned yet
+MOVE_WINDOW = timedelta(hours=1)
+
+
+def pool_file_details(args):
+    """Answer the FileDetails for (abspath, stats, budget config, cache,
+    metadata).  Executed in the workers, so mustn't access the database."""
+    abspath, stats, budget_config, cache, metadata = args
+    budget = IOBudget.from_config(budget_config)
+    return file_details(abspath, metadata=metadata, stats=stats,
+                        budget=budget, cache=cache)
+
+
+def shard_top(root_path, shard):
+    """Answer (top, recurse) for the shard of root_path.
+
+    A shard is a path relative to the root: '' is the entire root, 'a/b'
+    the sub-tree a/b, and a path ending in '.', e.g. '.' or 'a/.', only the
+    files of the directory itself."""
+    recurse = shard != '.' and not shard.endswith('/.')
+    if not recurse:
+        shard = shard[:-1].rstrip('/')
+    if shard == '':
+        top = root_path.abspath
+    else:
+        top = join(root_path.abspath, shard)
+    return top, recurse
+
+
+class DirListing(object):
+    """The files of a directory listed by walk().
+
+    The files are only stat'd when stats() is first called, so that
+    directories whose files aren't reconciled (see Scan.dir_unchanged())
+    cost a listing only.  The stats are charged to budget and timed by
+    metrics, if supplied."""
+
+    def __init__(self, entries, budget=None, metrics=None):
+        # name: DirEntry
+        self.entries = dict((entry.name, entry) for entry in entries)
+        self.budget = budget
+        self.metrics = metrics
+        self._stats = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def stat_entry(entry):
+        """Answer the os.lstat() of entry.  The scandir package's
+        DirEntry.stat() answers a stat_result that can't be pickled to the
+        worker processes, and the call is an lstat() on POSIX anyway."""
+        return os.lstat(entry.path)
+
+    def stats(self):
+        """Answer the dictionary of file name: os.stat() (the link for
+        symbolic links)"""
+        if self._stats is not None:
+            return self._stats
+        start = time.time()
+        stats = {}
+        for name, entry in self.entries.items():
+            try:
+                stats[name] = self.stat_entry(entry)
+            except OSError as e:
+                # The entry has probably been removed since the listing
+                logger.debug(u"Unable to stat {0}: {1}".format(entry.path, e))
+        if self.budget is not None:
+            self.budget.consume(0, len(stats))
+        if self.metrics is not None:
+            self.metrics.add_time('stat', time.time() - start)
+        self._stats = stats
+        return stats
+
+
+def walk(top, excluded=None, budget=None, metrics=None):
+    """Walk the directory tree rooted at top (top down) using scandir.
+
+    Yield (path, stats, entry_count, files) for each directory, where stats
+    is the directory's os.stat() and files is a DirListing of its files,
+    which are only stat'd when needed.
+    Sub-directories for which excluded(path) answers True are pruned
+    before being listed.  Symbolic links to directories aren't followed,
+    and like os.walk(), unreadable directories are skipped.
+    If budget is supplied, each listing and stat is charged to it.
+    If metrics (ScanMetrics) is supplied, the walk and stat phases are timed."""
+    stack = [top]
+    while len(stack) > 0:
+        path = stack.pop()
+        if budget is not None:
+            budget.consume(0)
+        start = time.time()
+        try:
+            # Get the mtime before listing so changes during the
+            # listing will be seen next time
+            stats = os.stat(path)
+            entries = list(scandir(path))
+        except OSError as e:
+            logger.warn(u"Unable to list {0}: {1}".format(path, e))
+            continue
+        subdirs = []
+        files = []
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        subdirs.append(entry.path)
+                    continue
+            except OSError as e:
+                # The entry has probably been removed since the listing
+                logger.debug(u"Unable to stat {0}: {1}".format(entry.path, e))
+                continue
+            files.append(entry)
+        if metrics is not None:
+            metrics.add_time('walk', time.time() - start)
+        yield path, stats, len(entries), DirListing(files, budget, metrics)
+        # Push in reverse so sub-directories are walked in listing order
+        for subdir in reversed(subdirs):
+            if excluded is not None and excluded(subdir):
+                logger.debug(u"Skipping: {0}".format(subdir))
+            else:
+                stack.append(subdir)
+
+
+class ScanFailed(Exception):
+    """Some directories couldn't be scanned"""
+    pass
+
+
 class Scan(object):
     """Abstract functionality for scanning folders.
     
-    Either FullScan or QuickScan should be instantiated."""
+    Either FullScan or QuickScan should be instantiated.
+
+    If workers is greater than 1, hashing and metadata extraction are done
+    by a pool of worker processes, in batches of batch_size files.
+    Walking the directories and database updates remain in this process.
+    If threads is True the pool is of threads instead, which avoids
+    copying the work between processes; hashlib releases the GIL while
+    hashing, but the metadata is read in this thread.
+
+    The progress of each root is recorded in a ScanRun.  If resume is True,
+    the directories completed by an interrupted scan are skipped.
+
+    Database writes are committed every commit_size directories or
+    commit_interval seconds (default settings.COMMIT_SIZE and
+    settings.COMMIT_INTERVAL).
+
+    Reads are limited by the IOBudget of each root path, which is shared
+    between the worker processes.
+
+    Files and directories are identified by their device and inode, so
+    that moved files are re-pointed rather than deleted and re-hashed.
+
+    Directories that still fail after being retried are added to failed,
+    their root's ScanRun is left unfinished and ScanFailed is raised at the
+    end of the scan.
+
+    Counters and phase timings are collected in self.metrics and reported
+    at the end of the scan.  If progress is True, a progress line is
+    written to stderr."""
+
+    # True if the scan rehashes every file
+    full = False
     
-    def __init__(self, rp=None):
+    def __init__(self, rp=None, workers=1, batch_size=HASH_BATCH_SIZE,
+                 resume=False, commit_size=None, commit_interval=None,
+                 progress=False, threads=False):
         if rp is None:
             self.root_paths = list(RootPath.objects.all())
         else:
             self.root_paths = list(RootPath.objects.filter(path__icontains=rp))
         if len(self.root_paths) == 0:
             raise Exception("No root paths found from: {0}".format(rp))
+        self.workers = workers
+        self.threads = threads
+        self.batch_size = batch_size
+        self.resume = resume
+        self.commit_size = commit_size
+        self.commit_interval = commit_interval
+        self.pool = None
+        self.budget = None
+        # The number of processes sharing each root's I/O budget
+        self.budget_share = 1
+        self.started = None
+        self.failed = []
+        self.metrics = ScanMetrics(self.__class__.__name__)
+        self.progress = None
+        if progress:
+            self.progress = ProgressLine(self.metrics,
+                previous_report(self.metrics.kind))
+
+    def scan(self, shards=None, report=True):
+        """Scan the root paths, starting the worker pool if requested.
+        shards is a list of (root_path, shard) to scan instead of the
+        entire root paths.  If report is True, write the scan report."""
+        self.started = datetime.now()
+        if self.workers > 1:
+            if self.threads:
+                self.pool = ThreadPool(self.workers)
+            else:
+                self.pool = Pool(self.workers)
+        try:
+            self.scan_roots(shards)
+        finally:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
+            if self.progress is not None:
+                self.progress.finish()
+        if report:
+            self.metrics.write_reports()
+        if len(self.failed) > 0:
+            raise ScanFailed("Unable to scan {0} directories, see the "
+                             "log".format(len(self.failed)))
+
+    def scan_roots(self, shards=None):
+        """Scan each root path (or shard) in turn and update the database"""
+        if shards is None:
+            shards = [(root_path, '') for root_path in self.root_paths]
+        for root_path, shard in shards:
+            self.scan_root(root_path, shard)
+        return
+
+    def scan_root(self, root_path, shard=''):
+        """Scan the shard (see shard_top()) of root_path"""
+        top, recurse = shard_top(root_path, shard)
+        matcher = exclude_matcher(root_path)
+        if matcher.excluded(join(top, '')):
+            logger.debug(u"Skipping: {0}".format(top))
+            return
+        if recurse:
+            excluded = matcher.child_excluded
+        else:
+            excluded = lambda path: True
 
-    def scan(self):
-        """Scan each root path in turn and update the database"""
-        # Iterate over each of the managed root paths
-        for root_path in self.root_paths:
-            # Build the list of regexe's
-            regexes = []
-            query = Q(root_path=root_path) | Q(root_path=None)
-            for rec in ExcludeDir.objects.filter(query):
-                regexes.append(re.compile(rec.regex))
-
-            # Iterate over each of the files in the current root path
-            for root, dirs, files in os.walk(root_path.abspath):
-                #
-                # Get the path to the current directory
-                #
-                rel_path = RelPath.getrelpath(root, root_path=root_path)
-                
-                #
-                # Continue if directory is excluded
-                #
-                skip = False
-                i = 0
-                while (i < len(regexes)) and not skip:
-                    if regexes[i].search(rel_path.abspath):
-                        logger.debug(u"Skipping: {0}".format(rel_path.abspath))
-                        skip=True
-                    i += 1
-                if skip:
+        # Threads share a single budget
+        processes = 1 if self.threads else self.workers
+        self.budget = IOBudget.for_root(root_path,
+                                        share=processes * self.budget_share)
+        self.metrics.start_root(top)
+        if recurse:
+            # Only the shard's own directories are read, the other shards
+            # are scanned by other processes
+            with self.metrics.timer('db_lookup'):
+                RelPath.warm_cache(root_path, shard)
+        run = ScanRun.start(root_path, self.full, self.resume, shard)
+        completed = run.completed_dirs()
+        # Directories are recorded as completed in the same transaction
+        # as their changes
+        batch = TransactionBatch(self.commit_size, self.commit_interval,
+                                 on_commit=run.dirs_completed)
+
+        # Iterate over each of the directories in the current root path,
+        # excluded directories are never entered.
+        try:
+            for root, stats, entry_count, files in walk(top, excluded,
+                    self.budget, self.metrics):
+                batch.run(self.scan_path, root_path, completed,
+                          root, files, entry_count, stats)
+                if self.progress is not None:
+                    self.progress.update()
+        except BaseException:
+            # Don't commit a partially scanned directory
+            batch.abort()
+            raise
+        finally:
+            RelPath.clear_cache(root_path)
+        batch.close()
+        if len(batch.failed) > 0:
+            # Leave the run unfinished so the directories are resumed
+            logger.error(u"Unable to scan {0} directories of {1}".format(
+                len(batch.failed), top))
+            self.failed.extend(batch.failed)
+        else:
+            run.finish()
+        self.metrics.add_time('db_write', batch.commit_time)
+        self.metrics.finish_root()
+        return
+
+    def scan_path(self, root_path, completed, path, files, entry_count, stats):
+        """Scan the directory path, unless it is in completed.
+        Answer its RelPath, or None if it was skipped."""
+        with self.metrics.timer('db_lookup'):
+            rel_path = self.dir_rel_path(root_path, path, stats)
+        if rel_path.pk in completed:
+            logger.debug(u"Already scanned: {0}".format(path))
+            return None
+        self.scan_dir(rel_path, files, entry_count, stats)
+        return rel_path
+
+    def dir_rel_path(self, root_path, path, stats):
+        """Answer the RelPath of the directory path, whose os.stat() is stats.
+
+        A new directory with the inode of a known directory that is no
+        longer at its path has been moved (or renamed), so the known RelPath
+        and its sub-directories are moved, keeping their files."""
+        try:
+            return RelPath.getrelpath(path, root_path=root_path, create=False)
+        except ValueError:
+            pass
+        for candidate in RelPath.objects.filter(root=root_path,
+                dev=stats.st_dev, ino=stats.st_ino):
+            candidate.root = root_path
+            if candidate.inode_moved():
+                candidate.move(path[len(root_path.path)+1:])
+                self.metrics.count('dirs_moved')
+                return candidate
+        return RelPath.getrelpath(path, root_path=root_path)
+
+    def scan_dir(self, rel_path, files, entry_count, stats):
+        """Reconcile the supplied directory listing with the database.
+
+        files is the DirListing answered by walk(), its files are only
+        stat'd if the directory isn't unchanged (see dir_unchanged()),
+        stats is the os.stat() of the directory.
+        The known files are loaded with a single query, new files are
+        inserted in bulk and deleted files are marked in a single update.
+        The directory mtime and entry_count are recorded for QuickScan."""
+        dir_mtime = stats.st_mtime
+        self.metrics.count('dirs')
+        self.metrics.count('files', len(files))
+        if self.dir_unchanged(rel_path, dir_mtime, entry_count):
+            logger.debug(u"Directory unchanged: {0}".format(rel_path.abspath))
+            self.metrics.count('dirs_skipped')
+            return
+        files = files.stats()
+        #
+        # Get the known files, keyed by name
+        #
+        known_files = {}
+        with self.metrics.timer('db_lookup'):
+            for file in File.objects.filter(path=rel_path, deleted=None):
+                # Avoid a query per file for the path
+                file.path = rel_path
+                known_files[file.name] = file
+        names = set(files)
+        known_names = set(known_files.keys())
+
+        #
+        # New files with the inode of a known file have been moved here
+        #
+        new_names = names - known_names
+        with self.metrics.timer('db_write'):
+            new_names -= set(self.moved_files(rel_path,
+                dict((fname, files[fname]) for fname in new_names)))
+
+        #
+        # Collect the files whose hash needs to be updated:
+        # new files and changed files (QuickScan or FullScan).
+        #
+        to_hash = []
+        for fname in sorted(new_names):
+            to_hash.append((File(path=rel_path, name=fname), files[fname]))
+        for fname in sorted(names & known_names):
+            file = known_files[fname]
+            if self.needs_rehash(file, files[fname]):
+                to_hash.append((file, files[fname]))
+            else:
+                logger.debug(u"No change: {0}".format(file.abspath))
+        self.hash_files(rel_path, to_hash)
+
+        #
+        # Known files that are no longer present have been deleted
+        #
+        deleted = [known_files[fname] for fname in known_names - names]
+        for file in deleted:
+            logger.debug(u"Removing from known_files: {0}".format(file.abspath))
+        with self.metrics.timer('db_write'):
+            File.mark_all_deleted(deleted)
+            self.metrics.count('files_deleted', len(deleted))
+
+            if time.time() - dir_mtime > RACY_INTERVAL:
+                rel_path.update_dir_stats(dir_mtime, entry_count)
+            rel_path.update_inode(stats)
+        return
+
+    def moved_files(self, rel_path, files):
+        """Move the known files that have been moved to rel_path.
+
+        files is a dictionary of name: os.stat() of the new files in
+        rel_path.  A known file with the same device, inode, size and
+        nanosecond mtime has been moved if it was deleted within MOVE_WINDOW
+        of the scan starting, or its inode is no longer at its path.
+        Answer the list of names that were moved."""
+        new_files = {}
+        for fname, stats in files.items():
+            key = (stats.st_dev, stats.st_ino, stats.st_size,
+                   stat_mtime_ns(stats))
+            new_files[key] = fname
+        if len(new_files) == 0:
+            return []
+        since = (self.started or datetime.now()) - MOVE_WINDOW
+        inos = sorted(set(key[1] for key in new_files))
+        moved = []
+        for i in range(0, len(inos), QUERY_CHUNK_SIZE):
+            candidates = File.objects.filter(
+                Q(deleted=None) | Q(deleted__gte=since),
+                ino__in=inos[i:i+QUERY_CHUNK_SIZE]).select_related(
+                'path__root')
+            for file in candidates:
+                key = (file.dev, file.ino, file.size, file.mtime_ns)
+                fname = new_files.get(key)
+                if fname is None:
                     continue
+                if file.deleted is None and not file.inode_moved():
+                    # A hard link, both paths are present
+                    continue
+                file.move(rel_path, fname)
+                del new_files[key]
+                moved.append(fname)
+        self.metrics.count('files_moved', len(moved))
+        return moved
 
-                #
-                # Get the list of known files so we can remove any
-                # that have been deleted
-                #
-                known_files = list(File.objects.filter(path=rel_path))
-                
-                #
-                # Iterate over the files in the current directory and ensure
-                # the hash is up to date (QuickScan or FullScan).
-                # Remove each file from the list of known files on the way.
-                #
-                for fname in files:
-                    file = self.file(rel_path, fname)
-                    if file is None:
-                        self.add_file(rel_path, fname)
-                    else:
-                        known_files.remove(file)
-                        if self.needs_rehash(file):
-                            self.update_file(file)
-                        else:
-                            logger.debug(u"No change: {0}".format(file.abspath))
-                
-                #
-                # What's left in known_files has been deleted
-                # Remove from db
-                #
-                for file in known_files:
-                    logger.debug(u"Removing from known_files: {0}".format(file.abspath))
-                    file.mark_deleted()
+    def dir_unchanged(self, rel_path, mtime, entry_count):
+        """Answer a boolean indicating whether reconciling the directory's
+        files can be skipped.  By default, never."""
+        return False
 
     def file(self, rel_path, fname):
         """Answer the File object if present or None."""
@@ -91,30 +463,175 @@ class Scan(object):
         else:
             return files[0]
 
-    def add_file(self, rel_path, fname):
+    def files_details(self, files):
+        """Answer an iterator over (file, FileDetails) for the supplied
+        (file, stats).  If there is a worker pool, stream the work through it
+        in bounded batches."""
+        if self.pool is None:
+            for file, stats in files:
+                yield file, file_details(file.abspath, metadata=True,
+                                         stats=stats, budget=self.budget,
+                                         cache=not self.full)
+            return
+        if self.budget is None:
+            budget_config = None
+        else:
+            budget_config = self.budget.config()
+        for i in range(0, len(files), self.batch_size):
+            batch = files[i:i+self.batch_size]
+            args = [(file.abspath, stats, budget_config, not self.full,
+                     not self.threads)
+                    for file, stats in batch]
+            results = self.pool.imap(pool_file_details, args)
+            for j, details in enumerate(results):
+                file = batch[j][0]
+                if self.threads:
+                    details = details_metadata(file.abspath, details)
+                yield file, details
+
+    def hash_files(self, rel_path, files):
+        """Hash and update the supplied (file, stats) in rel_path.
+        The Hashes of each batch of files are resolved together, and files
+        that aren't yet in the db are inserted in bulk."""
+        new_files = []
+        files_details = self.files_details(files)
+        while True:
+            batch = list(islice(files_details, self.batch_size))
+            if len(batch) == 0:
+                break
+            start = time.time()
+            hashes = Hash.gethashes([(details.digest, details.algorithm)
+                                     for file, details in batch])
+            self.metrics.add_time('db_write', time.time() - start)
+            keyword_sync = KeywordSync()
+            for file, details in batch:
+                self.metrics.count('files_hashed')
+                self.metrics.count('bytes_hashed', details.size)
+                self.metrics.add_time('hash', details.hash_time)
+                self.metrics.add_hash_types(details.hash_types)
+                self.metrics.add_time('exif', details.metadata_time)
+                start = time.time()
+                hash = hashes[details.digest]
+                if file.pk is None:
+                    logger.debug(u"Adding: {0}".format(file.name))
+                    file.get_details(details, hash)
+                    new_files.append((file, details))
+                else:
+                    self.update_file(file, details, hash, keyword_sync)
+                self.metrics.add_time('db_write', time.time() - start)
+            with self.metrics.timer('db_write'):
+                keyword_sync.apply()
+        if len(new_files) == 0:
+            return
+        with self.metrics.timer('db_write'):
+            self.add_new_files(rel_path, new_files)
+        return
+
+    def add_new_files(self, rel_path, new_files):
+        """Insert the supplied (file, FileDetails) in bulk"""
+        self.metrics.count('files_added', len(new_files))
+        File.objects.bulk_create([file for file, details in new_files])
+
+        #
+        # bulk_create() doesn't set the primary key, so re-read the new
+        # images to add their keywords and dates
+        #
+        metadata = {}
+        for file, details in new_files:
+            if file.is_image:
+                metadata[file.name] = details.metadata
+        if len(metadata) == 0:
+            return
+        keyword_sync = KeywordSync()
+        for file in File.objects.filter(path=rel_path, deleted=None):
+            if file.name in metadata:
+                file.file_update_metadata(metadata[file.name], keyword_sync)
+                file.save()
+        keyword_sync.apply()
+        return
+
+    def add_file(self, rel_path, fname, details=None):
         """Add the supplied fname to the db"""
         logger.debug(u"Adding: {0}".format(fname))
         file = File(path=rel_path, name=fname)
-        file.update_details()
+        if details is None:
+            details = file_details(file.abspath, budget=self.budget,
+                                   cache=not self.full)
+        file.update_details(details)
         return
 
-    def update_file(self, file):
+    def update_file(self, file, details=None, hash=None, keyword_sync=None):
         logger.debug(u"Updating: {0}".format(file.abspath))
-        file.update_details()
+        self.metrics.count('files_updated')
+        if details is None:
+            details = file_details(file.abspath, budget=self.budget,
+                                   cache=not self.full)
+        file.update_details(details, hash, keyword_sync)
         return
 
 
 class QuickScan(Scan):
     """QuickScan assumes that a file with the same mtime and size hasn't
-    changed, so doesn't require its hash to be recalculated."""
-    
-    def needs_rehash(self, file):
-        return file.os_stats_changed()
+    changed, so doesn't require its hash to be recalculated.
+
+    If skip_unchanged_dirs is True, QuickScan also assumes that the files
+    in a directory with the same mtime and entry count as the last scan
+    haven't changed.  Since modifying a file doesn't change its directory,
+    the files of unchanged directories are still stat-checked every
+    verify_every days (0 = never), spread evenly across the directories.
+
+    If check_fingerprint is True, a file whose mtime has changed but whose
+    size and fingerprint (see smhash.fingerprint()) haven't is assumed to
+    be unchanged, e.g. touched by a sync tool, and isn't rehashed.  Only
+    the sampled blocks are compared, so this is optional."""
+
+    def __init__(self, rp=None, workers=1, batch_size=HASH_BATCH_SIZE,
+                 resume=False, commit_size=None, commit_interval=None,
+                 progress=False, skip_unchanged_dirs=False, verify_every=7,
+                 check_fingerprint=False, threads=False):
+        super(QuickScan, self).__init__(rp, workers, batch_size, resume,
+                                        commit_size, commit_interval,
+                                        progress, threads)
+        self.skip_unchanged_dirs = skip_unchanged_dirs
+        self.verify_every = verify_every
+        self.check_fingerprint = check_fingerprint
+
+    def dir_unchanged(self, rel_path, mtime, entry_count):
+        if not self.skip_unchanged_dirs:
+            return False
+        if rel_path.ino is None:
+            # Scanned before inodes were recorded
+            return False
+        if rel_path.mtime != mtime or rel_path.entry_count != entry_count:
+            return False
+        if self.verify_every > 0 and \
+                (rel_path.pk + date.today().toordinal()) % self.verify_every == 0:
+            # It's this directory's turn to have its files stat-checked
+            return False
+        return True
+
+    def needs_rehash(self, file, stats=None):
+        if not file.os_stats_changed(stats):
+            return False
+        if not self.check_fingerprint or file.fingerprint is None:
+            return True
+        if stats is None:
+            stats = file.os_stats()
+        if stats.st_size != file.size or \
+                cached_fingerprint(file.abspath, stats, self.budget) != \
+                file.fingerprint:
+            return True
+        logger.debug(u"Fingerprint unchanged: {0}".format(file.abspath))
+        file.update_stats(stats)
+        self.metrics.count('files_touched')
+        return False
 
 
 class FullScan(Scan):
     """FullScan rehashes every file, regardless of whether it has been
     changed or not"""
 
-    def needs_rehash(self, file):
+    full = True
+
+    def needs_rehash(self, file, stats=None):
         return True
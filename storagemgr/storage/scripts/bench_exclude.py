@@ -0,0 +1,72 @@
+"""
+Script: bench_exclude.py
+
+Compare the ExcludeMatcher with the original per-regex loop over a set of
+synthetic directory paths.
+
+Usage:
+
+$ manage.py runscript bench_exclude --script-args=[path count]
+"""
+
+import random
+import re
+import time
+from os.path import join
+
+from storage.exclude import ExcludeMatcher
+
+# The rules from regen.sh
+RULES = [r"\.git", r"\.svn", r"\.cache", r"\.compiz", r"\.config", r"\.dbus",
+         r"\.ecryptfs", r"\.gconf", r"\.gnome2", r"\.gnome2_private",
+         r"\.gstreamer-0.10", r"\.java", r"\.kde", r"\.local", r"\.mozilla",
+         r"\.mplayer", r"\.pki", r"\.Private", r"\.Skype", r"\.vim",
+         r"VirtualBox VMs"]
+NAMES = ['Photos', '2013', '12Dec', 'Documents', 'src', 'project', 'data',
+         'Music', 'Artist', 'Album', 'home', 'akg', 'backup', 'old']
+
+
+def regex_loop_excluded(regexes, path):
+    """The original Scan exclusion test"""
+    skip = False
+    i = 0
+    while (i < len(regexes)) and not skip:
+        if regexes[i].search(path):
+            skip = True
+        i += 1
+    return skip
+
+
+def synthetic_paths(count):
+    """Answer count directory paths, about 1% of which are excluded"""
+    excluded_names = [re.sub(r'\\(.)', r'\1', rule) for rule in RULES]
+    rnd = random.Random(1)
+    paths = []
+    for i in range(count):
+        depth = rnd.randint(2, 8)
+        components = [rnd.choice(NAMES) for j in range(depth)]
+        if rnd.random() < 0.01:
+            components.append(rnd.choice(excluded_names))
+        paths.append(join('/mnt/samba', *components))
+    return paths
+
+
+def run(*args):
+    count = int(args[0]) if len(args) > 0 else 1000000
+    paths = synthetic_paths(count)
+
+    regexes = [re.compile(rule) for rule in RULES]
+    start = time.time()
+    loop_results = [regex_loop_excluded(regexes, path) for path in paths]
+    loop_time = time.time() - start
+
+    matcher = ExcludeMatcher(RULES)
+    start = time.time()
+    matcher_results = [matcher.child_excluded(path) for path in paths]
+    matcher_time = time.time() - start
+
+    assert loop_results == matcher_results, "Matcher results differ"
+    print("{0} paths, {1} excluded".format(count, sum(loop_results)))
+    print("regex loop:      {0:8.3f}s".format(loop_time))
+    print("ExcludeMatcher:  {0:8.3f}s".format(matcher_time))
+    print("speedup:         {0:8.1f}x".format(loop_time / matcher_time))
@@ -0,0 +1,91 @@
+"""
+Script: bench_hash.py
+
+Compare the original read loop with file_digest()'s mmap hashing, and with
+a pool of threads hashing through mmap, over the files of one or more
+directories, e.g. a local disk and an SMB mount.
+
+Each method should be run with a cold page cache (or over files larger
+than memory) for the disk to be measured rather than the cache, e.g.:
+
+# sync; echo 3 > /proc/sys/vm/drop_caches
+
+Usage:
+
+$ manage.py runscript bench_hash --script-args=path [path...] [threads]
+"""
+
+import hashlib
+import os
+import time
+from multiprocessing.pool import ThreadPool
+from os.path import getsize, isfile, islink, join
+
+from storage.smhash import file_digest
+
+# The number of threads hashing at once
+THREADS = 4
+
+
+def read_loop_digest(fn):
+    """The original smhash() fallback loop"""
+    hasher = hashlib.sha256()
+    with open(fn, 'rb') as fp:
+        while True:
+            buf = fp.read(hasher.block_size * 1024)
+            if len(buf) == 0:
+                break
+            hasher.update(buf)
+    return hasher.hexdigest()
+
+
+def mmap_digest(fn):
+    return file_digest(fn)
+
+
+def path_files(path):
+    """Answer the regular files below path"""
+    files = []
+    for root, dirs, names in os.walk(path):
+        for name in names:
+            fn = join(root, name)
+            if isfile(fn) and not islink(fn):
+                files.append(fn)
+    return files
+
+
+def bench(label, digests, files, nbytes):
+    start = time.time()
+    results = digests(files)
+    elapsed = time.time() - start
+    rate = nbytes / (1024.0 * 1024.0) / elapsed if elapsed > 0 else 0.0
+    print("  {0:16s} {1:8.3f}s {2:8.1f} MB/s".format(label, elapsed, rate))
+    return results
+
+
+def run(*args):
+    paths = list(args)
+    threads = THREADS
+    if len(paths) > 1 and paths[-1].isdigit():
+        threads = int(paths.pop())
+    pool = ThreadPool(threads)
+    try:
+        for path in paths:
+            files = path_files(path)
+            nbytes = sum(getsize(fn) for fn in files)
+            print("{0}: {1} files, {2:.1f} MB".format(
+                path, len(files), nbytes / (1024.0 * 1024.0)))
+            loop_results = bench("read loop:",
+                lambda files: [read_loop_digest(fn) for fn in files],
+                files, nbytes)
+            mmap_results = bench("mmap:",
+                lambda files: [mmap_digest(fn) for fn in files],
+                files, nbytes)
+            thread_results = bench("mmap x{0}:".format(threads),
+                lambda files: pool.map(mmap_digest, files),
+                files, nbytes)
+            assert loop_results == mmap_results == thread_results, \
+                "Digests differ"
+    finally:
+        pool.close()
+        pool.join()
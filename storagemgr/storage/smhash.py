@@ -1,33 +1,669 @@
 import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
 from PIL import Image
+try:
+    # Python 2's hashlib doesn't include BLAKE2
+    import pyblake2
+except ImportError:
+    pyblake2 = None
 
 from logger import init_logging
 logger = init_logging(__name__)
 
-def smhash(fn):
+# The algorithm of digests that don't record one
+DEFAULT_ALGORITHM = 'sha256'
+# Algorithms are named <hashlib algorithm>[+<scheme>...], e.g.
+# 'sha256+jpeg'.  The schemes hash some types of file by their image data
+# without decoding them:
+# jpeg:  JPEGs' compressed streams, see jpeg_digest()
+# media: TIFF based RAWs' image data and MP4/MOV media data,
+#        see media_digest()
+JPEG_SCHEME = 'jpeg'
+MEDIA_SCHEME = 'media'
+SCHEMES = [JPEG_SCHEME, MEDIA_SCHEME]
+# JPEG markers
+SOI = b'\xff\xd8'
+EOI = 0xd9
+SOS = 0xda
+COM = 0xfe
+# TIFF based RAW types hashed by the media scheme
+RAW_TYPES = ['.cr2', '.nef', '.nrw', '.dng', '.arw', '.pef', '.srw']
+# The number of bytes read to identify the type of a file
+SNIFF_SIZE = 16
+# (offset, magic number, type) identifying the type of a file, see sniff()
+MAGICS = [(0, b'\xff\xd8\xff', 'jpeg'),
+          (0, b'\x89PNG\r\n\x1a\n', 'png'),
+          (0, b'GIF87a', 'gif'),
+          (0, b'GIF89a', 'gif'),
+          (0, b'II*\x00', 'tiff'),
+          (0, b'MM\x00*', 'tiff'),
+          (0, b'BM', 'bmp'),
+          (8, b'WEBP', 'webp'),
+          (8, b'AVI ', 'avi'),
+          (8, b'WAVE', 'wav'),
+          (0, b'\x00\x00\x01\xba', 'mpeg'),
+          (0, b'\x1a\x45\xdf\xa3', 'mkv'),
+          (0, b'ID3', 'mp3'),
+          (0, b'OggS', 'ogg'),
+          (0, b'fLaC', 'flac'),
+          (0, b'PK\x03\x04', 'zip'),
+          (0, b'\x1f\x8b', 'gzip'),
+          (0, b'7z\xbc\xaf\x27\x1c', '7z'),
+          (0, b'Rar!', 'rar'),
+          (0, b'%PDF', 'pdf'),
+          (0, b'\x7fELF', 'elf')]
+# The types that PIL can't open, which are hashed as files without trying
+FILE_TYPES = ['mp4', 'avi', 'wav', 'mpeg', 'mkv', 'mp3', 'ogg', 'flac',
+              'zip', 'gzip', '7z', 'rar', 'pdf', 'elf']
+# The types hashed by the media scheme
+MEDIA_TYPES = ['raw', 'mp4']
+# TIFF headers and tags
+TIFF_HEADERS = {b'II*\x00': '<', b'MM\x00*': '>'}
+STRIP_OFFSETS = 273
+STRIP_BYTE_COUNTS = 279
+TILE_OFFSETS = 324
+TILE_BYTE_COUNTS = 325
+SUB_IFDS = 330
+# TIFF type: struct format
+TIFF_TYPES = {3: 'H', 4: 'I', 13: 'I'}
+# The maximum number of IFDs followed
+MAX_IFDS = 64
+# The top level atoms that identify an MP4 / QuickTime file
+MP4_ATOMS = [b'ftyp', b'moov', b'mdat', b'free', b'skip', b'wide', b'pnot']
+# The size of each read of the ranges hashed by media_digest()
+RANGE_READ = 1024 * 1024
+# The number of rows (and bits per row) of a dhash()
+DHASH_SIZE = 8
+# The largest JPEG draft decoded by image_dhash()
+DHASH_DRAFT = (128, 128)
+# The resampling filter of dhash(), ANTIALIAS was removed in Pillow 10
+if hasattr(Image, 'LANCZOS'):
+    DHASH_RESAMPLE = Image.LANCZOS
+else:
+    DHASH_RESAMPLE = Image.ANTIALIAS
+
+# The hashing times of the current thread, see pop_hash_times()
+_hash_times = threading.local()
+
+# The size of each block read by fingerprint()
+FINGERPRINT_BLOCK = 64 * 1024
+# The approximate size of each strip of image data hashed by image_digest()
+STRIP_BYTES = 4 * 1024 * 1024
+# The size of each read of a strip decoded by decode_strip()
+STRIP_READ = 64 * 1024
+# decode_strip() uses PIL's (private) decoder interface, as
+# ImageFile.load() does.  Without it images are always decoded at once.
+STRIP_DECODING = hasattr(Image, '_getdecoder')
+# Files of at least this size are hashed through mmap by file_digest()
+MMAP_MIN_SIZE = 1024 * 1024
+# The size of each slice of a mapped file passed to the hasher.
+# hashlib releases the GIL while hashing large buffers.
+MMAP_CHUNK = 1024 * 1024
+
+
+def split_algorithm(algorithm):
+    """Answer the (hashlib algorithm, list of schemes) of algorithm"""
+    names = algorithm.split('+')
+    return names[0], names[1:]
+
+
+def join_algorithm(algorithm, schemes):
+    """Answer the name of algorithm with the supplied schemes"""
+    return '+'.join([algorithm] + [scheme for scheme in SCHEMES
+                                   if scheme in schemes])
+
+
+def applied_schemes(fn, algorithm):
+    """Answer the set of algorithm's schemes that may hash fn differently
+    to its hashlib algorithm alone"""
+    base, schemes = split_algorithm(algorithm)
+    applied = set()
+    if len(schemes) == 0:
+        return applied
+    ftype = file_type(fn)
+    if JPEG_SCHEME in schemes and ftype == 'jpeg':
+        applied.add(JPEG_SCHEME)
+    if MEDIA_SCHEME in schemes and ftype in MEDIA_TYPES:
+        applied.add(MEDIA_SCHEME)
+    return applied
+
+
+def new_hasher(algorithm=DEFAULT_ALGORITHM):
+    """Answer a new hashlib object for the named algorithm,
+    e.g. 'sha256' or 'blake2b'"""
+    try:
+        return hashlib.new(algorithm)
+    except ValueError:
+        if pyblake2 is not None and algorithm in ('blake2b', 'blake2s'):
+            return getattr(pyblake2, algorithm)()
+        raise
+
+
+def smhash(fn, budget=None, algorithm=DEFAULT_ALGORITHM, dhashes=None):
     """Try and return the hash of just the image data.
-    If not, the entire file."""
+    If not, the entire file.
+
+    If the algorithm has the JPEG_SCHEME, JPEGs are hashed by their
+    compressed image data (see jpeg_digest()) rather than decoded.
+    If it has the MEDIA_SCHEME, RAWs and videos are hashed by their image
+    and media data (see media_digest()) rather than the entire file.
+
+    The type of the file is identified from its first bytes (see sniff())
+    so that files PIL can't open are hashed without trying.  The file is
+    only opened once.  The time taken is recorded by type, see
+    pop_hash_times().
+
+    If dhashes (a dictionary) is supplied and the image is decoded, its
+    dhash() is added as dhashes[fn], so that it needn't be decoded again.
+
+    If budget (an IOBudget) is supplied, reads are charged to it."""
+
+    start = time.time()
+    algorithm, schemes = split_algorithm(algorithm)
+    with open(fn, 'rb') as fp:
+        if budget is not None:
+            # Decoding the image reads (at least) the entire file
+            budget.consume(os.fstat(fp.fileno()).st_size)
+        read_start = time.time()
+        ftype = sniff(fp.read(SNIFF_SIZE), fn)
+        if budget is not None:
+            # Reading the header is a single, I/O bound, read
+            budget.record_latency(time.time() - read_start)
+        digest, method = typed_digest(fp, ftype, schemes, algorithm, budget,
+                                      dhashes)
+    logger.debug("{0} {1} digest: {2} -> {3}".format(ftype, method, fn,
+                                                     digest))
+    record_hash_time(ftype, method, time.time() - start)
+    return digest
 
+
+def typed_digest(fp, ftype, schemes, algorithm, budget=None, dhashes=None):
+    """Answer the (digest, method) of the open file fp of type ftype.
+    method is one of 'stream' (jpeg_digest()), 'media' (media_digest()),
+    'image' (image_digest()) or 'file' (the entire file).
+    See smhash() for dhashes."""
+    if ftype == 'jpeg' and JPEG_SCHEME in schemes:
+        digest = jpeg_digest(fp, algorithm)
+        if digest is not None:
+            return digest, 'stream'
+    if ftype in MEDIA_TYPES and MEDIA_SCHEME in schemes:
+        digest = media_digest(fp, ftype, algorithm)
+        if digest is not None:
+            return digest, 'media'
+    if ftype not in FILE_TYPES:
+        fp.seek(0)
+        try:
+            img = Image.open(fp)
+            digest = image_digest(img, algorithm)
+            if dhashes is not None:
+                dhashes[fp.name] = dhash(img)
+            return digest, 'image'
+        except IOError:
+            pass
+    return stream_digest(fp, budget, algorithm=algorithm), 'file'
+
+
+def sniff(header, fn):
+    """Answer the type of fn from its first SNIFF_SIZE bytes, header,
+    e.g. 'jpeg', 'raw' (a TIFF based RAW) or 'mp4', or 'unknown'"""
+    for offset, magic, ftype in MAGICS:
+        if header[offset:offset+len(magic)] == magic:
+            if ftype == 'tiff' and \
+                    os.path.splitext(fn)[1].lower() in RAW_TYPES:
+                return 'raw'
+            return ftype
+    if header[4:8] in MP4_ATOMS:
+        return 'mp4'
+    return 'unknown'
+
+
+def file_type(fn):
+    """Answer the type of fn, see sniff()"""
+    with open(fn, 'rb') as fp:
+        return sniff(fp.read(SNIFF_SIZE), fn)
+
+
+def record_hash_time(ftype, method, seconds):
+    """Add seconds to the time the current thread has spent hashing
+    files of ftype with method"""
+    times = getattr(_hash_times, 'times', None)
+    if times is None:
+        times = {}
+        _hash_times.times = times
+    key = "{0}/{1}".format(ftype, method)
+    files, total = times.get(key, (0, 0.0))
+    times[key] = (files + 1, total + seconds)
+    return
+
+
+def pop_hash_times():
+    """Answer the {'type/method': (files, seconds)} hashed by smhash() in
+    the current thread since the last call"""
+    times = getattr(_hash_times, 'times', None) or {}
+    _hash_times.times = {}
+    return times
+
+
+def file_digest(fn, budget=None, use_mmap=True,
+                algorithm=DEFAULT_ALGORITHM):
+    """Answer the digest of the entire file, see stream_digest()"""
+    with open(fn, 'rb') as fp:
+        return stream_digest(fp, budget, use_mmap, algorithm)
+
+
+def stream_digest(fp, budget=None, use_mmap=True,
+                  algorithm=DEFAULT_ALGORITHM):
+    """Answer the digest of the entire open file fp.
+
+    Large files are mapped and hashed through memoryview slices, avoiding
+    copying each block in to a new string.  Read latency can't be measured
+    through page faults, so files are read if the budget adapts to it."""
+    if budget is not None and budget.latency_target is not None:
+        use_mmap = False
+    if use_mmap and os.fstat(fp.fileno()).st_size >= MMAP_MIN_SIZE:
+        try:
+            mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError) as e:
+            # E.g. a file system that doesn't support mmap
+            logger.debug("Unable to mmap {0}: {1}".format(fp.name, e))
+        else:
+            try:
+                return mapped_digest(mapped, budget, algorithm)
+            finally:
+                mapped.close()
+    fp.seek(0)
+    hasher = new_hasher(algorithm)
+    read_size = hasher.block_size * 1024
+    while True:
+        if budget is not None:
+            budget.consume(0)
+            start = time.time()
+        buf = fp.read(read_size)
+        if budget is not None:
+            budget.record_latency(time.time() - start)
+        if len(buf) == 0:
+            break
+        hasher.update(buf)
+    return hasher.hexdigest()
+
+
+def mapped_digest(mapped, budget=None, algorithm=DEFAULT_ALGORITHM):
+    """Answer the digest of the supplied mmap"""
+    hasher = new_hasher(algorithm)
+    size = len(mapped)
     try:
-        img = Image.open(fn)
-        img_data = img.tobytes()
-        hasher = hashlib.sha256()
-        hasher.update(img_data)
-        digest = hasher.hexdigest()
-        logger.debug("Successfully used image digest: {0} -> {1}".format(
-            fn, digest))
-    except IOError:
-        digest = None
-    if digest is None:
-        hasher = hashlib.sha256()
-        read_size = hasher.block_size * 1024
-        with open(fn, 'rb') as fp:
+        view = memoryview(mapped)
+    except TypeError:
+        # Python 2 mmaps only support the old buffer interface
+        view = None
+    try:
+        for offset in range(0, size, MMAP_CHUNK):
+            if budget is not None:
+                budget.consume(0)
+            if view is not None:
+                hasher.update(view[offset:offset+MMAP_CHUNK])
+            else:
+                hasher.update(buffer(mapped, offset, MMAP_CHUNK))
+    finally:
+        if view is not None:
+            # The mmap can't be closed while exported
+            view.release()
+    return hasher.hexdigest()
+
+
+def image_digest(img, algorithm=DEFAULT_ALGORITHM):
+    """Answer the digest of img.tobytes().
+
+    Images stored in separately decodable strips or tiles, e.g. TIFFs
+    that PIL decodes itself, are decoded and hashed a strip (or row of
+    tiles) at a time (see image_strips()), so only one strip is held in
+    memory.  Other images are decoded at once by load() and hashed in
+    horizontal strips of about STRIP_BYTES, rather than creating the
+    bytes of the entire image (which tobytes() assembles from a list of
+    chunks, i.e. twice over).  The raw encoding is row by row, so the
+    concatenated strips are identical to tobytes()."""
+    strips = image_strips(img)
+    if strips is not None:
+        hasher = new_hasher(algorithm)
+        try:
+            for top, bottom, tiles in strips:
+                hasher.update(decode_strip(img, top, bottom, tiles).tobytes())
+            return hasher.hexdigest()
+        except (AttributeError, TypeError) as e:
+            # PIL's decoder interface has changed
+            logger.debug("Unable to decode strips, decoding at once: "
+                         "{0}".format(e))
+    hasher = new_hasher(algorithm)
+    img.load()
+    width, height = img.size
+    if width > 0 and height > 0:
+        row_bytes = len(img.crop((0, 0, width, 1)).tobytes())
+        strip_height = max(1, STRIP_BYTES // max(1, row_bytes))
+        for top in range(0, height, strip_height):
+            bottom = min(height, top + strip_height)
+            hasher.update(img.crop((0, top, width, bottom)).tobytes())
+    return hasher.hexdigest()
+
+
+def image_strips(img):
+    """Answer the list of (top, bottom, tiles) of the horizontal strips of
+    the unloaded image img that can be decoded separately, or None if
+    it is decoded at once, e.g. PNGs, JPEGs and TIFFs decoded by
+    libtiff, which have a single tile."""
+    if not STRIP_DECODING or len(getattr(img, 'tile', None) or []) < 2:
+        return None
+    rows = {}
+    for tile in img.tile:
+        decoder_name, extents = tile[0], tile[1]
+        if decoder_name == 'libtiff' or extents is None:
+            return None
+        rows.setdefault((extents[1], extents[3]), []).append(tile)
+    strips = []
+    top = 0
+    for (strip_top, bottom), tiles in sorted(rows.items()):
+        if strip_top != top:
+            # Overlapping or missing rows
+            return None
+        strips.append((top, bottom, tiles))
+        top = bottom
+    if top != img.size[1]:
+        return None
+    return strips
+
+
+def decode_strip(img, top, bottom, tiles):
+    """Answer the image of rows top to bottom of img, decoded from its
+    tiles covering them, as ImageFile.load() decodes the entire image"""
+    strip = Image.new(img.mode, (img.size[0], bottom - top))
+    for decoder_name, extents, offset, args in tiles:
+        decoder = Image._getdecoder(img.mode, decoder_name, args,
+                                    getattr(img, 'decoderconfig', ()))
+        try:
+            decoder.setimage(strip.im, (extents[0], extents[1] - top,
+                                        extents[2], extents[3] - top))
+            img.fp.seek(offset)
+            data = b''
             while True:
-                buf = fp.read(read_size)
-                if len(buf) == 0:
-                    break  
-                hasher.update(buf)
-        digest = hasher.hexdigest()
-        logger.debug("Fallback file digest: {0} -> {1}".format(fn, digest))
-    return digest
+                chunk = img.fp.read(STRIP_READ)
+                if not chunk:
+                    raise IOError("image file is truncated")
+                data = data + chunk
+                consumed, err = decoder.decode(data)
+                if consumed < 0:
+                    break
+                data = data[consumed:]
+            if err < 0:
+                raise IOError("decoder error {0}".format(err))
+        finally:
+            decoder.cleanup()
+    return strip
+
+
+def dhash(img):
+    """Answer the difference hash of the PIL image img, or None if it
+    can't be converted.
+
+    The image is reduced to (DHASH_SIZE + 1) x DHASH_SIZE grey pixels and
+    each bit is whether a pixel is brighter than its right neighbour.
+    Resized and re-encoded copies of an image have dhashes a small
+    hamming distance apart (see hamming()).  The 64 bits are answered as
+    a signed integer, to fit a BigIntegerField."""
+    try:
+        small = img.convert('L').resize((DHASH_SIZE + 1, DHASH_SIZE),
+                                        DHASH_RESAMPLE)
+    except (IOError, ValueError) as e:
+        logger.debug("Unable to dhash image: {0}".format(e))
+        return None
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(DHASH_SIZE):
+        for col in range(DHASH_SIZE):
+            offset = row * (DHASH_SIZE + 1) + col
+            value = (value << 1) | int(pixels[offset] > pixels[offset + 1])
+    if value >= 1 << 63:
+        value -= 1 << 64
+    return value
+
+
+def image_dhash(fn):
+    """Answer the dhash() of the image fn, or None if it isn't an image.
+    JPEGs are decoded at a reduced size."""
+    try:
+        with Image.open(fn) as img:
+            img.draft('L', DHASH_DRAFT)
+            return dhash(img)
+    except IOError:
+        return None
+
+
+def hamming(a, b):
+    """Answer the number of bits that differ between the dhashes a and b"""
+    return bin((a ^ b) & 0xffffffffffffffff).count('1')
+
+
+def fingerprint(fn, size=None, budget=None):
+    """Answer a cheap fingerprint of the contents of fn: the sha256 of its
+    size and its first, middle and last FINGERPRINT_BLOCK bytes (all of it
+    if smaller).
 
+    Files with different fingerprints have different contents, files with
+    the same fingerprint probably have the same contents."""
+    if size is None:
+        size = os.path.getsize(fn)
+    hasher = hashlib.sha256()
+    hasher.update(str(size).encode('ascii'))
+    if size <= 3 * FINGERPRINT_BLOCK:
+        blocks = [(0, size)]
+    else:
+        blocks = [(0, FINGERPRINT_BLOCK),
+                  ((size - FINGERPRINT_BLOCK) // 2, FINGERPRINT_BLOCK),
+                  (size - FINGERPRINT_BLOCK, FINGERPRINT_BLOCK)]
+    with open(fn, 'rb') as fp:
+        for offset, length in blocks:
+            if budget is not None:
+                budget.consume(length)
+            fp.seek(offset)
+            hasher.update(fp.read(length))
+    return hasher.hexdigest()
+
+
+def jpeg_digest(fp, algorithm=DEFAULT_ALGORITHM):
+    """Answer the digest of the compressed image data of the open JPEG fp,
+    or None if it isn't a well formed JPEG.
+
+    The marker segments, e.g. SOF, DHT, DQT and SOS, and the entropy coded
+    data of each scan are hashed.  The APPn (Exif, XMP, etc.) and COM
+    segments are skipped, so changing the metadata, e.g. keywords, doesn't
+    change the digest, and the image isn't decoded."""
+    fp.seek(0)
+    data = fp.read()
+    if data[:2] != SOI:
+        return None
+    hasher = new_hasher(algorithm)
+    size = len(data)
+    pos = 2
+    while True:
+        if pos + 2 > size or data[pos:pos+1] != b'\xff':
+            # Truncated or corrupt
+            return None
+        marker = struct.unpack('>B', data[pos+1:pos+2])[0]
+        if marker == 0xff:
+            # Fill byte
+            pos += 1
+            continue
+        if marker == EOI:
+            hasher.update(data[pos:pos+2])
+            break
+        if 0xd0 <= marker <= 0xd7 or marker == 0x01:
+            # RSTn and TEM have no segment
+            hasher.update(data[pos:pos+2])
+            pos += 2
+            continue
+        if pos + 4 > size:
+            return None
+        end = pos + 2 + struct.unpack('>H', data[pos+2:pos+4])[0]
+        if end > size:
+            return None
+        if not (0xe0 <= marker <= 0xef or marker == COM):
+            hasher.update(data[pos:end])
+        pos = end
+        if marker == SOS:
+            scan_end = entropy_end(data, pos)
+            if scan_end is None:
+                return None
+            hasher.update(data[pos:scan_end])
+            pos = scan_end
+    return hasher.hexdigest()
+
+
+def entropy_end(data, pos):
+    """Answer the position of the marker following the entropy coded data
+    starting at pos, or None if there isn't one.  Stuffed 0xff00 bytes and
+    restart markers are part of the data."""
+    size = len(data)
+    while True:
+        pos = data.find(b'\xff', pos)
+        if pos < 0 or pos + 1 >= size:
+            return None
+        following = struct.unpack('>B', data[pos+1:pos+2])[0]
+        if following == 0 or 0xd0 <= following <= 0xd7:
+            pos += 2
+            continue
+        return pos
+
+
+def media_digest(fp, ftype, algorithm=DEFAULT_ALGORITHM):
+    """Answer the digest of the image data of a TIFF based RAW (ftype
+    'raw'), or the media data of an MP4 / QuickTime file ('mp4'), or None
+    if the open file fp is malformed.
+
+    Only the data is read, by seeking to it, so editing the metadata
+    doesn't change the digest."""
+    size = os.fstat(fp.fileno()).st_size
+    if ftype == 'raw':
+        ranges = tiff_ranges(fp, size)
+    else:
+        ranges = mp4_ranges(fp, size)
+    if not ranges:
+        return None
+    hasher = new_hasher(algorithm)
+    for offset, length in ranges:
+        fp.seek(offset)
+        while length > 0:
+            buf = fp.read(min(length, RANGE_READ))
+            if len(buf) == 0:
+                return None
+            hasher.update(buf)
+            length -= len(buf)
+    return hasher.hexdigest()
+
+
+def tiff_ranges(fp, size):
+    """Answer the list of (offset, length) of the strips and tiles of each
+    IFD (and sub-IFD) of the TIFF fp, or None if it's malformed"""
+    fp.seek(0)
+    header = fp.read(8)
+    endian = TIFF_HEADERS.get(header[:4])
+    if endian is None or len(header) < 8:
+        return None
+    pending = [struct.unpack(endian + 'I', header[4:8])[0]]
+    seen = set()
+    ranges = []
+    while len(pending) > 0 and len(seen) < MAX_IFDS:
+        ifd = pending.pop(0)
+        if ifd == 0 or ifd in seen:
+            continue
+        if ifd + 2 > size:
+            return None
+        seen.add(ifd)
+        fp.seek(ifd)
+        count = struct.unpack(endian + 'H', fp.read(2))[0]
+        entries = fp.read(count * 12 + 4)
+        if len(entries) < count * 12 + 4:
+            return None
+        tags = {}
+        for i in range(count):
+            tag, tiff_type, n, value = struct.unpack(endian + 'HHI4s',
+                entries[i*12:(i+1)*12])
+            if tag in (STRIP_OFFSETS, STRIP_BYTE_COUNTS, TILE_OFFSETS,
+                       TILE_BYTE_COUNTS, SUB_IFDS):
+                tags[tag] = tiff_values(fp, endian, tiff_type, n, value,
+                                        size)
+                if tags[tag] is None:
+                    return None
+        for offsets_tag, counts_tag in ((STRIP_OFFSETS, STRIP_BYTE_COUNTS),
+                                        (TILE_OFFSETS, TILE_BYTE_COUNTS)):
+            offsets = tags.get(offsets_tag, [])
+            counts = tags.get(counts_tag, [])
+            if len(offsets) != len(counts):
+                return None
+            for offset, length in zip(offsets, counts):
+                if offset + length > size:
+                    return None
+                ranges.append((offset, length))
+        pending.extend(tags.get(SUB_IFDS, []))
+        pending.append(struct.unpack(endian + 'I', entries[-4:])[0])
+    return ranges
+
+
+def tiff_values(fp, endian, tiff_type, n, value, size):
+    """Answer the list of n values of the IFD entry, or None"""
+    fmt = TIFF_TYPES.get(tiff_type)
+    if fmt is None:
+        return None
+    length = n * struct.calcsize(fmt)
+    if length <= 4:
+        data = value[:length]
+    else:
+        offset = struct.unpack(endian + 'I', value)[0]
+        if offset + length > size:
+            return None
+        fp.seek(offset)
+        data = fp.read(length)
+    return list(struct.unpack(endian + fmt * n, data))
+
+
+def mp4_ranges(fp, size):
+    """Answer the list of (offset, length) of the payload of each top
+    level mdat atom of the MP4 / QuickTime fp, or None if it's malformed.
+    The other atoms, e.g. moov (including udta) are metadata."""
+    ranges = []
+    offset = 0
+    while offset + 8 <= size:
+        fp.seek(offset)
+        header = fp.read(16)
+        atom_size, atom_type = struct.unpack('>I4s', header[:8])
+        header_size = 8
+        if atom_size == 1:
+            if len(header) < 16:
+                return None
+            atom_size = struct.unpack('>Q', header[8:16])[0]
+            header_size = 16
+        elif atom_size == 0:
+            # The last atom extends to the end of the file
+            atom_size = size - offset
+        if atom_size < header_size or offset + atom_size > size:
+            return None
+        if atom_type == b'mdat':
+            ranges.append((offset + header_size, atom_size - header_size))
+        offset += atom_size
+    return ranges
+
+
+def image_digested(fn, algorithm=DEFAULT_ALGORITHM):
+    """Answer a boolean indicating whether smhash() answers the digest of
+    fn's image or media data (rather than the entire file).
+    Only reads the header."""
+    if len(applied_schemes(fn, algorithm)) > 0:
+        return True
+    if file_type(fn) in FILE_TYPES:
+        return False
+    try:
+        Image.open(fn).close()
+    except IOError:
+        return False
+    return True
@@ -9,7 +9,7 @@ from datetime import datetime
 from django.conf import settings
 from django.test import TestCase
 
-from storage.models import RootPath, File, Hash
+from storage.models import RootPath, RelPath, File, Hash, Keyword
 from storage.scan import QuickScan
 from storage.archiver import Archiver, ImageArchiver, VideoArchiver
 
@@ -18,6 +18,11 @@ class ArchiveTests(TestCase):
     fixtures = ['initial_data']
 
     def setUp(self):
+        # Each test's rows are rolled back, so don't reuse cached ids
+        Hash.clear_cache()
+        RootPath.clear_cache()
+        RelPath.clear_cache()
+        Keyword.clear_cache()
         # Get tmp directory
         tmpdirs = ['/run/shm', '/tmp']
         self.tmpdir = None
@@ -157,6 +162,11 @@ class ImageArchiveTests(TestCase):
     fixtures = ['initial_data']
 
     def setUp(self):
+        # Each test's rows are rolled back, so don't reuse cached ids
+        Hash.clear_cache()
+        RootPath.clear_cache()
+        RelPath.clear_cache()
+        Keyword.clear_cache()
         # Get tmp directory
         tmpdirs = ['/run/shm', '/tmp']
         self.tmpdir = None
@@ -319,6 +329,11 @@ class VideoArchiveTests(TestCase):
     fixtures = ['initial_data']
 
     def setUp(self):
+        # Each test's rows are rolled back, so don't reuse cached ids
+        Hash.clear_cache()
+        RootPath.clear_cache()
+        RelPath.clear_cache()
+        Keyword.clear_cache()
         # Get tmp directory
         tmpdirs = ['/run/shm', '/tmp']
         self.tmpdir = None
@@ -1,20 +1,45 @@
 """
 Test the core storagemgr functionality - scanning and maintaing the archive
 """
+import re
+import time
 from shutil import copy2, rmtree
-from os.path import isdir, join
-from os import makedirs, remove
+from os.path import isdir, isfile, join
+from os import makedirs, remove, rename, utime
+from struct import pack
+from PIL import Image, TiffImagePlugin
 
 from django.conf import settings
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import override_settings
+from django.test.utils import CaptureQueriesContext
 
-from storage.models import RootPath, File
-from storage.scan import QuickScan
+from storage.models import RootPath, RelPath, File, ExcludeDir
+from storage.models import ScanRun, ScanRunDir, Hash, Keyword
+from storage.models import KeywordSync
+from storage.scan import QuickScan, FullScan, DirListing, shard_top
+from storage.scan import ScanFailed
+from storage.parallel import root_shards
+from storage.exclude import ExcludeMatcher
+from storage import smhash
+from storage.hashcache import cached_smhash, hash_cache, content_stats
+from storage.throttle import IOBudget
+from storage.batch import TransactionBatch
+from storage.metrics import PROMETHEUS_FILE, previous_report
+from storage.rehash import HashMigration
+from storage.nearindex import MultiIndex, near_clusters
+from storage.watcher import RootWatcher, PollingWatcher
 
 class StorageTests(TestCase):
     fixtures = ['initial_data']
     
     def setUp(self):
+        # Each test's rows are rolled back, so don't reuse cached ids
+        Hash.clear_cache()
+        RootPath.clear_cache()
+        RelPath.clear_cache()
+        Keyword.clear_cache()
         # Get tmp directory
         tmpdirs = ['/run/shm', '/tmp']
         self.tmpdir = None
@@ -78,3 +103,747 @@ class StorageTests(TestCase):
         self.assertEqual(File.objects.filter(
                             name='image2.png', deleted__isnull=True).count(), 1)
         return
+
+
+    def test_worker_scan(self):
+        """Check:
+        1. Scanning with a worker pool produces the same digests.
+        """
+        copy2(join(self.test_data, "archive1", "image3.png"), self.rootdir)
+        scanner = QuickScan(workers=2)
+        scanner.scan()
+        self.assertEqual(File.objects.all().count(), 3)
+        i1 = File.objects.get(name='image1.png')
+        self.assertEqual(i1.hash.digest,
+                         '4511e4bd5136a1c1491abfbc2221ffcc37c77f3d1213a41b2d3ea9e87ac6549c')
+        i3 = File.objects.get(name='image3.png')
+        self.assertEqual(i3.hash.digest,
+                         '2c2ddf743172fd763dcb71a17e699481d1eb568cfdb0443a1c7a229f64865983')
+        return
+
+
+    def test_unchanged_rescan_queries(self):
+        """Check:
+        1. Rescanning an unchanged directory only reads its files, i.e. one
+           query per directory (the directories are read at the start).
+        """
+        scanner = QuickScan()
+        with CaptureQueriesContext(connection) as one_dir:
+            scanner.scan()
+        for i in range(3):
+            makedirs(join(self.rootdir, "dir{0}".format(i)))
+        scanner.scan()
+        with CaptureQueriesContext(connection) as four_dirs:
+            scanner.scan()
+        self.assertEqual(len(four_dirs) - len(one_dir), 3 * 1)
+        return
+
+
+    def test_skip_unchanged_dirs(self):
+        """Check:
+        1. The files of a directory with an unchanged mtime aren't checked.
+        2. They are checked when it is the directory's turn to be verified.
+        """
+        old_time = (1000000000, 1000000000)
+        utime(self.rootdir, old_time)
+        QuickScan().scan()
+        # Modifying a file doesn't change the directory
+        copy2(self.image1_src, self.image2)
+        utime(self.rootdir, old_time)
+        QuickScan(skip_unchanged_dirs=True, verify_every=0).scan()
+        i2 = File.objects.get(name='image2.png', deleted=None)
+        self.assertEqual(i2.hash.digest,
+                         '26a2ca1108565fb5df7b4a70660c5017334c7c8074c5528492a679859c119121')
+        QuickScan(skip_unchanged_dirs=True, verify_every=1).scan()
+        i2 = File.objects.get(name='image2.png', deleted=None)
+        self.assertEqual(i2.hash.digest,
+                         '4511e4bd5136a1c1491abfbc2221ffcc37c77f3d1213a41b2d3ea9e87ac6549c')
+        return
+
+
+    def test_unchanged_dir_not_stated(self):
+        """Check:
+        1. The files of a directory counted as unchanged are never stat'd.
+        """
+        old_time = (1000000000, 1000000000)
+        utime(self.rootdir, old_time)
+        QuickScan().scan()
+        stated = []
+        stat_entry = DirListing.stat_entry
+
+        def record_stat(entry):
+            stated.append(entry.name)
+            return stat_entry(entry)
+
+        DirListing.stat_entry = staticmethod(record_stat)
+        try:
+            scanner = QuickScan(skip_unchanged_dirs=True, verify_every=0)
+            scanner.scan()
+        finally:
+            DirListing.stat_entry = staticmethod(stat_entry)
+        self.assertEqual(scanner.metrics.totals().counters['dirs_skipped'], 1)
+        self.assertEqual(stated, [])
+        return
+
+
+    def test_watcher_process(self):
+        """Check:
+        1. A new file reported by the watcher is added.
+        2. A removed file reported by the watcher is marked deleted.
+        """
+        root_watcher = RootWatcher(PollingWatcher())
+        root_watcher.start()
+        image3 = join(self.rootdir, "image3.png")
+        copy2(join(self.test_data, "archive1", "image3.png"), image3)
+        root_watcher.process(image3, False)
+        self.assertEqual(File.objects.filter(name='image3.png').count(), 1)
+        remove(self.image2)
+        root_watcher.process(self.image2, False)
+        i2 = File.objects.get(name='image2.png')
+        self.assertIsNotNone(i2.deleted)
+        return
+
+
+    def test_watcher_roots(self):
+        """Check:
+        1. A path is processed with the longest root path containing it.
+        2. Directories created unseen are watched after an overflow.
+        3. A failed event doesn't stop the watcher.
+        """
+        nested = join(self.rootdir, "nested")
+        makedirs(nested)
+        nested_root = RootPath(path=nested)
+        nested_root.save()
+        watcher = PollingWatcher()
+        root_watcher = RootWatcher(watcher)
+        root_watcher.start()
+        self.assertEqual(root_watcher.root_path(join(nested, "image3.png")),
+                         nested_root)
+        self.assertEqual(root_watcher.root_path(self.image2), self.rootpath)
+        subdir = join(self.rootdir, "subdir")
+        makedirs(subdir)
+        self.assertNotIn(subdir, watcher.snapshots)
+        root_watcher.overflowed()
+        self.assertIn(subdir, watcher.snapshots)
+        # A file that has gone before it is processed is logged and skipped
+        root_watcher.handle(root_watcher.process_file, self.rootpath,
+                            join(self.rootdir, "missing.png"))
+        return
+
+
+    def test_excluded_dir(self):
+        """Check:
+        1. Excluded directories aren't added, or their files scanned.
+        """
+        ExcludeDir(regex=r"\.git", root_path=self.rootpath).save()
+        git_dir = join(self.rootdir, ".git")
+        makedirs(join(git_dir, "objects"))
+        copy2(self.image1_src, join(git_dir, "objects", "git1.png"))
+        scanner = QuickScan()
+        scanner.scan()
+        self.assertEqual(RelPath.objects.filter(path__contains=".git").count(), 0)
+        self.assertEqual(File.objects.filter(name="git1.png").count(), 0)
+        return
+
+
+    def test_exclude_matcher(self):
+        """Check:
+        1. The matcher excludes the same directories as searching for each
+           of the regen.sh rules in the absolute path.
+        2. A directory's parents are excluded before it.
+        """
+        with open(join(settings.PROJECT_DIR, 'regen.sh')) as fp:
+            rules = re.findall(r'exclude_dir "(.*)"', fp.read())
+        rules.append(r"/tmp/[0-9]+$")
+        self.assertGreater(len(rules), 20)
+        matcher = ExcludeMatcher(rules)
+        regexes = [re.compile(rule) for rule in rules]
+        names = ['.git', 'project.git', '.gitfoo', '.gnome2', '.gnome2_private',
+                 '.gnome', 'VirtualBox VMs', 'Old VirtualBox VMs2', 'Photos',
+                 'git', 'java', '123', 'tmp']
+        for parent in ['/mnt/samba', '/mnt/samba/.svn', '/tmp']:
+            for name in names:
+                path = join(parent, name)
+                expected = any(regex.search(path) for regex in regexes)
+                self.assertEqual(matcher.excluded(path), expected, msg=path)
+                if not matcher.excluded(parent):
+                    self.assertEqual(matcher.child_excluded(path), expected,
+                                     msg=path)
+        return
+
+
+    def test_resume_scan(self):
+        """Check:
+        1. Resuming a scan skips the directories already completed.
+        2. The next scan picks up the changes.
+        """
+        run = ScanRun(root=self.rootpath, full=False)
+        run.save()
+        rel_path = RelPath.getrelpath(self.rootdir, root_path=self.rootpath)
+        ScanRunDir(run=run, path=rel_path).save()
+        copy2(join(self.test_data, "archive1", "image3.png"), self.rootdir)
+        QuickScan(resume=True).scan()
+        self.assertEqual(File.objects.filter(name='image3.png').count(), 0)
+        self.assertIsNotNone(ScanRun.objects.get(pk=run.pk).finished)
+        QuickScan(resume=True).scan()
+        self.assertEqual(File.objects.filter(name='image3.png').count(), 1)
+        return
+
+
+    def test_resume_full_scan(self):
+        """Check:
+        1. A completed quick scan keeps an interrupted full scan's progress.
+        """
+        run = ScanRun(root=self.rootpath, full=True)
+        run.save()
+        rel_path = RelPath.getrelpath(self.rootdir, root_path=self.rootpath)
+        ScanRunDir(run=run, path=rel_path).save()
+        QuickScan().scan()
+        self.assertEqual(ScanRun.objects.filter(pk=run.pk).count(), 1)
+        self.assertEqual(ScanRunDir.objects.filter(run=run).count(), 1)
+        return
+
+
+    def test_failed_scan(self):
+        """Check:
+        1. A directory that can't be scanned fails the scan.
+        2. The run is left unfinished, so it can be resumed.
+        """
+        def fail(*args):
+            raise ValueError("fail")
+
+        scanner = QuickScan()
+        scanner.scan_dir = fail
+        self.assertRaises(ScanFailed, scanner.scan)
+        self.assertEqual(len(scanner.failed), 1)
+        self.assertEqual(ScanRun.objects.filter(root=self.rootpath,
+                                                finished=None).count(), 1)
+        return
+
+
+    def test_io_budget(self):
+        """Check:
+        1. A budgeted scan produces the same digests.
+        2. High read latency halves the adaptive factor.
+        3. Without rate limits, a latency target spaces out the reads.
+        """
+        self.rootpath.io_bandwidth = 1000
+        self.rootpath.io_iops = 10000
+        self.rootpath.save()
+        scanner = FullScan()
+        scanner.scan()
+        self.assertIsNotNone(scanner.budget)
+        i1 = File.objects.get(name='image1.png')
+        self.assertEqual(i1.hash.digest,
+                         '4511e4bd5136a1c1491abfbc2221ffcc37c77f3d1213a41b2d3ea9e87ac6549c')
+
+        budget = IOBudget(iops=100, latency_target=0.01)
+        budget.record_latency(0.5)
+        self.assertEqual(budget.adaptive, 0.5)
+        budget.record_latency(0.001)
+        self.assertGreater(budget.adaptive, 0.5)
+
+        # A latency target alone is a budget
+        self.rootpath.io_bandwidth = None
+        self.rootpath.io_iops = None
+        self.rootpath.save()
+        self.assertIsNone(IOBudget.for_root(self.rootpath))
+        with override_settings(IO_LATENCY_TARGET=0.01):
+            budget = IOBudget.for_root(self.rootpath)
+        self.assertIsNotNone(budget)
+        budget.record_latency(0.02)
+        self.assertEqual(budget.adaptive, 0.5)
+        start = time.time()
+        budget.consume(1000)
+        self.assertGreaterEqual(time.time() - start, 0.015)
+        return
+
+
+    def test_scan_report(self):
+        """Check:
+        1. The JSON report and Prometheus textfile are written.
+        2. The report counts the files seen and hashed.
+        """
+        report_dir = join(self.tmpdir, 'storagemgr_reports')
+        if isdir(report_dir):
+            rmtree(report_dir)
+        copy2(join(self.test_data, "archive1", "image3.png"), self.rootdir)
+        with override_settings(SCAN_REPORT_DIR=report_dir,
+                               HASH_CACHE_PATH=None):
+            QuickScan().scan()
+            report = previous_report('QuickScan')
+        self.assertIsNotNone(report)
+        root = report['roots'][self.rootdir]
+        self.assertEqual(root['files'], 3)
+        self.assertEqual(root['files_hashed'], 1)
+        self.assertEqual(root['files_added'], 1)
+        self.assertEqual(root['hash_types']['png/image']['files'], 1)
+        self.assertTrue(isfile(join(report_dir, PROMETHEUS_FILE)))
+        rmtree(report_dir)
+        return
+
+
+    def test_moved_files(self):
+        """Check:
+        1. A renamed directory keeps its RelPath and files.
+        2. A file moved to another directory is re-pointed, not re-added.
+        """
+        subdir = join(self.rootdir, "sub")
+        makedirs(subdir)
+        copy2(join(self.test_data, "archive1", "image3.png"), subdir)
+        QuickScan().scan()
+        i3 = File.objects.get(name='image3.png')
+        sub = i3.path
+        rename(subdir, join(self.rootdir, "renamed"))
+        QuickScan().scan()
+        self.assertEqual(RelPath.objects.get(pk=sub.pk).path, "renamed")
+        self.assertEqual(File.objects.filter(name='image3.png').count(), 1)
+        i3 = File.objects.get(name='image3.png')
+        self.assertIsNone(i3.deleted)
+        self.assertEqual(i3.path.pk, sub.pk)
+
+        i2 = File.objects.get(name='image2.png')
+        rename(self.image2, join(self.rootdir, "renamed", "moved2.png"))
+        QuickScan().scan()
+        self.assertEqual(File.objects.filter(name='image2.png').count(), 0)
+        moved = File.objects.get(name='moved2.png')
+        self.assertEqual(moved.pk, i2.pk)
+        self.assertEqual(moved.path.pk, sub.pk)
+        self.assertIsNone(moved.deleted)
+        return
+
+
+    def test_shard_scan(self):
+        """Check:
+        1. A root is split in to its own files and a shard per sub-directory.
+        2. Scanning each shard finds all the files.
+        3. Each shard only caches its own directories.
+        """
+        for i in range(2):
+            subdir = join(self.rootdir, "dir{0}".format(i))
+            makedirs(subdir)
+            copy2(join(self.test_data, "archive1", "image3.png"),
+                  join(subdir, "image3_{0}.png".format(i)))
+        shards = root_shards(self.rootpath, 1)
+        self.assertEqual(shards, ['.', 'dir0', 'dir1'])
+        self.assertEqual(shard_top(self.rootpath, '.'), (self.rootdir, False))
+        self.assertEqual(shard_top(self.rootpath, 'dir0'),
+                         (join(self.rootdir, 'dir0'), True))
+        QuickScan().scan([(self.rootpath, shard) for shard in shards])
+        self.assertEqual(File.objects.filter(deleted=None).count(), 4)
+        self.assertEqual(ScanRun.objects.filter(shard='dir1').count(), 1)
+        # A shard's cache only has its own directories
+        RelPath.warm_cache(self.rootpath, 'dir1')
+        try:
+            with CaptureQueriesContext(connection) as queries:
+                RelPath.getrelpath(join(self.rootdir, 'dir1'),
+                                   root_path=self.rootpath)
+            self.assertEqual(len(queries), 0)
+            self.assertEqual(RelPath.getrelpath(join(self.rootdir, 'dir0'),
+                root_path=self.rootpath, create=False).path, 'dir0')
+        finally:
+            RelPath.clear_cache(self.rootpath)
+        return
+
+
+    def test_fingerprint_unchanged(self):
+        """Check:
+        1. A touched file with an unchanged fingerprint isn't rehashed.
+        2. Its new mtime is recorded.
+        """
+        utime(self.image2, (1000000000, 1000000000))
+        scanner = QuickScan(check_fingerprint=True)
+        scanner.scan()
+        counters = scanner.metrics.roots[self.rootdir].counters
+        self.assertEqual(counters['files_touched'], 1)
+        self.assertEqual(counters['files_hashed'], 0)
+        i2 = File.objects.get(name='image2.png', deleted=None)
+        self.assertEqual(i2.mtime, 1000000000)
+        return
+
+
+    def test_strip_digest(self):
+        """Check:
+        1. Hashing the image in strips answers the existing digest.
+        """
+        strip_bytes = smhash.STRIP_BYTES
+        smhash.STRIP_BYTES = 1000
+        try:
+            digest = smhash.smhash(self.image1_src)
+        finally:
+            smhash.STRIP_BYTES = strip_bytes
+        self.assertEqual(digest,
+                         '4511e4bd5136a1c1491abfbc2221ffcc37c77f3d1213a41b2d3ea9e87ac6549c')
+        return
+
+
+    def write_strip_tiff(self, path, img, rows_per_strip):
+        """Write the RGB img to path as an uncompressed little endian TIFF
+        of rows_per_strip rows per strip.  PIL before 7 ignores
+        RowsPerStrip when saving."""
+        width, height = img.size
+        data = img.convert('RGB').tobytes()
+        row_bytes = width * 3
+        strips = [data[top*row_bytes:(top+rows_per_strip)*row_bytes]
+                  for top in range(0, height, rows_per_strip)]
+        count = len(strips)
+        tags = 9
+        bps_offset = 8 + 2 + 12 * tags + 4
+        offsets_offset = bps_offset + 6
+        counts_offset = offsets_offset + 4 * count
+        data_offset = counts_offset + 4 * count
+        offsets = []
+        for strip in strips:
+            offsets.append(data_offset)
+            data_offset += len(strip)
+
+        def tag(code, tiff_type, n, value):
+            # A single SHORT is stored in the first half of the value
+            if tiff_type == 3 and n == 1:
+                return pack('<HHIH2x', code, tiff_type, n, value)
+            return pack('<HHII', code, tiff_type, n, value)
+
+        with open(path, 'wb') as fp:
+            fp.write(b'II*\x00' + pack('<I', 8) + pack('<H', tags))
+            fp.write(tag(256, 4, 1, width) + tag(257, 4, 1, height) +
+                     tag(258, 3, 3, bps_offset) + tag(259, 3, 1, 1) +
+                     tag(262, 3, 1, 2) + tag(273, 4, count, offsets_offset) +
+                     tag(277, 3, 1, 3) + tag(278, 4, 1, rows_per_strip) +
+                     tag(279, 4, count, counts_offset) + pack('<I', 0))
+            fp.write(pack('<HHH', 8, 8, 8))
+            fp.write(pack('<{0}I'.format(count), *offsets))
+            fp.write(pack('<{0}I'.format(count),
+                          *[len(strip) for strip in strips]))
+            for strip in strips:
+                fp.write(strip)
+        return
+
+
+    def test_tiff_strip_digest(self):
+        """Check:
+        1. A TIFF's strips are decoded and hashed separately.
+        2. The digest is that of the entire image.
+        """
+        tiff = join(self.rootdir, "image1.tif")
+        self.write_strip_tiff(tiff, Image.open(self.image1_src), 3)
+        img = Image.open(tiff)
+        if smhash.STRIP_DECODING:
+            self.assertEqual(len(smhash.image_strips(img)), 19)
+        self.assertEqual(smhash.image_digest(img),
+                         '4511e4bd5136a1c1491abfbc2221ffcc37c77f3d1213a41b2d3ea9e87ac6549c')
+        self.assertIsNone(smhash.image_strips(Image.open(self.image1_src)))
+        return
+
+
+    def test_mmap_digest(self):
+        """Check:
+        1. Hashing a mapped file answers the same digest as reading it.
+        """
+        mmap_min_size = smhash.MMAP_MIN_SIZE
+        mmap_chunk = smhash.MMAP_CHUNK
+        smhash.MMAP_MIN_SIZE = 1
+        smhash.MMAP_CHUNK = 1000
+        try:
+            mapped = smhash.file_digest(self.image1_src)
+        finally:
+            smhash.MMAP_MIN_SIZE = mmap_min_size
+            smhash.MMAP_CHUNK = mmap_chunk
+        self.assertEqual(mapped,
+                         smhash.file_digest(self.image1_src, use_mmap=False))
+        return
+
+
+    def test_jpeg_digest(self):
+        """Check:
+        1. A JPEG's stream digest ignores comment and APPn segments.
+        2. Other files are hashed as usual with the JPEG scheme.
+        """
+        jpeg1 = join(self.rootdir, "image1.jpg")
+        Image.open(self.image1_src).convert('RGB').save(jpeg1)
+        with open(jpeg1, 'rb') as fp:
+            data = fp.read()
+        jpeg2 = join(self.rootdir, "image2.jpg")
+        with open(jpeg2, 'wb') as fp:
+            fp.write(data[:2] + b'\xff\xfe\x00\x07hello' + data[2:])
+        smhash.pop_hash_times()
+        digest = smhash.smhash(jpeg1, algorithm='sha256+jpeg')
+        self.assertEqual(list(smhash.pop_hash_times()), ['jpeg/stream'])
+        self.assertEqual(smhash.smhash(jpeg2, algorithm='sha256+jpeg'),
+                         digest)
+        self.assertNotEqual(smhash.smhash(jpeg2), digest)
+        self.assertEqual(smhash.smhash(self.image1_src,
+                                       algorithm='sha256+jpeg'),
+                         '4511e4bd5136a1c1491abfbc2221ffcc37c77f3d1213a41b2d3ea9e87ac6549c')
+        return
+
+
+    def test_media_digest(self):
+        """Check:
+        1. A RAW's digest ignores changes to its TIFF tags.
+        2. A video's digest ignores changes to its udta atom.
+        """
+        img = Image.open(self.image1_src).convert('RGB')
+        raws = []
+        for i, description in enumerate(['one', 'another description']):
+            info = TiffImagePlugin.ImageFileDirectory_v2()
+            info[270] = description
+            raws.append(join(self.rootdir, "image{0}.cr2".format(i)))
+            img.save(raws[-1], format='TIFF', tiffinfo=info)
+        smhash.pop_hash_times()
+        digest = smhash.smhash(raws[0], algorithm='sha256+media')
+        self.assertEqual(list(smhash.pop_hash_times()), ['raw/media'])
+        self.assertEqual(smhash.smhash(raws[1], algorithm='sha256+media'),
+                         digest)
+
+        def atom(atom_type, payload):
+            return pack('>I', 8 + len(payload)) + atom_type + payload
+
+        videos = []
+        for i, tags in enumerate([b'tags', b'other tags']):
+            videos.append(join(self.rootdir, "video{0}.mp4".format(i)))
+            with open(videos[-1], 'wb') as fp:
+                fp.write(atom(b'ftyp', b'isom\x00\x00\x00\x00') +
+                         atom(b'moov', atom(b'udta', tags)) +
+                         atom(b'mdat', b'media data'))
+        smhash.pop_hash_times()
+        digest = smhash.smhash(videos[0], algorithm='sha256+media')
+        self.assertEqual(list(smhash.pop_hash_times()), ['mp4/media'])
+        self.assertEqual(smhash.smhash(videos[1], algorithm='sha256+media'),
+                         digest)
+        self.assertNotEqual(smhash.smhash(videos[1]), digest)
+        return
+
+
+    def test_sniff(self):
+        """Check:
+        1. Files are identified by their first bytes.
+        2. Files PIL can't open are hashed without trying.
+        """
+        self.assertEqual(smhash.file_type(self.image1_src), 'png')
+        video = join(self.rootdir, "video.mp4")
+        with open(video, 'wb') as fp:
+            fp.write(pack('>I', 16) + b'ftypisom\x00\x00\x00\x00')
+        self.assertEqual(smhash.file_type(video), 'mp4')
+        self.assertEqual(smhash.file_type(join(self.test_data, "File1.txt")),
+                         'unknown')
+        smhash.pop_hash_times()
+        self.assertEqual(smhash.smhash(video), smhash.file_digest(video))
+        self.assertEqual(list(smhash.pop_hash_times()), ['mp4/file'])
+        self.assertFalse(smhash.image_digested(video))
+        self.assertTrue(smhash.image_digested(video, 'sha256+media'))
+        return
+
+
+    def test_near_duplicates(self):
+        """Check:
+        1. A resized, re-encoded, copy has a nearby dhash.
+        2. The dhash is calculated from the image decoded by smhash().
+        3. The MultiIndex finds it.
+        """
+        img = Image.open(self.image1_src).convert('RGB')
+        large = join(self.rootdir, "large.jpg")
+        img.resize((img.size[0] * 2, img.size[1] * 2),
+                   smhash.DHASH_RESAMPLE).save(large, quality=75)
+        dhashes = {}
+        smhash.smhash(self.image1_src, dhashes=dhashes)
+        dhash1 = dhashes[self.image1_src]
+        self.assertEqual(dhash1, smhash.image_dhash(self.image1_src))
+        dhash2 = smhash.image_dhash(large)
+        self.assertTrue(smhash.hamming(dhash1, dhash2) <= 4)
+        self.assertEqual(smhash.image_dhash(join(self.test_data,
+                                                 "File1.txt")), None)
+        index = MultiIndex(4)
+        for value in [dhash1, ~dhash1, dhash1 ^ 0xff00ff]:
+            index.add(value)
+        self.assertEqual([value for d, value in index.search(dhash2)],
+                         [dhash1])
+        self.assertEqual(near_clusters([dhash1, dhash2, ~dhash1], 4),
+                         [set([dhash1, dhash2])])
+        return
+
+
+    def test_getrootpath(self):
+        """Check:
+        1. The longest containing root is answered.
+        2. Roots only contain whole path components.
+        3. New roots are found.
+        4. Roots added by another process are found after the TTL.
+        """
+        self.assertEqual(RootPath.getrootpath(join(self.rootdir, "a", "b")),
+                         self.rootpath)
+        self.assertEqual(RootPath.getrootpath(self.rootdir + "2"), None)
+        nested = RootPath(path=join(self.rootdir, "a"))
+        nested.save()
+        self.assertEqual(RootPath.getrootpath(join(self.rootdir, "a", "b")),
+                         nested)
+        self.assertEqual(RootPath.getrootpath(join(self.rootdir, "ab")),
+                         self.rootpath)
+        with CaptureQueriesContext(connection) as queries:
+            RootPath.getrootpath(self.rootdir)
+        self.assertEqual(len(queries), 0)
+        # Another process adds a root, which isn't seen until the TTL
+        RootPath.objects.bulk_create([RootPath(path=self.rootdir + "2")])
+        self.assertEqual(RootPath.getrootpath(self.rootdir + "2"), None)
+        with override_settings(ROOT_PATH_CACHE_TTL=0):
+            self.assertEqual(RootPath.getrootpath(self.rootdir + "2").path,
+                             self.rootdir + "2")
+        return
+
+
+    def test_gethashes(self):
+        """Check:
+        1. Missing Hashes are created in bulk.
+        2. Cached digests are answered without a query.
+        3. The cache is cleared when a batch unit is rolled back.
+        4. Only the failed unit of a batch is lost, the others are replayed.
+        """
+        digests = ['digest{0}'.format(i) for i in range(3)]
+        hashes = Hash.gethashes(digests + ['0'])
+        self.assertEqual(sorted(hashes), ['0'] + digests)
+        self.assertEqual(Hash.objects.filter(digest__in=digests).count(), 3)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(Hash.gethash('digest1').pk,
+                             hashes['digest1'].pk)
+            Hash.gethashes(digests)
+        self.assertEqual(len(queries), 0)
+
+        def fail():
+            Hash.gethash('digest3')
+            raise ValueError("fail")
+
+        batch = TransactionBatch(retries=0)
+        batch.run(Hash.gethash, 'digest4')
+        batch.run(fail)
+        self.assertEqual(Hash.objects.filter(digest='digest3').count(), 0)
+        with CaptureQueriesContext(connection) as queries:
+            Hash.gethashes(digests)
+        self.assertEqual(len(queries), 1)
+        batch.close()
+        # The earlier unit was replayed
+        self.assertEqual(Hash.objects.filter(digest='digest4').count(), 1)
+        self.assertEqual(len(batch.failed), 1)
+        return
+
+
+    def test_keyword_sync(self):
+        """Check:
+        1. Keywords are replaced or added for several files at once.
+        2. Once the names are cached, each apply takes three queries: read,
+           delete and insert.
+        """
+        i1 = File.objects.get(name='image1.png')
+        i2 = File.objects.get(name='image2.png')
+        sync = KeywordSync()
+        sync.set_keywords(i1, ['tag1', 'tag2'])
+        sync.set_keywords(i2, ['tag2'])
+        sync.apply()
+        self.assertEqual(set(i1.keyword_names), set(['tag1', 'tag2']))
+        self.assertEqual(set(i2.keyword_names), set(['tag2']))
+        sync.set_keywords(i1, ['tag2'])
+        sync.add_keywords(i2, ['tag1'])
+        with CaptureQueriesContext(connection) as queries:
+            sync.apply()
+        self.assertEqual(len(queries), 3)
+        self.assertEqual(set(i1.keyword_names), set(['tag2']))
+        self.assertEqual(set(i2.keyword_names), set(['tag1', 'tag2']))
+        self.assertEqual(Keyword.objects.count(), 2)
+        return
+
+
+    def test_keyword_concurrent_insert(self):
+        """Check:
+        1. A keyword inserted by another process after the names were read
+           isn't duplicated.
+        """
+        Keyword(name='tag1').save()
+        read_ids = Keyword.__dict__['read_ids']
+        reads = []
+
+        def stale_read_ids(names):
+            reads.append(names)
+            if len(reads) == 1:
+                # Read before the other process inserted tag1
+                return {}
+            return read_ids.__get__(None, Keyword)(names)
+
+        Keyword.read_ids = staticmethod(stale_read_ids)
+        try:
+            ids = Keyword.getids(['tag1', 'tag2'])
+        finally:
+            Keyword.read_ids = read_ids
+        self.assertEqual(sorted(ids), ['tag1', 'tag2'])
+        self.assertEqual(Keyword.objects.filter(name='tag1').count(), 1)
+        self.assertEqual(ids['tag1'], Keyword.objects.get(name='tag1').pk)
+        return
+
+
+    def test_hash_cache(self):
+        """Check:
+        1. A hashed file's digest is cached.
+        2. A modified file isn't answered the cached digest.
+        """
+        cache_path = join(self.tmpdir, 'storagemgr_hashcache.sqlite3')
+        if isfile(cache_path):
+            remove(cache_path)
+        with override_settings(HASH_CACHE_PATH=cache_path):
+            digest = cached_smhash(self.image2)
+            self.assertEqual(hash_cache().get(content_stats(self.image2),
+                                              'sha256'), digest)
+            copy2(self.image1_src, self.image2)
+            self.assertEqual(cached_smhash(self.image2),
+                             '4511e4bd5136a1c1491abfbc2221ffcc37c77f3d1213a41b2d3ea9e87ac6549c')
+        return
+
+
+    def test_migrate_hashes(self):
+        """Check:
+        1. Files added after changing the algorithm match existing files.
+        2. Migrating rehashes the existing files with the new algorithm.
+        3. Duplicates hashed with different algorithms are merged.
+        """
+        with override_settings(SMHASH_ALGORITHM='sha512'):
+            copy2(self.image1_src, join(self.rootdir, "image1copy.png"))
+            scanner = QuickScan()
+            scanner.scan()
+            i1 = File.objects.get(name='image1.png')
+            i1copy = File.objects.get(name='image1copy.png')
+            self.assertEqual(i1.hash.algorithm, 'sha256')
+            self.assertEqual(i1copy.hash.algorithm, 'sha512')
+            self.assertEqual(i1copy.matching_files(), [i1])
+
+            HashMigration().migrate()
+            self.assertEqual(Hash.algorithms(), ['sha512'])
+            i1 = File.objects.get(name='image1.png')
+            i1copy = File.objects.get(name='image1copy.png')
+            self.assertEqual(i1.hash, i1copy.hash)
+            self.assertEqual(i1.original_hash, i1.hash)
+            self.assertEqual(len(i1.hash.digest), 128)
+        return
+
+
+    def test_migrate_split_hash(self):
+        """Check:
+        1. A JPEG and a PNG with the same pixels share a sha256 Hash.
+        2. Migrating to the JPEG scheme splits them between two Hashes.
+        """
+        jpeg = join(self.rootdir, "image1.jpg")
+        Image.open(self.image1_src).convert('RGB').save(jpeg)
+        png = join(self.rootdir, "image1jpeg.png")
+        Image.open(jpeg).save(png)
+        scanner = QuickScan()
+        scanner.scan()
+        jpeg = File.objects.get(name='image1.jpg')
+        png = File.objects.get(name='image1jpeg.png')
+        self.assertEqual(jpeg.hash, png.hash)
+        old_digest = png.hash.digest
+
+        with override_settings(SMHASH_JPEG_STREAM=True):
+            HashMigration().migrate()
+            self.assertEqual(Hash.algorithms(), ['sha256+jpeg'])
+        jpeg = File.objects.get(name='image1.jpg')
+        png = File.objects.get(name='image1jpeg.png')
+        self.assertNotEqual(jpeg.hash, png.hash)
+        self.assertEqual(png.hash.digest, old_digest)
+        self.assertEqual(jpeg.original_hash, jpeg.hash)
+        self.assertEqual(png.original_hash, png.hash)
+        return
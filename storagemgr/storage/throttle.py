@@ -0,0 +1,181 @@
+"""
+Module: throttle
+
+Limit the I/O of background scanning, hashing and archiving so that it
+doesn't starve foreground users of shared storage.
+
+An IOBudget shapes reads with two token buckets: bandwidth (bytes/s) and
+operations (IOPS).  The rates are scaled by:
+
+* the time of day, from a schedule of (start hour, end hour, factor), and
+* an adaptive factor that is halved whenever the average read latency
+  exceeds the target, and slowly recovers while it is below.
+
+Without bandwidth or IOPS limits, a latency target still throttles the
+reads: the time spent between reads is scaled instead, so that reading
+takes up only the factor of the time.
+
+The budget of a root path is taken from its io_bandwidth and io_iops,
+falling back to settings.IO_BANDWIDTH and settings.IO_IOPS.
+"""
+
+import threading
+import time
+from datetime import datetime
+
+from django.conf import settings
+
+from logger import init_logging
+logger = init_logging(__name__)
+
+# Weight of the latest measurement in the average read latency
+LATENCY_WEIGHT = 0.2
+# Limits and step of the adaptive factor
+MIN_ADAPTIVE = 0.05
+ADAPTIVE_STEP = 0.05
+
+# config tuple: IOBudget, for the worker processes
+_budgets = {}
+
+
+class TokenBucket(object):
+    """Allow rate units per second, with bursts of up to burst units.
+    May be shared by threads: each consumer takes its tokens, possibly
+    going in to debt, and sleeps until its share of the debt is paid."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.tokens = self.burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, amount, factor=1.0):
+        """Wait until amount units are available at rate * factor"""
+        rate = self.rate * factor
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.last) * rate)
+            self.last = now
+            self.tokens -= amount
+            debt = -self.tokens
+        if debt > 0:
+            # Sleep until the debt has been paid
+            time.sleep(debt / rate)
+        return
+
+
+class IOBudget(object):
+    """Bandwidth (bytes/s) and IOPS limits for reading files.
+
+    schedule is a list of (start hour, end hour, factor), e.g.
+    [(8, 18, 0.25)] limits the rates to a quarter during office hours.
+    latency_target (seconds per read) enables the adaptive backoff.
+    A rate of None is unlimited; if both are, reads are spaced out to
+    apply the factor instead."""
+
+    def __init__(self, bandwidth=None, iops=None, schedule=None,
+                 latency_target=None):
+        self.bandwidth = bandwidth
+        self.iops = iops
+        self.schedule = schedule or []
+        self.latency_target = latency_target
+        self.bytes_bucket = TokenBucket(bandwidth) if bandwidth else None
+        self.ops_bucket = TokenBucket(iops) if iops else None
+        self.latency = None
+        # The duration of the last read, see record_latency()
+        self.read_time = None
+        self.adaptive = 1.0
+
+    @classmethod
+    def for_root(cls, root_path, share=1):
+        """Answer the budget for root_path, divided between share processes.
+        Answer None if the root is unlimited and there is no latency
+        target."""
+        bandwidth = root_path.io_bandwidth or settings.IO_BANDWIDTH
+        iops = root_path.io_iops or settings.IO_IOPS
+        if not bandwidth and not iops and \
+                settings.IO_LATENCY_TARGET is None:
+            return None
+        if bandwidth:
+            # Configured in MB/s
+            bandwidth = bandwidth * 1024 * 1024 / share
+        if iops:
+            iops = float(iops) / share
+        return cls(bandwidth, iops, settings.IO_SCHEDULE,
+                   settings.IO_LATENCY_TARGET)
+
+    @classmethod
+    def from_config(cls, config):
+        """Answer the (process wide) budget for the supplied config().
+        Used by the worker processes, so that the buckets persist
+        between tasks."""
+        if config is None:
+            return None
+        budget = _budgets.get(config)
+        if budget is None:
+            bandwidth, iops, schedule, latency_target = config
+            budget = cls(bandwidth, iops, list(schedule), latency_target)
+            # Worker threads share the process's budget
+            budget = _budgets.setdefault(config, budget)
+        return budget
+
+    def config(self):
+        """Answer a hashable tuple from which the receiver can be recreated"""
+        return (self.bandwidth, self.iops, tuple(self.schedule),
+                self.latency_target)
+
+    def factor(self):
+        """Answer the current scaling of the rates"""
+        factor = self.adaptive
+        hour = datetime.now().hour
+        for start, end, scale in self.schedule:
+            if start <= end:
+                in_period = start <= hour < end
+            else:
+                # The period wraps around midnight
+                in_period = hour >= start or hour < end
+            if in_period:
+                factor *= scale
+                break
+        return factor
+
+    def consume(self, nbytes, ops=1):
+        """Wait until nbytes may be read using ops operations"""
+        factor = self.factor()
+        while factor <= 0:
+            # Paused for this period, check again every minute
+            time.sleep(60)
+            factor = self.factor()
+        if self.ops_bucket is None and self.bytes_bucket is None:
+            if factor < 1.0 and self.read_time:
+                # Unlimited rates: read for only factor of the time
+                time.sleep(self.read_time * (1.0 / factor - 1.0))
+            return
+        if self.ops_bucket is not None and ops > 0:
+            self.ops_bucket.consume(ops, factor)
+        if self.bytes_bucket is not None and nbytes > 0:
+            self.bytes_bucket.consume(nbytes, factor)
+        return
+
+    def record_latency(self, seconds):
+        """Record the duration of a read and adjust the adaptive factor"""
+        self.read_time = seconds
+        if self.latency_target is None:
+            return
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency = LATENCY_WEIGHT * seconds + \
+                           (1 - LATENCY_WEIGHT) * self.latency
+        if self.latency > self.latency_target:
+            if self.adaptive > MIN_ADAPTIVE:
+                self.adaptive = max(MIN_ADAPTIVE, self.adaptive / 2)
+                logger.debug("Read latency {0:.3f}s, backing off to {1:.2f}"
+                             .format(self.latency, self.adaptive))
+            # Start measuring afresh at the new rate
+            self.latency = None
+        else:
+            self.adaptive = min(1.0, self.adaptive + ADAPTIVE_STEP)
+        return
@@ -0,0 +1,421 @@
+"""
+Module: watcher
+
+Keep the catalog up to date by watching the root paths for changes,
+rather than periodically walking the entire tree.
+
+On Linux the kernel's inotify interface is used (through ctypes), otherwise
+the watched directories are polled.  Events are collected in a debounced
+queue and only the affected paths are updated using the Scan logic.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import stat
+import struct
+import sys
+import time
+from os.path import dirname, basename, isdir, islink, join, lexists
+
+from django.db.models import Q
+
+from storage.models import RootPath, RelPath, File, os_stats
+from storage.scan import QuickScan, walk
+from storage.exclude import exclude_matcher
+from storage.throttle import IOBudget
+
+from logger import init_logging
+logger = init_logging(__name__)
+
+# inotify constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+             IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+EVENT_HEADER = struct.Struct('iIII')
+# The encoding of the names answered by inotify
+FS_ENCODING = sys.getfilesystemencoding() or 'utf-8'
+
+# Seconds a path must be quiet before it is processed
+DEBOUNCE_DELAY = 5.0
+# Seconds between polls by the PollingWatcher
+POLL_INTERVAL = 60.0
+
+
+class InotifyWatcher(object):
+    """Watch directories using Linux inotify.
+
+    read() answers a list of (path, is_dir) for changed paths,
+    path is None if the kernel event queue overflowed."""
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c')
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, "inotify_init1: {0}".format(os.strerror(err)))
+        self.wds = {}
+        self.paths = {}
+
+    @classmethod
+    def available(cls):
+        """Answer a boolean indicating whether inotify can be used"""
+        if not sys.platform.startswith('linux'):
+            return False
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            return False
+        return hasattr(ctypes.CDLL(libc_name), 'inotify_init1')
+
+    def watch(self, path):
+        """Add a watch on the directory path (not recursive)"""
+        if path in self.paths:
+            return
+        try:
+            fspath = fsencode(path)
+        except UnicodeError:
+            logger.warn(u"Unable to encode {0!r}, not watched".format(path))
+            return
+        wd = self.libc.inotify_add_watch(self.fd, fspath, WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                logger.error("Out of inotify watches, increase "
+                             "fs.inotify.max_user_watches")
+            elif err == errno.ENOENT:
+                # The directory has gone before we could watch it
+                return
+            raise OSError(err, u"inotify_add_watch {0}: {1}".format(
+                path, os.strerror(err)))
+        self.wds[wd] = path
+        self.paths[path] = wd
+        return
+
+    def unwatch(self, path):
+        """Remove the watches on path and all its sub-directories"""
+        prefix = join(path, '')
+        for wpath in list(self.paths.keys()):
+            if wpath == path or wpath.startswith(prefix):
+                wd = self.paths.pop(wpath)
+                del self.wds[wd]
+                # The kernel may already have removed the watch
+                self.libc.inotify_rm_watch(self.fd, wd)
+        return
+
+    def read(self, timeout):
+        """Answer the list of (path, is_dir) that have changed,
+        waiting up to timeout seconds"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if len(readable) == 0:
+            return []
+        buf = os.read(self.fd, 65536)
+        changes = []
+        offset = 0
+        while offset < len(buf):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(buf, offset)
+            offset += EVENT_HEADER.size
+            name = buf[offset:offset+length].rstrip(b'\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                changes.append((None, True))
+                continue
+            if mask & IN_IGNORED:
+                # The watched directory has been removed
+                path = self.wds.pop(wd, None)
+                if path is not None:
+                    self.paths.pop(path, None)
+                continue
+            dir_path = self.wds.get(wd)
+            if dir_path is None or len(name) == 0:
+                continue
+            try:
+                name = name.decode(FS_ENCODING)
+            except UnicodeDecodeError:
+                logger.warn(u"Skipping undecodable name {0!r} in {1}".format(
+                    name, dir_path))
+                continue
+            path = join(dir_path, name)
+            is_dir = bool(mask & IN_ISDIR)
+            if is_dir and mask & IN_MOVED_FROM:
+                # The watch descriptors now refer to the new location
+                self.unwatch(path)
+            changes.append((path, is_dir))
+        return changes
+
+
+def fsencode(path):
+    """Answer path encoded in the file system encoding"""
+    if isinstance(path, bytes):
+        return path
+    if hasattr(os, 'fsencode'):
+        return os.fsencode(path)
+    return path.encode(FS_ENCODING)
+
+
+class PollingWatcher(object):
+    """Watch directories by periodically listing them and comparing
+    each entry's type, mtime and size.
+
+    Provides the same interface as InotifyWatcher for systems without
+    inotify."""
+
+    def __init__(self, interval=POLL_INTERVAL):
+        self.interval = interval
+        self.snapshots = {}
+        self.last_poll = time.time()
+
+    def snapshot(self, path):
+        """Answer a dictionary of name: (is_dir, mtime, size) for path.
+        Directories are reported by their own snapshot, so only their
+        presence is recorded here."""
+        snapshot = {}
+        try:
+            names = os.listdir(path)
+        except OSError:
+            return None
+        for name in names:
+            try:
+                stats = os.lstat(join(path, name))
+            except OSError:
+                continue
+            if stat.S_ISDIR(stats.st_mode):
+                snapshot[name] = (True, None, None)
+            else:
+                snapshot[name] = (False, stats.st_mtime, stats.st_size)
+        return snapshot
+
+    def watch(self, path):
+        if path not in self.snapshots:
+            self.snapshots[path] = self.snapshot(path) or {}
+        return
+
+    def unwatch(self, path):
+        prefix = join(path, '')
+        for wpath in list(self.snapshots.keys()):
+            if wpath == path or wpath.startswith(prefix):
+                del self.snapshots[wpath]
+        return
+
+    def read(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        if time.time() - self.last_poll < self.interval:
+            return []
+        self.last_poll = time.time()
+        changes = []
+        for path, old in list(self.snapshots.items()):
+            new = self.snapshot(path)
+            if new is None:
+                # The directory has gone, its parent will report it
+                del self.snapshots[path]
+                continue
+            self.snapshots[path] = new
+            for name in set(old.keys()) | set(new.keys()):
+                if old.get(name) != new.get(name):
+                    is_dir = (old.get(name) or new.get(name))[0]
+                    changes.append((join(path, name), is_dir))
+        return changes
+
+
+def create_watcher(poll=False, interval=POLL_INTERVAL):
+    """Answer an InotifyWatcher if available, otherwise a PollingWatcher"""
+    if not poll and InotifyWatcher.available():
+        return InotifyWatcher()
+    logger.info("inotify not available, polling every {0}s".format(interval))
+    return PollingWatcher(interval)
+
+
+class DebounceQueue(object):
+    """Collect changed paths until they have been quiet for delay seconds"""
+
+    def __init__(self, delay=DEBOUNCE_DELAY):
+        self.delay = delay
+        self.pending = {}
+
+    def add(self, path, is_dir):
+        entry = self.pending.get(path)
+        if entry is None:
+            self.pending[path] = [time.time(), is_dir]
+        else:
+            entry[0] = time.time()
+            entry[1] = entry[1] or is_dir
+        return
+
+    def ready(self):
+        """Remove and answer the list of (path, is_dir) that are ready to be
+        processed, parents before children"""
+        now = time.time()
+        ready = []
+        for path, (last, is_dir) in list(self.pending.items()):
+            if now - last >= self.delay:
+                del self.pending[path]
+                ready.append((path, is_dir))
+        ready.sort()
+        return ready
+
+    def __len__(self):
+        return len(self.pending)
+
+
+class RootWatcher(object):
+    """Keep the catalog of the root paths up to date from watcher events.
+
+    Files are updated individually using the Scan add_file(),
+    update_file() and mark_deleted() logic, new directories are scanned
+    and ExcludeDir entries are not watched.  An event that fails, e.g.
+    because the file has gone or can't be read, is logged and skipped."""
+
+    def __init__(self, watcher, rp=None, delay=DEBOUNCE_DELAY):
+        self.watcher = watcher
+        self.scan = QuickScan(rp)
+        self.queue = DebounceQueue(delay)
+        # root path id: IOBudget
+        self.budgets = {}
+
+    def start(self):
+        """Add the watches for all the root paths"""
+        for root_path in self.scan.root_paths:
+            logger.info(u"Watching: {0}".format(root_path.abspath))
+        self.watch_roots()
+        return
+
+    def watch_roots(self):
+        """Watch each directory of the root paths that isn't already
+        watched"""
+        for root_path in self.scan.root_paths:
+            self.watch_tree(root_path, root_path.abspath)
+        return
+
+    def overflowed(self):
+        """Events have been lost: watch any directories that were created
+        unseen and rescan all the roots"""
+        logger.warn("Event queue overflow, rescanning all roots")
+        self.watch_roots()
+        self.scan.scan()
+        return
+
+    def run(self):
+        """Process events until interrupted"""
+        self.start()
+        while True:
+            for path, is_dir in self.watcher.read(timeout=1.0):
+                if path is None:
+                    self.handle(self.overflowed)
+                    continue
+                self.queue.add(path, is_dir)
+            for path, is_dir in self.queue.ready():
+                self.handle(self.process, path, is_dir)
+
+    def handle(self, func, *args):
+        """Call func(*args), logging rather than raising any failure so
+        that the remaining events are still processed"""
+        try:
+            func(*args)
+        except Exception:
+            logger.error(u"Unable to process: {0}{1}".format(
+                func.__name__, args), exc_info=True)
+        return
+
+    def root_path(self, path):
+        """Answer the watched root path for path, i.e. the longest one
+        that is path or one of its parents (see RootPath.getrootpath()),
+        or None"""
+        root_path = RootPath.getrootpath(path)
+        if root_path not in self.scan.root_paths:
+            return None
+        return root_path
+
+    def budget(self, root_path):
+        """Answer the IOBudget of root_path, shared by all its events"""
+        if root_path.pk not in self.budgets:
+            self.budgets[root_path.pk] = IOBudget.for_root(root_path)
+        return self.budgets[root_path.pk]
+
+    def excluded(self, root_path, path):
+        return exclude_matcher(root_path).excluded(path)
+
+    def watch_tree(self, root_path, path):
+        """Watch path and each of its non-excluded sub-directories.
+        Answer the list of (path, stats, entry_count, files) of each
+        directory, as answered by walk()."""
+        if self.excluded(root_path, path):
+            return []
+        matcher = exclude_matcher(root_path)
+        watched = []
+        for entry in walk(path, matcher.child_excluded):
+            self.watcher.watch(entry[0])
+            watched.append(entry)
+        return watched
+
+    def process(self, path, is_dir):
+        """Update the catalog for the changed path"""
+        root_path = self.root_path(path)
+        if root_path is None:
+            return
+        if self.excluded(root_path, dirname(path)):
+            return
+        self.scan.budget = self.budget(root_path)
+        if isdir(path) and not islink(path):
+            self.process_dir(root_path, path)
+        elif lexists(path):
+            self.process_file(root_path, path)
+        else:
+            self.process_removed(root_path, path, is_dir)
+        return
+
+    def process_dir(self, root_path, path):
+        """A directory has been created or moved in, watch and scan it"""
+        for dir_path, stats, entry_count, files in \
+                self.watch_tree(root_path, path):
+            rel_path = self.scan.dir_rel_path(root_path, dir_path, stats)
+            self.scan.scan_dir(rel_path, files, entry_count, stats)
+        return
+
+    def process_file(self, root_path, path):
+        """A file has been created or modified"""
+        rel_path = RelPath.getrelpath(dirname(path), root_path=root_path)
+        fname = basename(path)
+        file = self.scan.file(rel_path, fname)
+        if file is None:
+            if len(self.scan.moved_files(rel_path,
+                                         {fname: os_stats(path)})) > 0:
+                return
+            self.scan.add_file(rel_path, fname)
+        elif self.scan.needs_rehash(file):
+            self.scan.update_file(file)
+        return
+
+    def process_removed(self, root_path, path, is_dir):
+        """A file or directory has been deleted or moved out"""
+        try:
+            rel_path = RelPath.getrelpath(dirname(path), root_path=root_path,
+                                          create=False)
+        except ValueError:
+            # The parent directory has never been scanned
+            return
+        file = self.scan.file(rel_path, basename(path))
+        if file is not None:
+            logger.debug(u"Removing: {0}".format(file.abspath))
+            file.mark_deleted()
+            return
+        # Check for a directory
+        self.watcher.unwatch(path)
+        rel_str = path[len(root_path.abspath)+1:]
+        query = Q(path__path=rel_str) | Q(path__path__startswith=rel_str + '/')
+        files = File.objects.filter(query, path__root=root_path, deleted=None)
+        File.mark_all_deleted(list(files))
+        return
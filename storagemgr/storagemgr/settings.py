@@ -185,5 +185,54 @@ SESSION_SERIALIZER = 'django.contrib.sessions.serializers.JSONSerializer'
 TMP_PATH = '/tmp'
 TMP_MIN_SPACE = 100 # MB
 
+# Scans and archiving commit their database writes every COMMIT_SIZE
+# directories / files or COMMIT_INTERVAL seconds, whichever comes first
+COMMIT_SIZE = 100
+COMMIT_INTERVAL = 10.0
+
+# The I/O budget of scans, hashing and archiving, see storage/throttle.py.
+# IO_BANDWIDTH (MB/s) and IO_IOPS may be overridden per RootPath,
+# None = unlimited.
+IO_BANDWIDTH = None
+IO_IOPS = None
+# (start hour, end hour, factor) applied to the budget by time of day,
+# e.g. [(8, 18, 0.25), (18, 23, 0.5)]
+IO_SCHEDULE = []
+# Back off when the average read latency exceeds this many seconds,
+# None = don't adapt
+IO_LATENCY_TARGET = None
+
+# The hashlib algorithm of new digests, e.g. 'blake2b' (requires pyblake2
+# on Python 2).  Existing digests are converted by manage.py migrate_hashes.
+SMHASH_ALGORITHM = 'sha256'
+# Hash JPEGs by their compressed image data instead of decoding them.
+# Also converted by migrate_hashes.
+SMHASH_JPEG_STREAM = False
+# Hash TIFF based RAWs (e.g. CR2) by their image data and MP4/MOV videos by
+# their media data, so that editing their metadata doesn't change the
+# digest.  Also converted by migrate_hashes.
+SMHASH_MEDIA_STREAM = False
+
+# Store the perceptual hash (dhash) of images, used to find near
+# duplicates by manage.py manage_duplicates --near
+DHASH_IMAGES = True
+
+# The cache of file digests, see storage/hashcache.py, None = no cache
+HASH_CACHE_PATH = join(PROJECT_DIR, 'hashcache.sqlite3')
+# The maximum number of cached digests
+HASH_CACHE_ENTRIES = 1000000
+
+# The number of Hash ids cached in each process, see Hash.gethash()
+HASH_ID_CACHE_SIZE = 100000
+# The number of Keyword ids cached in each process, see Keyword.getids()
+KEYWORD_ID_CACHE_SIZE = 10000
+# Seconds before each process checks whether the root paths have been
+# changed by another process, see RootPath.getrootpath()
+ROOT_PATH_CACHE_TTL = 60
+
+# Scans write a JSON report and Prometheus textfile (storagemgr_scan.prom)
+# to SCAN_REPORT_DIR at the end of each run, None = no reports
+SCAN_REPORT_DIR = None
+
 IMAGES_ARCHIVE = '/mnt/daa/data1/Photos'
 VIDEO_ARCHIVE = '/mnt/daa/data1/Photos'
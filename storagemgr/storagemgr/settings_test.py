@@ -18,3 +18,7 @@ del DATABASES['sqlitedb']
 
 IMAGES_ARCHIVE = '/dev/shm/storagemgr'
 VIDEO_ARCHIVE = '/dev/shm/storagemgr'
+
+# Don't share the persistent digest cache with real scans, the cache tests
+# override this with their own path
+HASH_CACHE_PATH = None
@@ -0,0 +1,61 @@
+-- Upgrade a database created by syncdb before the following columns were
+-- added.  syncdb creates missing tables (storage_scanrun and
+-- storage_scanrundir) but doesn't alter existing ones, so run:
+--
+--   manage.py syncdb
+--   manage.py dbshell < upgrade.sql
+--
+-- The statements are valid for both MySQL and SQLite; the /*!40000 */
+-- statements are only executed by MySQL.  Duplicate Keywords are merged
+-- before their names are made unique.  New digests are
+-- tagged with their algorithm; existing rows are sha256, the default.
+-- The new File and RelPath columns are filled in by the next scan, and
+-- File.dhash by manage.py migrate_hashes --dhashes.
+
+-- RelPath: the directory's mtime, entry count and device / inode,
+-- used to skip unchanged directories and find moved ones
+ALTER TABLE storage_relpath ADD COLUMN mtime double precision NULL;
+ALTER TABLE storage_relpath ADD COLUMN entry_count integer NULL;
+ALTER TABLE storage_relpath ADD COLUMN dev bigint NULL;
+ALTER TABLE storage_relpath ADD COLUMN ino bigint NULL;
+
+-- RootPath: the per root I/O budget, NULL = settings.IO_BANDWIDTH / IO_IOPS
+ALTER TABLE storage_rootpath ADD COLUMN io_bandwidth double precision NULL;
+ALTER TABLE storage_rootpath ADD COLUMN io_iops integer NULL;
+
+-- File: the device / inode, nanosecond mtime, content fingerprint and
+-- perceptual hash
+ALTER TABLE storage_file ADD COLUMN dev bigint NULL;
+ALTER TABLE storage_file ADD COLUMN ino bigint NULL;
+ALTER TABLE storage_file ADD COLUMN mtime_ns bigint NULL;
+ALTER TABLE storage_file ADD COLUMN fingerprint varchar(64) NULL;
+ALTER TABLE storage_file ADD COLUMN dhash bigint NULL;
+CREATE INDEX storage_file_fingerprint ON storage_file (fingerprint);
+
+-- Hash: the algorithm of the digest
+ALTER TABLE storage_hash ADD COLUMN algorithm varchar(32) NOT NULL
+    DEFAULT 'sha256';
+CREATE INDEX storage_hash_algorithm ON storage_hash (algorithm);
+
+-- Keyword: the names are unique.  Duplicate keywords are merged in to the
+-- first of each name, then the name is limited to 255 characters (MySQL
+-- only, SQLite doesn't enforce the length; longer names must be shortened
+-- first) and made unique.
+CREATE TABLE storage_keyword_merge AS
+    SELECT k.id AS old_id, MIN(f.id) AS new_id
+    FROM storage_keyword k
+    JOIN storage_keyword f ON f.name = k.name
+    GROUP BY k.id;
+CREATE TABLE storage_keyword_files_merged AS
+    SELECT DISTINCT kf.file_id AS file_id, m.new_id AS keyword_id
+    FROM storage_keyword_files kf
+    JOIN storage_keyword_merge m ON m.old_id = kf.keyword_id;
+DELETE FROM storage_keyword_files;
+INSERT INTO storage_keyword_files (file_id, keyword_id)
+    SELECT file_id, keyword_id FROM storage_keyword_files_merged;
+DELETE FROM storage_keyword WHERE id IN
+    (SELECT old_id FROM storage_keyword_merge WHERE old_id <> new_id);
+DROP TABLE storage_keyword_files_merged;
+DROP TABLE storage_keyword_merge;
+/*!40000 ALTER TABLE storage_keyword MODIFY name varchar(255) NOT NULL */;
+CREATE UNIQUE INDEX storage_keyword_name ON storage_keyword (name);